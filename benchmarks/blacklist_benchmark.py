@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the blacklist checks of find on labels with many overlapping matches
+The CodeMatcher with its BlacklistIndex is compared to the former linear scans over the
+blacklisted words. Both have to return the same matches.
+
+python -m benchmarks.blacklist_benchmark -o results.json
+"""
+
+import argparse
+import json
+import platform
+import random
+import typing
+
+from benchmarks.corpus import generate_locations, location_codes
+from benchmarks.find_benchmark import best_time, current_commit
+from hloc.find_helper.code_matcher import CodeMatcher, BLACKLIST_CODE_TYPE
+from hloc.scripts.find import create_trie_obj
+
+
+def __create_parser_arguments(parser: argparse.ArgumentParser):
+    """Creates the arguments for the parser"""
+    parser.add_argument('-nl', '--number-locations', type=int, default=10**4,
+                        help='The number of synthetic locations')
+    parser.add_argument('-nb', '--number-labels', type=int, default=5*10**4,
+                        help='The number of synthetic labels')
+    parser.add_argument('-nw', '--number-blacklist-words', type=int, default=2000,
+                        help='The number of blacklisted words')
+    parser.add_argument('-cw', '--words-per-code', type=int, default=20,
+                        help='The number of code to location blacklist words per code')
+    parser.add_argument('-lw', '--blacklist-words-per-label', type=int, default=6,
+                        help='The maximum number of blacklisted words in a label')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='The seed for the corpus generation')
+    parser.add_argument('-r', '--repetitions', type=int, default=3,
+                        help='The number of repetitions per timing. The fastest is reported')
+    parser.add_argument('-o', '--output-file', type=str,
+                        help='The JSON file for the results. Printed if not set')
+
+
+def linear_scan_search(code_matcher: CodeMatcher, label_name: str) \
+        -> typing.List[typing.Tuple[str, str, int, int]]:
+    """
+    CodeMatcher.search_with_offsets with the blacklist checks of find before the
+    BlacklistIndex as reference
+    """
+    location_code_tuples = []
+
+    sub_label_offset = 0
+    for o_label in label_name.split('-'):
+        blacklisted = []
+
+        for start_index, key in code_matcher.code_occurrences(o_label):
+            if [black_word for black_word in blacklisted if key in black_word]:
+                continue
+
+            if key in code_matcher.code_to_location_blacklist and \
+                    [black_word for black_word in code_matcher.code_to_location_blacklist[key]
+                     if black_word in o_label]:
+                continue
+
+            matching_locations = code_matcher.trie[key]
+            if [code_type for _, code_type in matching_locations
+                    if code_type == BLACKLIST_CODE_TYPE]:
+                blacklisted.append(key)
+                continue
+
+            for location_id, code_type in matching_locations:
+                location_code_tuples.append((location_id.decode(), key, code_type,
+                                             sub_label_offset + start_index))
+
+        sub_label_offset += len(o_label) + 1
+
+    return location_code_tuples
+
+
+def generate_blacklists(codes: typing.List[str], number_words: int, words_per_code: int,
+                        rand: random.Random) \
+        -> typing.Tuple[typing.Set[str], typing.Dict[str, typing.List[str]]]:
+    """
+    Creates blacklisted words out of two or three codes, so every word covers several codes,
+    and a code to location blacklist for every tenth code
+    """
+    word_blacklist = {''.join(rand.sample(codes, rand.randint(2, 3)))
+                      for _ in range(number_words)}
+
+    code_to_location_blacklist = {}
+    for code in codes[::10]:
+        code_to_location_blacklist[code] = [rand.choice(codes) + rand.choice(codes)
+                                            for _ in range(words_per_code)]
+
+    return word_blacklist, code_to_location_blacklist
+
+
+def generate_overlapping_labels(codes: typing.List[str], word_blacklist: typing.Set[str],
+                                count: int, max_blacklist_words: int,
+                                rand: random.Random) -> typing.List[str]:
+    """Creates labels out of several codes and blacklisted words without separators"""
+    words = sorted(word_blacklist)
+    labels = []
+    for _ in range(count):
+        parts = [rand.choice(codes) for _ in range(rand.randint(2, 5))]
+        parts.extend(rand.choice(words) for _ in range(rand.randint(0, max_blacklist_words)))
+        rand.shuffle(parts)
+        labels.append(''.join(parts))
+    return labels
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser()
+    __create_parser_arguments(parser)
+    args = parser.parse_args()
+
+    rand = random.Random(args.seed)
+    locations = generate_locations(args.number_locations, seed=args.seed)
+    codes = location_codes(locations)
+    word_blacklist, code_to_location_blacklist = generate_blacklists(
+        codes, args.number_blacklist_words, args.words_per_code, rand)
+    labels = generate_overlapping_labels(codes, word_blacklist, args.number_labels,
+                                         args.blacklist_words_per_label, rand)
+
+    trie = create_trie_obj(locations, set(), word_blacklist)
+    code_matcher = CodeMatcher(trie, code_to_location_blacklist)
+
+    linear_scan_time, linear_scan_matches = best_time(
+        lambda: [linear_scan_search(code_matcher, label) for label in labels], args.repetitions)
+    index_time, index_matches = best_time(
+        lambda: [code_matcher.search_with_offsets(label) for label in labels], args.repetitions)
+
+    results = {
+        'commit': current_commit(),
+        'python': platform.python_version(),
+        'parameters': vars(args),
+        'labels': len(labels),
+        'occurrences': sum(len(code_matcher.code_occurrences(label)) for label in labels),
+        'matches': sum(len(matches) for matches in index_matches),
+        'equal_matches': linear_scan_matches == index_matches,
+        'linear_scan_seconds': linear_scan_time,
+        'blacklist_index_seconds': index_time,
+        'speedup': linear_scan_time / index_time if index_time else None,
+    }
+
+    if args.output_file:
+        with open(args.output_file, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
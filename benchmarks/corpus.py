@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Generates reproducible synthetic location tables and rDNS label corpora
+No database is needed. The locations are transient LocationInfo objects.
+"""
+
+import random
+import string
+import typing
+
+from hloc.models import LocationInfo, State
+
+INTERFACE_PREFIXES = ['ae', 'xe', 'ge', 'et', 'te', 'po', 'so', 'be', 'lo']
+ROUTER_ROLES = ['cr', 'br', 'ar', 'er', 'pe', 'core', 'edge', 'bb', 'agg', 'gw']
+NOISE_WORDS = ['static', 'dynamic', 'host', 'pool', 'dsl', 'cable', 'customer', 'mail',
+               'vpn', 'router', 'server', 'client', 'dhcp', 'broadband']
+SYLLABLES = ['ber', 'lin', 'fran', 'furt', 'mun', 'ich', 'ham', 'burg', 'lon', 'don', 'par',
+             'is', 'ams', 'ter', 'dam', 'chi', 'ca', 'go', 'dal', 'las', 'san', 'jo', 'se',
+             'to', 'ky', 'o', 'sea', 'ttle', 'mia', 'mi', 'at', 'lan', 'ta', 'ros', 'ville']
+
+
+def _random_letters(rand: random.Random, length: int) -> str:
+    return ''.join(rand.choice(string.ascii_uppercase) for _ in range(length))
+
+
+def generate_locations(count: int, seed: int=0) -> typing.List[LocationInfo]:
+    """
+    Creates locations with a city name, alternate names, CLLI, LOCODE and airport codes
+    :param count: the number of locations
+    :param seed: the seed of the random generator
+    """
+    rand = random.Random(seed)
+    states = [State(name='state{}'.format(index), iso3166code=_random_letters(rand, 2))
+              for index in range(max(1, count // 100))]
+
+    locations = []
+    for _ in range(count):
+        city_name = ''.join(rand.choice(SYLLABLES)
+                            for _ in range(rand.randint(2, 4))).capitalize()
+        location = LocationInfo(round(rand.uniform(-90, 90), 6), round(rand.uniform(-180, 180), 6),
+                                city_name=city_name)
+        location.state = rand.choice(states)
+
+        if rand.random() < 0.3:
+            location.alternate_names = [city_name + rand.choice(['city', 'town', 'ville'])]
+
+        if rand.random() < 0.5:
+            location.clli = [_random_letters(rand, 4) + location.state.iso3166code]
+
+        if rand.random() < 0.8:
+            location.add_locode_info()
+            location.locode_info.place_codes = [_random_letters(rand, 3)]
+
+        if rand.random() < 0.4:
+            location.add_airport_info()
+            location.airport_info.iata_codes = [_random_letters(rand, 3)]
+            if rand.random() < 0.5:
+                location.airport_info.icao_codes = [_random_letters(rand, 4)]
+            if rand.random() < 0.2:
+                location.airport_info.faa_codes = [_random_letters(rand, 3)]
+
+        locations.append(location)
+
+    return locations
+
+
+def location_codes(locations: typing.List[LocationInfo]) -> typing.List[str]:
+    """Returns all codes of the locations usable for the trie"""
+    return sorted({code for location in locations
+                   for code, _ in location.code_id_type_tuples() if len(code) > 2})
+
+
+def generate_labels(codes: typing.List[str], count: int, seed: int=0,
+                    code_ratio: float=0.6) -> typing.List[str]:
+    """
+    Creates router style domain labels like ae-1-fra01, cr2-deber or static-10-2-3-4
+    :param codes: the location codes which are embedded into the labels
+    :param count: the number of labels
+    :param seed: the seed of the random generator
+    :param code_ratio: the part of the labels containing a location code
+    """
+    rand = random.Random(seed)
+
+    def noise() -> str:
+        choice = rand.random()
+        if choice < 0.3:
+            return '{}-{}-{}-{}-{}'.format(rand.choice(NOISE_WORDS), rand.randint(1, 254),
+                                           rand.randint(0, 255), rand.randint(0, 255),
+                                           rand.randint(1, 254))
+        elif choice < 0.6:
+            return '{}{}'.format(rand.choice(NOISE_WORDS), rand.randint(0, 9999))
+        return ''.join(rand.choice(string.ascii_lowercase + string.digits)
+                       for _ in range(rand.randint(4, 16)))
+
+    labels = []
+    for _ in range(count):
+        if not codes or rand.random() >= code_ratio:
+            labels.append(noise())
+            continue
+
+        code = rand.choice(codes)
+        template = rand.randint(0, 4)
+        if template == 0:
+            label = '{}-{}-{}{:02d}'.format(rand.choice(INTERFACE_PREFIXES), rand.randint(0, 9),
+                                            code, rand.randint(1, 20))
+        elif template == 1:
+            label = '{}{}'.format(code, rand.randint(1, 9))
+        elif template == 2:
+            label = '{}{}-{}'.format(rand.choice(ROUTER_ROLES), rand.randint(1, 4), code)
+        elif template == 3:
+            label = '{}-{}'.format(code, noise())
+        else:
+            label = code
+        labels.append(label)
+
+    return labels
+
+
+__all__ = ['generate_locations',
+           'generate_labels',
+           'location_codes',
+           'NOISE_WORDS',
+           ]
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the trie build and the label matching of find on a synthetic corpus
+Runs without a database. The results are written as JSON to compare them between commits.
+
+python -m benchmarks.find_benchmark -o results.json
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import typing
+
+from benchmarks.corpus import generate_locations, generate_labels, location_codes, NOISE_WORDS
+from hloc.find_helper.code_matcher import CodeMatcher
+from hloc.scripts.find import create_trie_obj, match_labels
+
+
+def __create_parser_arguments(parser: argparse.ArgumentParser):
+    """Creates the arguments for the parser"""
+    parser.add_argument('-nl', '--number-locations', type=int, default=10**4,
+                        help='The number of synthetic locations')
+    parser.add_argument('-nb', '--number-labels', type=int, default=2*10**5,
+                        help='The number of synthetic labels')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='The seed for the corpus generation')
+    parser.add_argument('-b', '--match-block-size', type=int, default=5*10**4,
+                        help='The number of labels matched together')
+    parser.add_argument('-r', '--repetitions', type=int, default=3,
+                        help='The number of repetitions per timing. The fastest is reported')
+    parser.add_argument('-o', '--output-file', type=str,
+                        help='The JSON file for the results. Printed if not set')
+
+
+def current_commit() -> typing.Optional[str]:
+    """Returns the commit hash of the repository or None if it is not available"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def max_rss_bytes() -> int:
+    """Returns the peak resident set size of this process"""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS bytes
+    return max_rss if platform.system() == 'Darwin' else max_rss * 1024
+
+
+def best_time(function: typing.Callable[[], typing.Any], repetitions: int) \
+        -> typing.Tuple[float, typing.Any]:
+    """Returns the fastest run time of the function and its last result"""
+    best = None
+    result = None
+    for _ in range(repetitions):
+        start_time = time.perf_counter()
+        result = function()
+        run_time = time.perf_counter() - start_time
+        if best is None or run_time < best:
+            best = run_time
+    return best, result
+
+
+def benchmark_trie_build(locations, word_blacklist, repetitions: int) \
+        -> typing.Tuple[dict, typing.Any]:
+    """Times create_trie_obj and returns the results and the created trie"""
+    build_time, trie = best_time(lambda: create_trie_obj(locations, set(), word_blacklist),
+                                 repetitions)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        trie_filepath = os.path.join(temp_dir, 'trie.marisa')
+        trie.save(trie_filepath)
+        trie_file_bytes = os.path.getsize(trie_filepath)
+
+    return {'seconds': build_time, 'codes': len(trie), 'file_bytes': trie_file_bytes}, trie
+
+
+def benchmark_matching(code_matcher: CodeMatcher, labels: typing.List[str],
+                       match_block_size: int, repetitions: int) -> dict:
+    """Times match_labels for all labels in blocks of match_block_size labels"""
+    def match_all():
+        return [match_labels(labels[index:index + match_block_size], code_matcher)
+                for index in range(0, len(labels), match_block_size)]
+
+    match_time, match_batches = best_time(match_all, repetitions)
+
+    tracemalloc.start()
+    match_all()
+    _, python_peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    match_checksum = hashlib.md5()
+    match_count = 0
+    for block_index, match_batch in enumerate(match_batches):
+        block_labels = labels[block_index * match_block_size:(block_index + 1) * match_block_size]
+        for match in match_batch.iter_matches(block_labels):
+            match_checksum.update(repr(match).encode())
+        match_count += len(match_batch)
+
+    return {
+        'seconds': match_time,
+        'labels_per_second': len(labels) / match_time if match_time else None,
+        'matches': match_count,
+        'match_checksum': match_checksum.hexdigest(),
+        'python_peak_bytes': python_peak_bytes,
+    }
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser()
+    __create_parser_arguments(parser)
+    args = parser.parse_args()
+
+    corpus_start_time = time.perf_counter()
+    locations = generate_locations(args.number_locations, seed=args.seed)
+    labels = generate_labels(location_codes(locations), args.number_labels, seed=args.seed)
+    corpus_time = time.perf_counter() - corpus_start_time
+
+    word_blacklist = set(NOISE_WORDS[:len(NOISE_WORDS) // 2])
+
+    trie_results, trie = benchmark_trie_build(locations, word_blacklist, args.repetitions)
+
+    matcher_time, code_matcher = best_time(lambda: CodeMatcher(trie), args.repetitions)
+
+    results = {
+        'commit': current_commit(),
+        'python': platform.python_version(),
+        'parameters': vars(args),
+        'corpus': {'seconds': corpus_time, 'locations': len(locations), 'labels': len(labels),
+                   'label_characters': sum(len(label) for label in labels)},
+        'trie_build': trie_results,
+        'matcher_build': {'seconds': matcher_time},
+        'matching': benchmark_matching(code_matcher, labels, args.match_block_size,
+                                       args.repetitions),
+        'max_rss_bytes': max_rss_bytes(),
+    }
+
+    if args.output_file:
+        with open(args.output_file, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Checks that the CodeMatcher of find returns the same matches as the former trie.prefixes() loop
+The former search walked trie.prefixes() for every suffix of every dash separated sub label.
+Both are run on the synthetic router labels of the corpus and on labels with many overlapping
+codes and blacklisted words. The matches have to be equal including their order. The exit
+status is 1 if they differ.
+
+python -m benchmarks.matcher_parity -o results.json
+"""
+
+import argparse
+import json
+import platform
+import random
+import sys
+import typing
+
+import marisa_trie
+
+from benchmarks.blacklist_benchmark import generate_blacklists, generate_overlapping_labels
+from benchmarks.corpus import generate_locations, generate_labels, location_codes
+from benchmarks.find_benchmark import best_time, current_commit
+from hloc.find_helper.code_matcher import CodeMatcher, BLACKLIST_CODE_TYPE
+from hloc.scripts.find import create_trie_obj
+
+
+def __create_parser_arguments(parser: argparse.ArgumentParser):
+    """Creates the arguments for the parser"""
+    parser.add_argument('-nl', '--number-locations', type=int, default=10**4,
+                        help='The number of synthetic locations')
+    parser.add_argument('-nb', '--number-labels', type=int, default=10**5,
+                        help='The number of synthetic router labels')
+    parser.add_argument('-no', '--number-overlapping-labels', type=int, default=2*10**4,
+                        help='The number of labels with overlapping codes and blacklisted words')
+    parser.add_argument('-nw', '--number-blacklist-words', type=int, default=2000,
+                        help='The number of blacklisted words')
+    parser.add_argument('-cw', '--words-per-code', type=int, default=20,
+                        help='The number of code to location blacklist words per code')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='The seed for the corpus generation')
+    parser.add_argument('-r', '--repetitions', type=int, default=1,
+                        help='The number of repetitions per timing. The fastest is reported')
+    parser.add_argument('-o', '--output-file', type=str,
+                        help='The JSON file for the results. Printed if not set')
+
+
+def prefix_loop_search(trie: marisa_trie.RecordTrie,
+                       code_to_location_blacklist: typing.Dict[str, typing.List[str]],
+                       label_name: str) -> typing.List[typing.Tuple[str, str, int]]:
+    """
+    The search of find before the CodeMatcher as reference
+    For every suffix of a sub label all codes which are a prefix of it are checked, the
+    longest first
+    :return: a list of (location_id, code, code_type) tuples like CodeMatcher.search
+    """
+    location_code_tuples = []
+
+    for o_label in label_name.split('-'):
+        label = o_label[:]
+        blacklisted = []
+
+        while label:
+            matching_keys = trie.prefixes(label)
+            matching_keys.sort(key=len, reverse=True)
+
+            for key in matching_keys:
+                if [black_word for black_word in blacklisted if key in black_word]:
+                    continue
+
+                if key in code_to_location_blacklist and \
+                        [black_word for black_word in code_to_location_blacklist[key]
+                         if black_word in o_label]:
+                    continue
+
+                matching_locations = trie[key]
+                if [code_type for _, code_type in matching_locations
+                        if code_type == BLACKLIST_CODE_TYPE]:
+                    blacklisted.append(key)
+                    continue
+
+                for location_id, code_type in matching_locations:
+                    location_code_tuples.append((location_id.decode(), key, code_type))
+
+            label = label[1:]
+
+    return location_code_tuples
+
+
+def compare_matches(code_matcher: CodeMatcher, labels: typing.List[str], repetitions: int) \
+        -> dict:
+    """Runs both searches on the labels and returns the timings and the differing labels"""
+    prefix_loop_time, prefix_loop_matches = best_time(
+        lambda: [prefix_loop_search(code_matcher.trie, code_matcher.code_to_location_blacklist,
+                                    label) for label in labels], repetitions)
+    matcher_time, matcher_matches = best_time(
+        lambda: [code_matcher.search(label) for label in labels], repetitions)
+
+    differing_labels = [label for label, prefix_loop_label_matches, matcher_label_matches
+                        in zip(labels, prefix_loop_matches, matcher_matches)
+                        if prefix_loop_label_matches != matcher_label_matches]
+
+    return {
+        'labels': len(labels),
+        'matches': sum(len(matches) for matches in matcher_matches),
+        'equal_matches': not differing_labels,
+        'differing_labels': differing_labels[:20],
+        'number_differing_labels': len(differing_labels),
+        'prefix_loop_seconds': prefix_loop_time,
+        'code_matcher_seconds': matcher_time,
+        'speedup': prefix_loop_time / matcher_time if matcher_time else None,
+    }
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser()
+    __create_parser_arguments(parser)
+    args = parser.parse_args()
+
+    rand = random.Random(args.seed)
+    locations = generate_locations(args.number_locations, seed=args.seed)
+    codes = location_codes(locations)
+    word_blacklist, code_to_location_blacklist = generate_blacklists(
+        codes, args.number_blacklist_words, args.words_per_code, rand)
+
+    router_labels = generate_labels(codes, args.number_labels, seed=args.seed)
+    overlapping_labels = generate_overlapping_labels(codes, word_blacklist,
+                                                     args.number_overlapping_labels, 6, rand)
+
+    trie = create_trie_obj(locations, set(), word_blacklist)
+    code_matcher = CodeMatcher(trie, code_to_location_blacklist)
+
+    results = {
+        'commit': current_commit(),
+        'python': platform.python_version(),
+        'parameters': vars(args),
+        'router_labels': compare_matches(code_matcher, router_labels, args.repetitions),
+        'overlapping_labels': compare_matches(code_matcher, overlapping_labels,
+                                              args.repetitions),
+    }
+
+    if args.output_file:
+        with open(args.output_file, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if not (results['router_labels']['equal_matches'] and
+            results['overlapping_labels']['equal_matches']):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Distributes id ranges (chunks) on demand to the worker processes of find and validate
+"""
+
+import collections
+import multiprocessing as mp
+import threading
+import typing
+
+Chunk = typing.Tuple[int, int]
+
+
+def read_checkpoint(checkpoint_filepath: str) -> typing.Set[Chunk]:
+    """Returns the finished chunks saved in the checkpoint file"""
+    finished_chunks = set()
+    try:
+        with open(checkpoint_filepath) as checkpoint_file:
+            for line in checkpoint_file:
+                line = line.strip()
+                if line:
+                    chunk_start, chunk_end = line.split(',')
+                    finished_chunks.add((int(chunk_start), int(chunk_end)))
+    except FileNotFoundError:
+        pass
+
+    return finished_chunks
+
+
+class ChunkCoordinator(object):
+    """
+    Hands out [start, end) id chunks to every worker process which asks for work
+    Fast workers simply take more chunks than slow ones. The chunks are aligned to multiples
+    of chunk_size, so a resumed run uses the same chunks as long as the chunk size is the same.
+    Finished chunks are appended to the checkpoint file and are skipped by a resumed run.
+    The coordinator has to be created before the worker processes are started.
+    """
+
+    def __init__(self, start_id: int, end_id: int, chunk_size: int,
+                 checkpoint_filepath: typing.Optional[str]=None, resume: bool=False,
+                 cyclic: bool=False, finished_chunks: typing.Iterable[Chunk]=()):
+        """
+        :param start_id: the smallest id to hand out
+        :param end_id: the id after the largest id to hand out
+        :param chunk_size: the number of ids per chunk
+        :param checkpoint_filepath: the file the finished chunks are saved to
+        :param resume: skip the finished chunks of the checkpoint file. Otherwise the checkpoint
+            file is cleared
+        :param cyclic: start again with the first chunk after the last one was handed out
+        :param finished_chunks: chunks which are skipped in addition to the ones of the
+            checkpoint file
+        """
+        if cyclic and checkpoint_filepath:
+            raise ValueError('a cyclic coordinator can not use a checkpoint file')
+
+        self.first_chunk_start = start_id - start_id % chunk_size
+        self.end_id = end_id
+        self.chunk_size = chunk_size
+        self.checkpoint_filepath = checkpoint_filepath
+        self.cyclic = cyclic
+        self.finished_chunks = set(finished_chunks)
+        self._next_chunk_start = mp.Value('q', self.first_chunk_start)
+        self._checkpoint_lock = mp.Lock()
+
+        if checkpoint_filepath:
+            if resume:
+                self.finished_chunks.update(read_checkpoint(checkpoint_filepath))
+            else:
+                open(checkpoint_filepath, 'w').close()
+
+    def next_chunk(self) -> typing.Optional[Chunk]:
+        """Returns the next unfinished chunk or None if all chunks were handed out"""
+        with self._next_chunk_start.get_lock():
+            while True:
+                chunk_start = self._next_chunk_start.value
+                if chunk_start >= self.end_id:
+                    if not self.cyclic or self.first_chunk_start >= self.end_id:
+                        return None
+                    chunk_start = self.first_chunk_start
+
+                self._next_chunk_start.value = chunk_start + self.chunk_size
+                chunk = (chunk_start, chunk_start + self.chunk_size)
+                if chunk not in self.finished_chunks:
+                    return chunk
+
+    def iter_chunks(self) -> typing.Generator[Chunk, None, None]:
+        """Yields chunks until all chunks were handed out"""
+        while True:
+            chunk = self.next_chunk()
+            if chunk is None:
+                break
+            yield chunk
+
+    def chunk_finished(self, chunk: Chunk):
+        """Saves the chunk as finished in the checkpoint file"""
+        if not self.checkpoint_filepath:
+            return
+
+        with self._checkpoint_lock:
+            with open(self.checkpoint_filepath, 'a') as checkpoint_file:
+                checkpoint_file.write('{},{}\n'.format(*chunk))
+
+
+class CommitMarker(object):
+    """
+    Sent through the queue of a writer after all results of an item (a chunk or an id)
+    The writer acknowledges the marker after its next commit. Then all results sent before the
+    marker are committed and the item can be saved as finished.
+    """
+
+    __slots__ = ['item']
+
+    def __init__(self, item):
+        self.item = item
+
+
+def save_committed_chunks(chunk_coordinator: ChunkCoordinator, acknowledgement_queue: mp.Queue,
+                          nr_writers: int):
+    """
+    Saves a chunk as finished after all nr_writers writers acknowledged its CommitMarker
+    The writers put the chunks of the acknowledged markers on the acknowledgement_queue.
+    Returns if None is received.
+    """
+    acknowledgement_counts = collections.defaultdict(int)
+    while True:
+        chunk = acknowledgement_queue.get()
+        if chunk is None:
+            break
+
+        acknowledgement_counts[chunk] += 1
+        if acknowledgement_counts[chunk] >= nr_writers:
+            del acknowledgement_counts[chunk]
+            chunk_coordinator.chunk_finished(chunk)
+
+
+class ChunkProgress(object):
+    """
+    Tracks the ids of a worker process which are still in work to find its finished chunks
+    Needed if the ids of a chunk are handled by several threads. All methods are thread safe.
+    """
+
+    def __init__(self, chunk_coordinator: ChunkCoordinator):
+        self.chunk_coordinator = chunk_coordinator
+        self._pending_counts = collections.defaultdict(int)
+        self._handed_out_chunks = set()
+        self._lock = threading.Lock()
+
+    def _chunk_for_id(self, item_id: int) -> Chunk:
+        chunk_start = item_id - item_id % self.chunk_coordinator.chunk_size
+        return chunk_start, chunk_start + self.chunk_coordinator.chunk_size
+
+    def started(self, item_id: int):
+        """Marks the id as in work"""
+        with self._lock:
+            self._pending_counts[self._chunk_for_id(item_id)] += 1
+
+    def all_started(self, chunk: Chunk):
+        """Marks that all ids of the chunk were handed out"""
+        with self._lock:
+            self._handed_out_chunks.add(chunk)
+            self._finish_if_done(chunk)
+
+    def done(self, item_id: int):
+        """Marks the id as done"""
+        with self._lock:
+            chunk = self._chunk_for_id(item_id)
+            self._pending_counts[chunk] -= 1
+            self._finish_if_done(chunk)
+
+    def _finish_if_done(self, chunk: Chunk):
+        if chunk in self._handed_out_chunks and not self._pending_counts[chunk]:
+            self._handed_out_chunks.remove(chunk)
+            del self._pending_counts[chunk]
+            self.chunk_coordinator.chunk_finished(chunk)
+
+
+__all__ = ['ChunkCoordinator',
+           'ChunkProgress',
+           'Chunk',
+           'CommitMarker',
+           'read_checkpoint',
+           'save_committed_chunks',
+           ]
@@ -1,3 +1,14 @@
+CREATE INDEX IF NOT EXISTS ix_domain_labels_last_searched ON domain_labels (last_searched);
+CREATE INDEX IF NOT EXISTS ix_location_hint_labels_domain_label_id
+    ON location_hint_labels (domain_label_id);
+CREATE INDEX IF NOT EXISTS ix_domain_to_labels_domain_id ON domain_to_labels (domain_id);
+CREATE INDEX IF NOT EXISTS ix_domain_location_hints_domain_id
+    ON domain_location_hints (domain_id);
+ALTER TABLE location_hints DROP COLUMN IF EXISTS prior_score;
+ALTER TABLE location_hint_labels ADD COLUMN IF NOT EXISTS code_offset smallint,
+    ADD COLUMN IF NOT EXISTS boundary_flags smallint,
+    ADD COLUMN IF NOT EXISTS prior_score float;
+
 
 CREATE OR REPLACE FUNCTION earthRadius() RETURNS numeric
     AS 'SELECT 6371.0'
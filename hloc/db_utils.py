@@ -3,16 +3,24 @@
 A collection of queries connected to the location object
 """
 
+import collections
+import csv
+import io
 import typing
 import datetime
+import hashlib
 import sqlalchemy as sqla
 import sqlalchemy.exc
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.sql.expression import func
 
 
 from hloc.models import State, Probe, Domain, MeasurementResult, DomainLabel, Base, \
-    DomainType, Location, LocationInfo, AirportInfo
+    DomainType, Location, LocationInfo, AirportInfo, LocodeInfo
+
+# the number of IP addresses sent as one array parameter to the database
+IP_QUERY_BATCH_SIZE = 10**4
 
 
 def create_engine(database_name: str, database_user: str='hloc', database_password: str='hloc2017'):
@@ -60,14 +68,20 @@ def state_for_code(state_code, state_name, db_session):
     return state
 
 
-def label_for_name(label_name: str, db_session):
+def label_for_name(label_name: str, db_session, label_id_cache: 'LabelIdCache'=None):
     """
     Checks for an existing label with the same name and returns it.
     If there is no existing a new one is created
     :param label_name: the label text
     :param db_session: a data base session on which the queries are executed
+    :param label_id_cache: if set the id of the label is looked up and inserted with the cache
+        and only the label object is queried
     :return: the DomainLabel object for the label name
     """
+    if label_id_cache is not None:
+        return db_session.query(DomainLabel).get(label_id_cache.id_for_name(label_name,
+                                                                            db_session))
+
     label = db_session.query(DomainLabel).filter(DomainLabel.name == label_name).first()
 
     if not label:
@@ -83,6 +97,171 @@ def label_for_name(label_name: str, db_session):
     return label
 
 
+def label_ids_for_names(label_names: typing.Iterable[str], db_session) -> typing.Dict[str, int]:
+    """
+    Returns the ids of the labels and inserts the missing ones in one statement
+    Concurrent inserts of the same label are resolved by the unique index on the name. The
+    inserted names stay locked in the index until the transaction ends. The names are inserted
+    sorted, so transactions which only execute this one insert lock overlapping labels in the
+    same order and cannot deadlock. Transactions which insert labels several times or write
+    other rows afterwards can deadlock with each other and should commit the labels right away
+    (see the label_session of LabelIdCache).
+    :param label_names: the label texts
+    :param db_session: a data base session on which the queries are executed
+    :return: a dictionary with the id for every label name
+    """
+    label_names = sorted(set(label_names))
+    if not label_names:
+        return {}
+
+    db_session.execute(
+        sqla.text('INSERT INTO domain_labels (name) SELECT unnest(:names) '
+                  'ON CONFLICT (name) DO NOTHING'),
+        {'names': label_names})
+    result = db_session.execute(
+        sqla.text('SELECT name, id FROM domain_labels WHERE name = ANY(:names)'),
+        {'names': label_names})
+    return {name: label_id for name, label_id in result}
+
+
+class LabelIdCache(object):
+    """
+    Maps label names to their ids with a bounded number of entries
+    The least recently used labels are evicted if the cache is full. Missing labels are
+    queried and inserted together with label_ids_for_names. Only the ids are kept, no label
+    objects or domains of the labels.
+    With a label_session the missing labels are inserted in short separate transactions. The
+    unique index locks of new labels are then released immediately instead of being held until
+    the (long) transaction of the domains commits, and a rollback of that transaction only
+    leaves unused labels behind and no cached ids of labels which do not exist.
+    """
+
+    def __init__(self, max_size: int, label_session=None):
+        """
+        :param max_size: the maximum number of cached label ids
+        :param label_session: a data base session used only to query and insert the missing
+            labels. It is committed after every insert. If None the missing labels are
+            inserted in the transaction of the session passed to ids_for_names
+        """
+        self.max_size = max_size
+        self.label_session = label_session
+        self._label_ids = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._label_ids)
+
+    def ids_for_names(self, label_names: typing.Iterable[str], db_session) \
+            -> typing.Dict[str, int]:
+        """
+        Returns the ids of the labels and queries only the ones missing in the cache
+        :param label_names: the label texts
+        :param db_session: a data base session on which the missing labels are queried if the
+            cache has no label_session
+        :return: a dictionary with the id for every label name
+        """
+        label_ids = {}
+        missing_names = set()
+        for label_name in label_names:
+            if label_name in label_ids or label_name in missing_names:
+                continue
+            label_id = self._label_ids.get(label_name)
+            if label_id is None:
+                missing_names.add(label_name)
+            else:
+                self._label_ids.move_to_end(label_name)
+                label_ids[label_name] = label_id
+
+        self.hits += len(label_ids)
+        self.misses += len(missing_names)
+
+        if missing_names:
+            if self.label_session is not None:
+                try:
+                    missing_label_ids = label_ids_for_names(missing_names, self.label_session)
+                    self.label_session.commit()
+                except Exception:
+                    self.label_session.rollback()
+                    raise
+            else:
+                missing_label_ids = label_ids_for_names(missing_names, db_session)
+            label_ids.update(missing_label_ids)
+            self._label_ids.update(missing_label_ids)
+            while len(self._label_ids) > self.max_size:
+                self._label_ids.popitem(last=False)
+
+        return label_ids
+
+    def id_for_name(self, label_name: str, db_session) -> int:
+        """Returns the id of one label and inserts it if it does not exist"""
+        return self.ids_for_names([label_name], db_session)[label_name]
+
+
+def location_table_checksum(db_session) -> str:
+    """
+    Computes a checksum over all tables holding location codes
+    :param db_session: a data base session on which the queries are executed
+    :return: the md5 hexdigest over the content of the location tables
+    """
+    md5 = hashlib.md5()
+    for table in [Location.__table__, AirportInfo.__table__, LocodeInfo.__table__,
+                  State.__table__]:
+        table_checksum = db_session.execute(
+            'SELECT md5(coalesce(string_agg(md5(t::text), \'\' ORDER BY t.id), \'\')) '
+            'FROM {} t'.format(table.name)).scalar()
+        md5.update('{}:{}'.format(table.name, table_checksum).encode())
+    return md5.hexdigest()
+
+
+def reserve_sequence_ids(table: sqla.Table, count: int, db_session) -> typing.List[int]:
+    """
+    Reserves count new ids from the sequence of the id column of the table
+    The ids are unique but not necessarily continuous if other sessions use the sequence
+    :param table: the table whose id sequence is used
+    :param count: the number of ids to reserve
+    :param db_session: a data base session on which the queries are executed
+    :return: the reserved ids
+    """
+    result = db_session.execute(
+        sqla.text('SELECT nextval(pg_get_serial_sequence(:table_name, \'id\')) '
+                  'FROM generate_series(1, :count)'),
+        {'table_name': table.name, 'count': count})
+    return [row[0] for row in result]
+
+
+def sequence_id_generator(table: sqla.Table, db_session, block_size: int=10**4) \
+        -> typing.Generator[int, None, None]:
+    """Yields new ids for the table which are reserved in blocks of block_size"""
+    while True:
+        for new_id in reserve_sequence_ids(table, block_size, db_session):
+            yield new_id
+
+
+def copy_rows(table: sqla.Table, columns: typing.List[str], rows: typing.Iterable[tuple],
+              db_session):
+    """
+    Writes the rows into the table with COPY FROM STDIN in csv format
+    The rows are written in the transaction of the session. None values are written as NULL
+    :param table: the destination table
+    :param columns: the column names in the order of the row values
+    :param rows: the rows to write
+    :param db_session: a data base session on which the queries are executed
+    """
+    copy_buffer = io.StringIO()
+    csv.writer(copy_buffer).writerows(rows)
+    if not copy_buffer.tell():
+        return
+
+    copy_buffer.seek(0)
+    cursor = db_session.connection().connection.cursor()
+    try:
+        cursor.copy_expert('COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+            table.name, ', '.join(columns)), copy_buffer)
+    finally:
+        cursor.close()
+
+
 def location_for_coordinates(lat: float, lon: float, db_session, create_new: bool=True) \
         -> Location:
     location = db_session.query(Location).filter_by(lat=lat, lon=lon).first()
@@ -143,6 +322,25 @@ def domains_for_ids(domain_ids: [int], db_session) -> [Domain]:
     return db_session.query(Domain).filter(Domain.id.in_(domain_ids))
 
 
+def domain_hint_prior_scores(domain_id: int, db_session) -> typing.Dict[str, float]:
+    """
+    Returns the best prior score of the label hints of the domain per location
+    Only the matches of the domain's own labels (location_hint_labels.prior_score) are used.
+    Locations whose matches have no score are not in the dictionary.
+    :param domain_id: the id of the domain
+    :param db_session: a data base session on which the queries are executed
+    :return: a dictionary with the maximal prior score for every location id
+    """
+    result = db_session.execute(
+        sqla.text('SELECT lh.location_id, max(lhl.prior_score) FROM domain_to_labels dtl '
+                  'JOIN location_hint_labels lhl ON lhl.domain_label_id = dtl.domain_label_id '
+                  'JOIN location_hints lh ON lh.id = lhl.location_hint_id '
+                  'WHERE dtl.domain_id = :domain_id AND lhl.prior_score IS NOT NULL '
+                  'GROUP BY lh.location_id'),
+        {'domain_id': domain_id})
+    return {location_id: prior_score for location_id, prior_score in result}
+
+
 def get_measurements_for_domain(domain: Domain,
                                 ip_version: str,
                                 max_measurement_age: typing.Optional[int],
@@ -232,6 +430,24 @@ def get_all_domains_splitted_efficient(index: int, block_limit: int, nr_processe
             break
 
 
+def get_domains_in_id_range(start_id: int, end_id: int, block_limit: int,
+                            domain_types: typing.List[DomainType], db_session,
+                            use_random_order: bool=False) -> typing.Generator[Domain, None, None]:
+    """Yields the domains of the types with an id in [start_id, end_id)"""
+    domains_query = db_session.query(Domain).filter(
+        sqla.and_(
+            Domain.id >= start_id,
+            Domain.id < end_id,
+            Domain.classification_type.in_(domain_types)
+        ))
+
+    if use_random_order:
+        domains_query = domains_query.order_by(func.random())
+
+    for domain in domains_query.yield_per(block_limit):
+        yield domain
+
+
 def get_all_domain_labels(index: int, block_limit: int, nr_processes: int, db_session) -> typing.Generator[DomainLabel, None, None]:
     domain_labels_query = db_session.query(DomainLabel).filter(DomainLabel.id % nr_processes == index)
 
@@ -239,22 +455,156 @@ def get_all_domain_labels(index: int, block_limit: int, nr_processes: int, db_se
         yield domain_label
 
 
+def id_range(model_class, db_session) -> typing.Tuple[int, int]:
+    """
+    Returns the range of the ids of the table of the model class
+    :return: a [start, end) id tuple which is empty if the table is empty
+    """
+    min_id, max_id = db_session.query(sqla.func.min(model_class.id),
+                                      sqla.func.max(model_class.id)).one()
+    if min_id is None:
+        return 0, 0
+
+    return min_id, max_id + 1
+
+
+def stream_domain_labels(start_id: int, end_id: int, block_limit: int, db_session,
+                         searched_before: typing.Optional[datetime.datetime]=None) \
+        -> typing.Generator[typing.Tuple[int, str, datetime.datetime, bool], None, None]:
+    """
+    Streams (id, name, last_searched, has_hints) tuples of the domain labels in [start_id, end_id)
+    The labels are read in pages of block_limit labels ordered by id. Every page starts after
+    the last id of the previous one (keyset pagination) and is read with a server side cursor.
+    No ORM objects are created.
+    :param searched_before: if set only labels never searched or last searched before are
+        returned. The filter is executed by the database using the index on last_searched
+    """
+    where_clause = 'id >= :start_id AND id < :end_id'
+    if searched_before:
+        where_clause += ' AND (last_searched IS NULL OR last_searched < :searched_before)'
+
+    page_query = sqla.text(
+        'SELECT id, name, last_searched, EXISTS ('
+        'SELECT 1 FROM location_hint_labels WHERE domain_label_id = domain_labels.id) '
+        'FROM domain_labels WHERE {} ORDER BY id LIMIT :block_limit'.format(where_clause))
+
+    page_params = {'end_id': end_id, 'block_limit': block_limit}
+    if searched_before:
+        page_params['searched_before'] = searched_before
+
+    connection = db_session.connection(execution_options={'stream_results': True})
+    while start_id < end_id:
+        page_params['start_id'] = start_id
+        result = connection.execute(page_query, page_params)
+        last_id = None
+        for label_id, name, last_searched, has_hints in result:
+            last_id = label_id
+            yield label_id, name, last_searched, has_hints
+
+        if last_id is None:
+            break
+        start_id = last_id + 1
+
+
+def stream_domains(start_id: int, end_id: int, block_limit: int, db_session,
+                   domain_types: typing.List[DomainType]=None) \
+        -> typing.Generator[typing.Tuple[int, str], None, None]:
+    """
+    Streams (id, name) tuples of the domains in [start_id, end_id) like stream_domain_labels
+    :param domain_types: the classification types of the returned domains (default valid)
+    """
+    page_query = sqla.text(
+        'SELECT id, name FROM domains WHERE id >= :start_id AND id < :end_id '
+        'AND classification_type::text IN :domain_types ORDER BY id LIMIT :block_limit'
+    ).bindparams(sqla.bindparam('domain_types', expanding=True))
+
+    page_params = {'end_id': end_id, 'block_limit': block_limit,
+                   'domain_types': [domain_type.name
+                                    for domain_type in domain_types or [DomainType.valid]]}
+
+    connection = db_session.connection(execution_options={'stream_results': True})
+    while start_id < end_id:
+        page_params['start_id'] = start_id
+        last_id = None
+        for domain_id, domain_name in connection.execute(page_query, page_params):
+            last_id = domain_id
+            yield domain_id, domain_name
+
+        if last_id is None:
+            break
+        start_id = last_id + 1
+
+
+def stream_domain_ips(start_id: int, end_id: int, block_limit: int, db_session,
+                      domain_types: typing.List[DomainType]=None) \
+        -> typing.Generator[typing.Tuple[int, typing.Optional[str], typing.Optional[str]],
+                            None, None]:
+    """
+    Streams (id, ipv4_address, ipv6_address) tuples of the domains in [start_id, end_id) like
+    stream_domains. The addresses are returned as strings without prefix length
+    :param domain_types: the classification types of the returned domains (default valid)
+    """
+    page_query = sqla.text(
+        'SELECT id, host(ipv4_address), host(ipv6_address) FROM domains '
+        'WHERE id >= :start_id AND id < :end_id '
+        'AND classification_type::text IN :domain_types ORDER BY id LIMIT :block_limit'
+    ).bindparams(sqla.bindparam('domain_types', expanding=True))
+
+    page_params = {'end_id': end_id, 'block_limit': block_limit,
+                   'domain_types': [domain_type.name
+                                    for domain_type in domain_types or [DomainType.valid]]}
+
+    connection = db_session.connection(execution_options={'stream_results': True})
+    while start_id < end_id:
+        page_params['start_id'] = start_id
+        last_id = None
+        for domain_id, ipv4_address, ipv6_address in connection.execute(page_query,
+                                                                        page_params):
+            last_id = domain_id
+            yield domain_id, ipv4_address, ipv6_address
+
+        if last_id is None:
+            break
+        start_id = last_id + 1
+
+
 def get_domains_for_ips(ip_filter_list: typing.List[str], db_session, block_limit: int,
                         use_random_order: bool=False, endless_mode: bool=False) \
         -> typing.Generator[Domain, None, None]:
-    domains_query = db_session.query(Domain).filter(
-        sqla.or_(
-            Domain.ipv4_address.in_(ip_filter_list),
-            Domain.ipv6_address.in_(ip_filter_list)
-        )
-    )
+    """
+    Yields the domains with an IPv4 or IPv6 address of the list
+    The addresses are sent in batches of IP_QUERY_BATCH_SIZE as one array parameter which is
+    joined with the indexed address columns (unnest(CAST(:ips AS inet[]))). IPv4 and IPv6
+    addresses are queried separately so every query uses the index of one column.
+    :param ip_filter_list: the IP addresses (no prefixes)
+    """
+    ipv4_addresses = [ip_address for ip_address in ip_filter_list if ':' not in ip_address]
+    ipv6_addresses = [ip_address for ip_address in ip_filter_list if ':' in ip_address]
 
-    if use_random_order:
-        domains_query.order_by(func.random())
+    def batch_queries():
+        for address_column, addresses in [(Domain.ipv4_address, ipv4_addresses),
+                                          (Domain.ipv6_address, ipv6_addresses)]:
+            for batch_start in range(0, len(addresses), IP_QUERY_BATCH_SIZE):
+                ips_table = func.unnest(sqla.cast(
+                    sqla.literal(addresses[batch_start:batch_start + IP_QUERY_BATCH_SIZE],
+                                 postgresql.ARRAY(sqla.Text)),
+                    postgresql.ARRAY(postgresql.INET))).table_valued('ip')
+                domains_query = db_session.query(Domain).join(
+                    ips_table, address_column == ips_table.c.ip)
+
+                if use_random_order:
+                    domains_query = domains_query.order_by(func.random())
+
+                yield domains_query
 
     while True:
-        for domain in domains_query.yield_per(block_limit):
-            yield domain
+        # a domain with both addresses in the list is only returned once
+        domain_ids = set()
+        for domains_query in batch_queries():
+            for domain in domains_query.yield_per(block_limit):
+                if domain.id not in domain_ids:
+                    domain_ids.add(domain.id)
+                    yield domain
 
         if not endless_mode:
             break
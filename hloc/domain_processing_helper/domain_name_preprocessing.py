@@ -11,7 +11,11 @@ import re
 import socket
 import string
 
+from hloc.domain_processing_helper.ip_encoding import IpEncodingClassifier
+from hloc.ip_set import IpSet, load_ip_set
+
 ACCEPTED_CHARACTER = frozenset('{0}.-_'.format(string.printable[0:62]))
+INVALID_CHARACTER_REGEX = re.compile('[^{}]'.format(re.escape(''.join(sorted(ACCEPTED_CHARACTER)))))
 
 
 @enum.unique
@@ -63,10 +67,7 @@ def main():
 
     white_list = None
     if args.white_list_file_path:
-        white_list = set()
-        with open(args.white_list_file_path) as filter_list_file:
-            for line in filter_list_file:
-                white_list.add(line.strip())
+        white_list = load_ip_set(args.white_list_file_path)
 
     regex_strategy = RegexStrategy(value=args.regex_strategy)
 
@@ -122,9 +123,10 @@ def preprocess_domains(ip_domain_tuples: [(str, str)], tlds: {str}, white_list:
                        regex_strategy: RegexStrategy = RegexStrategy.abstract,
                        ip_encoding_filter: bool = True):
     """
-    Sanitize filepart from start to end
-    pnr is a number to recognize the process
-    ipregex should be a regex with 4 integers to filter the Isp client domain names
+    Classifies a block of (ip, domain) tuples
+    The IP encodings of all lines with valid characters and whitelisted IPs are checked
+    together with an IpEncodingClassifier
+    :param white_list: an IpSet or a set of IP strings. Lines with other IPs are filtered
     """
 
     bad_characters = collections.defaultdict(int)
@@ -134,24 +136,34 @@ def preprocess_domains(ip_domain_tuples: [(str, str)], tlds: {str}, white_list:
     ip_encoded_lines = []
     custom_filter_lines = []
 
-    ipregex_text = __select_ip_regex(regex_strategy)
-    ipregex = re.compile(ipregex_text, flags=re.MULTILINE)
     is_ipv6 = ip_version == 'ipv6'
 
-    for ip_address, domain in ip_domain_tuples:
-
-        if set(domain).difference(ACCEPTED_CHARACTER):
+    whitelisted = None
+    if isinstance(white_list, IpSet):
+        whitelisted = white_list.contains_many(
+            [ip_address for ip_address, _ in ip_domain_tuples]).tolist()
+    elif white_list is not None:
+        whitelisted = [ip_address in white_list for ip_address, _ in ip_domain_tuples]
+
+    encoding_check_indexes = []
+    if ip_encoding_filter:
+        encoding_check_indexes = [
+            index for index, (ip_address, domain) in enumerate(ip_domain_tuples)
+            if not INVALID_CHARACTER_REGEX.search(domain) and
+            (whitelisted is None or whitelisted[index])]
+    ip_encoded_flags = dict(zip(encoding_check_indexes,
+                                IpEncodingClassifier(regex_strategy).ip_encoded_flags(
+                                    [ip_domain_tuples[index] for index in encoding_check_indexes],
+                                    ip_version)))
+
+    for index, (ip_address, domain) in enumerate(ip_domain_tuples):
+
+        if INVALID_CHARACTER_REGEX.search(domain):
             bad_lines.append((ip_address, domain))
         else:
-            if white_list is not None and ip_address not in white_list:
+            if whitelisted is not None and not whitelisted[index]:
                 custom_filter_lines.append((ip_address, domain))
-            elif not is_ipv6 and ip_encoding_filter and __has_ip_encoded(ip_address, domain,
-                                                                         ipregex):
-                ip_encoded_lines.append((ip_address, domain))
-            elif not is_ipv6 and ip_encoding_filter and \
-                    is_ip_hex_encoded(ip_address, domain):
-                ip_encoded_lines.append((ip_address, domain))
-            elif ip_encoding_filter and has_ip_alphanumeric_encoded(ip_address, domain, ip_version):
+            elif ip_encoding_filter and ip_encoded_flags[index]:
                 ip_encoded_lines.append((ip_address, domain))
             elif is_ipv6 and ip_encoding_filter and is_ipv6_address_encoded(ip_address, domain):
                 ip_encoded_lines.append((ip_address, domain))
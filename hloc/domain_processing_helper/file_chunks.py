@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+Splits rDNS files into newline aligned byte chunks which worker processes read on their own
+Plain files are split with mmap at any newline. Compressed files (gzip, bz2, xz) can only be
+split between compression members (e.g. files written by bgzip or pbzip2 or concatenated
+compressed parts). Their chunks are found with one decompression pass and saved in an index
+file next to the input file. A file with a single member is one chunk, so chunks are always
+read as a stream of line blocks and never decompressed into memory as a whole.
+"""
+
+import bz2
+import codecs
+import collections
+import glob
+import gzip
+import json
+import lzma
+import mmap
+import os
+import typing
+import zlib
+
+# a file chunk is described by (byte offset, byte length)
+FileChunk = typing.Tuple[int, int]
+
+GZIP_COMPRESSION = 'gzip'
+BZ2_COMPRESSION = 'bz2'
+XZ_COMPRESSION = 'xz'
+COMPRESSION_FILE_ENDINGS = {
+    '.gz': GZIP_COMPRESSION,
+    '.bz2': BZ2_COMPRESSION,
+    '.xz': XZ_COMPRESSION,
+}
+CHUNK_INDEX_FILE_ENDING = '.chunks.json'
+# the statistics files ipdns_parser wrote next to the input files in former versions
+STATS_FILE_ENDING = '.stats'
+READ_SIZE = 2**20
+
+
+def input_filepaths(patterns: typing.Iterable[str]) -> typing.List[str]:
+    """
+    Expands files, directories and glob patterns into a list of absolute file paths
+    Directories are expanded to the files directly in them without hidden, chunk index and
+    statistics files.
+    Every file is returned only once in the order of the patterns.
+    """
+    filepaths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = [os.path.join(pattern, filename) for filename in os.listdir(pattern)
+                       if not filename.startswith('.') and
+                       not filename.endswith(STATS_FILE_ENDING)]
+        elif os.path.exists(pattern):
+            matches = [pattern]
+        else:
+            matches = glob.glob(pattern)
+
+        filepaths.extend(sorted(os.path.abspath(filepath) for filepath in matches
+                                if os.path.isfile(filepath) and
+                                not filepath.endswith(CHUNK_INDEX_FILE_ENDING)))
+
+    return list(collections.OrderedDict.fromkeys(filepaths))
+
+
+def compression_for_path(filepath: str) -> typing.Optional[str]:
+    """Returns the compression of the file derived from its file ending"""
+    return COMPRESSION_FILE_ENDINGS.get(os.path.splitext(filepath)[1].lower())
+
+
+def new_decompressor(compression: str):
+    """Returns a decompressor object for one member of the compression"""
+    if compression == GZIP_COMPRESSION:
+        return zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    elif compression == BZ2_COMPRESSION:
+        return bz2.BZ2Decompressor()
+    elif compression == XZ_COMPRESSION:
+        return lzma.LZMADecompressor()
+    else:
+        raise ValueError('{} is not a supported compression'.format(compression))
+
+
+def iter_decompressed_members(input_file: typing.BinaryIO, chunk: FileChunk,
+                              compression: str) -> typing.Generator[bytes, None, None]:
+    """
+    Yields the decompressed data of a chunk consisting of one or more complete members
+    The chunk is read in pieces of READ_SIZE compressed bytes.
+    """
+    offset, remaining = chunk
+    input_file.seek(offset)
+    decompressor = new_decompressor(compression)
+    inside_member = False
+    data = b''
+    while data or remaining:
+        if not data:
+            data = input_file.read(min(READ_SIZE, remaining))
+            if not data:
+                raise ValueError('the file ends inside the chunk')
+            remaining -= len(data)
+
+        decompressed = decompressor.decompress(data)
+        if decompressed:
+            yield decompressed
+
+        if decompressor.eof:
+            data = decompressor.unused_data
+            decompressor = new_decompressor(compression)
+            inside_member = False
+        else:
+            data = b''
+            inside_member = True
+
+    if inside_member:
+        raise ValueError('the chunk ends inside a compression member')
+
+
+def plain_file_chunks(filepath: str, chunk_size: int) -> typing.List[FileChunk]:
+    """Splits the plain file into chunks of about chunk_size bytes ending with a newline"""
+    file_size = os.path.getsize(filepath)
+    if not file_size:
+        return []
+
+    chunks = []
+    with open(filepath, 'rb') as input_file, \
+            mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ) as input_mmap:
+        chunk_start = 0
+        while chunk_start < file_size:
+            chunk_end = chunk_start + chunk_size
+            if chunk_end < file_size:
+                newline_index = input_mmap.find(b'\n', chunk_end - 1)
+                chunk_end = file_size if newline_index < 0 else newline_index + 1
+            else:
+                chunk_end = file_size
+
+            chunks.append((chunk_start, chunk_end - chunk_start))
+            chunk_start = chunk_end
+
+    return chunks
+
+
+def compressed_file_chunks(filepath: str, compression: str, chunk_size: int) \
+        -> typing.List[FileChunk]:
+    """
+    Splits the compressed file between its members into chunks of about chunk_size compressed
+    bytes. A chunk only ends after a member whose decompressed data ends with a newline.
+    A file with only one member results in one chunk.
+    """
+    chunks = []
+    chunk_start = 0
+    # the offset of the start of the current member in the file
+    member_start = 0
+    consumed = 0
+    decompressor = new_decompressor(compression)
+    ends_with_newline = True
+
+    with open(filepath, 'rb') as input_file:
+        data = input_file.read(READ_SIZE)
+        while data:
+            decompressed = decompressor.decompress(data)
+            if decompressed:
+                ends_with_newline = decompressed.endswith(b'\n')
+
+            if decompressor.eof:
+                unused_data = decompressor.unused_data
+                member_end = consumed + len(data) - len(unused_data)
+                if ends_with_newline and member_end - chunk_start >= chunk_size:
+                    chunks.append((chunk_start, member_end - chunk_start))
+                    chunk_start = member_end
+
+                member_start = member_end
+                consumed = member_end
+                decompressor = new_decompressor(compression)
+                data = unused_data or input_file.read(READ_SIZE)
+            else:
+                consumed += len(data)
+                data = input_file.read(READ_SIZE)
+
+        if consumed > member_start:
+            raise ValueError('{} ends inside a compression member'.format(filepath))
+
+    if consumed > chunk_start:
+        chunks.append((chunk_start, consumed - chunk_start))
+
+    return chunks
+
+
+def _index_key(filepath: str, chunk_size: int) -> dict:
+    file_stat = os.stat(filepath)
+    return {'size': file_stat.st_size, 'mtime': file_stat.st_mtime, 'chunk_size': chunk_size}
+
+
+def file_chunks(filepath: str, chunk_size: int, use_index_file: bool=True) \
+        -> typing.List[FileChunk]:
+    """
+    Returns the chunks of the file
+    The chunks of a compressed file are read from its index file if it belongs to the same file
+    version and chunk size. Otherwise the chunks are computed and the index file is written.
+    :param filepath: the path to the plain or compressed rDNS file
+    :param chunk_size: the wanted size of a chunk in bytes of the (compressed) file
+    :param use_index_file: read and write the index file of compressed files
+    """
+    compression = compression_for_path(filepath)
+    if compression is None:
+        return plain_file_chunks(filepath, chunk_size)
+
+    index_filepath = filepath + CHUNK_INDEX_FILE_ENDING
+    index_key = _index_key(filepath, chunk_size)
+    if use_index_file:
+        try:
+            with open(index_filepath) as index_file:
+                index = json.load(index_file)
+            if index['key'] == index_key:
+                return [tuple(chunk) for chunk in index['chunks']]
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+    chunks = compressed_file_chunks(filepath, compression, chunk_size)
+
+    if use_index_file:
+        with open(index_filepath, 'w') as index_file:
+            json.dump({'key': index_key, 'chunks': chunks}, index_file)
+
+    return chunks
+
+
+def iter_file_lines(filepath: str, encoding: str='ISO-8859-1') \
+        -> typing.Generator[str, None, None]:
+    """Yields the lines of the whole plain or compressed file without the line endings"""
+    compression = compression_for_path(filepath)
+    if compression == GZIP_COMPRESSION:
+        open_function = gzip.open
+    elif compression == BZ2_COMPRESSION:
+        open_function = bz2.open
+    elif compression == XZ_COMPRESSION:
+        open_function = lzma.open
+    else:
+        open_function = open
+
+    with open_function(filepath, 'rt', encoding=encoding, newline='\n') as input_file:
+        for line in input_file:
+            yield line.rstrip('\n')
+
+
+class FileChunkReader(object):
+    """Reads the lines of file chunks. Every worker process uses its own reader"""
+
+    def __init__(self, filepath: str, encoding: str='ISO-8859-1'):
+        self.filepath = filepath
+        self.encoding = encoding
+        self.compression = compression_for_path(filepath)
+        self._file = open(filepath, 'rb')
+        self._mmap = None
+        if self.compression is None and os.path.getsize(filepath):
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def iter_bytes(self, chunk: FileChunk) -> typing.Generator[bytes, None, None]:
+        """Yields the (decompressed) content of the chunk in parts"""
+        offset, length = chunk
+        if self.compression is not None:
+            yield from iter_decompressed_members(self._file, chunk, self.compression)
+        elif self._mmap is not None:
+            for part_start in range(offset, offset + length, READ_SIZE):
+                yield self._mmap[part_start:min(part_start + READ_SIZE, offset + length)]
+
+    def iter_line_blocks(self, chunk: FileChunk, block_size: int) \
+            -> typing.Generator[typing.List[str], None, None]:
+        """
+        Yields the lines of the chunk without the line endings in lists of block_size lines
+        Only one block and one decompressed part of the chunk are held in memory.
+        """
+        decoder = codecs.getincrementaldecoder(self.encoding)()
+        block = []
+        line_start = ''
+        for data in self.iter_bytes(chunk):
+            lines = decoder.decode(data).split('\n')
+            lines[0] = line_start + lines[0]
+            line_start = lines.pop()
+            block.extend(lines)
+            while len(block) >= block_size:
+                yield block[:block_size]
+                block = block[block_size:]
+
+        line_start += decoder.decode(b'', final=True)
+        if line_start:
+            block.append(line_start)
+        while block:
+            yield block[:block_size]
+            block = block[block_size:]
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+
+
+__all__ = ['FileChunk',
+           'FileChunkReader',
+           'file_chunks',
+           'input_filepaths',
+           'iter_file_lines',
+           'plain_file_chunks',
+           'compressed_file_chunks',
+           'compression_for_path',
+           'iter_decompressed_members',
+           ]
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Checks if the IP address of a domain is encoded in the domain name without regular expressions
+The decimal octets are searched with str.find which needs linear time in the length of the
+domain name. The hex and base 36 encodings of the remaining IPv4 addresses of a block are
+computed with array operations. The results are the same as the checks with the regular
+expressions of domain_name_preprocessing.
+"""
+
+import ipaddress
+import re
+import typing
+
+import numpy as np
+
+BASE36_CHARACTERS = '0123456789abcdefghijklmnopqrstuvwxyz'
+HEX_CHARACTERS = '0123456789ABCDEF'
+# an IPv4 address of 32 bits has at most 7 base 36 digits
+IPV4_BASE36_DIGITS = 7
+DECIMAL_DIGITS = frozenset('0123456789')
+# addresses whose octets are at most 255 and have no leading zeros
+CANONICAL_IPV4_REGEX = re.compile(r'(?:(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\.){3}'
+                                  r'(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])')
+OCTET_DELIMITERS = frozenset('.-_')
+# the number of leading zeros allowed before an octet with the strict strategy
+MAX_OCTET_ZERO_PADDING = 2
+
+
+def int_to_base36(number: int) -> str:
+    """Returns the lowercase base 36 representation of the number"""
+    if number == 0:
+        return '0'
+
+    digits = []
+    while number:
+        number, rest = divmod(number, 36)
+        digits.append(BASE36_CHARACTERS[rest])
+    return ''.join(reversed(digits))
+
+
+def _digit_strings(digit_matrix: np.ndarray, characters: str) -> typing.List[str]:
+    """Converts a matrix of digit values (one number per row) into strings"""
+    character_table = np.frombuffer(characters.encode(), dtype=np.uint8)
+    character_matrix = np.ascontiguousarray(character_table[digit_matrix])
+    return [digits.decode() for digits in
+            character_matrix.view('S{}'.format(digit_matrix.shape[1])).ravel().tolist()]
+
+
+def ipv4_hex_and_base36(ip_addresses: typing.List[str]) \
+        -> typing.Tuple[typing.List[str], typing.List[str]]:
+    """
+    Computes the upper case hex and the base 36 encodings of canonical IPv4 addresses with
+    array operations for the whole list
+    """
+    octet_values = np.array('.'.join(ip_addresses).split('.'), dtype=np.int64).reshape(-1, 4)
+    ip_values = (octet_values[:, 0] << 24) | (octet_values[:, 1] << 16) | \
+        (octet_values[:, 2] << 8) | octet_values[:, 3]
+
+    hex_digits = np.stack([(ip_values >> shift) & 0xF for shift in range(28, -1, -4)], axis=1)
+
+    base36_digits = np.empty((len(ip_values), IPV4_BASE36_DIGITS), dtype=np.int64)
+    remaining_values = ip_values.copy()
+    for digit_index in range(IPV4_BASE36_DIGITS - 1, -1, -1):
+        remaining_values, base36_digits[:, digit_index] = np.divmod(remaining_values, 36)
+
+    base36_encodings = [digits.lstrip('0') or '0'
+                        for digits in _digit_strings(base36_digits, BASE36_CHARACTERS)]
+    return _digit_strings(hex_digits, HEX_CHARACTERS), base36_encodings
+
+
+def contains_octets_in_order(domain: str, octets: typing.List[str], min_gap: int=0) -> bool:
+    """
+    Checks if the octets occur in this order in the domain with at least min_gap characters
+    between two octets
+    Taking always the first occurrence after the previous octet is optimal.
+    """
+    position = domain.find(octets[0])
+    if position < 0:
+        return False
+
+    for previous_octet, octet in zip(octets, octets[1:]):
+        position = domain.find(octet, position + len(previous_octet) + min_gap)
+        if position < 0:
+            return False
+    return True
+
+
+def _delimited_octets_at(domain: str, position: int, octets: typing.List[str]) -> bool:
+    """Checks if the remaining octets follow at position each after a delimiter and zeros"""
+    if not octets:
+        return True
+
+    if position >= len(domain) or domain[position] not in OCTET_DELIMITERS:
+        return False
+    position += 1
+
+    for zero_count in range(0, MAX_OCTET_ZERO_PADDING + 1):
+        if zero_count and domain[position + zero_count - 1:position + zero_count] != '0':
+            break
+        if domain.startswith(octets[0], position + zero_count) and \
+                _delimited_octets_at(domain, position + zero_count + len(octets[0]),
+                                     octets[1:]):
+            return True
+    return False
+
+
+def contains_delimited_octets(domain: str, octets: typing.List[str]) -> bool:
+    """
+    Checks if the octets occur directly after each other in the domain separated by one
+    delimiter and up to two leading zeros
+    """
+    position = domain.find(octets[0])
+    while position >= 0:
+        if _delimited_octets_at(domain, position + len(octets[0]), octets[1:]):
+            return True
+        position = domain.find(octets[0], position + 1)
+    return False
+
+
+class IpEncodingClassifier(object):
+    """
+    Classifies blocks of domain names as IP encoded
+    The encodings are checked in the same order as preprocess_domains did with the regexes:
+    the decimal octets and the hex encoding for IPv4 and the base 36 encoding for both IP
+    versions. The hex and base 36 encodings are only computed for the domains which do not
+    contain the octets.
+    """
+
+    def __init__(self, regex_strategy):
+        """
+        :param regex_strategy: the RegexStrategy defining how the octets have to be separated
+        """
+        self.regex_strategy = regex_strategy
+
+    def has_octets_encoded(self, ip_address: str, domain: str) -> bool:
+        """Checks if the domain contains the decimal octets like the regex of the strategy"""
+        octets = ip_address.split('.')
+        if len(octets) != 4 or not all(0 < len(octet) <= 3 and DECIMAL_DIGITS.issuperset(octet)
+                                       for octet in octets):
+            return False
+
+        strategy = self.regex_strategy.value
+        if strategy == 'abstract':
+            return contains_octets_in_order(domain, octets) or \
+                contains_octets_in_order(domain, octets[::-1])
+        elif strategy == 'moderate':
+            return contains_octets_in_order(domain, octets, min_gap=1) or \
+                contains_octets_in_order(domain, octets[::-1], min_gap=1)
+        else:
+            return contains_delimited_octets(domain, octets) or \
+                contains_delimited_octets(domain, octets[::-1])
+
+    def ip_encoded_flags(self, ip_domain_tuples: typing.List[typing.Tuple[str, str]],
+                         ip_version: str) -> typing.List[bool]:
+        """
+        Classifies a block of (ip, domain) tuples of one IP version
+        :returns for every tuple if the IP address is encoded in the domain
+        """
+        is_ipv6 = ip_version == 'ipv6'
+        ip_encoded = [False] * len(ip_domain_tuples)
+
+        canonical_indexes = []
+        for index, (ip_address, domain) in enumerate(ip_domain_tuples):
+            if is_ipv6:
+                ip_encoded[index] = self._has_encoding(ip_address, domain, is_ipv6)
+            elif self.has_octets_encoded(ip_address, domain):
+                ip_encoded[index] = True
+            elif CANONICAL_IPV4_REGEX.fullmatch(ip_address):
+                canonical_indexes.append(index)
+            else:
+                ip_encoded[index] = self._has_encoding(ip_address, domain, is_ipv6)
+
+        if canonical_indexes:
+            hex_encodings, base36_encodings = ipv4_hex_and_base36(
+                [ip_domain_tuples[index][0] for index in canonical_indexes])
+            for index, hex_encoding, base36_encoding in zip(canonical_indexes, hex_encodings,
+                                                            base36_encodings):
+                domain = ip_domain_tuples[index][1]
+                ip_encoded[index] = hex_encoding in domain.upper() or base36_encoding in domain
+
+        return ip_encoded
+
+    @staticmethod
+    def _has_encoding(ip_address: str, domain: str, is_ipv6: bool) -> bool:
+        """Checks the hex and base 36 encodings of an IPv6 or a not canonical IPv4 address"""
+        if not is_ipv6:
+            octets = ip_address.split('.')
+            if len(octets) == 4 and all(DECIMAL_DIGITS.issuperset(octet) and octet
+                                        for octet in octets) and \
+                    '{:02X}{:02X}{:02X}{:02X}'.format(*[int(octet) for octet in octets]) in \
+                    domain.upper():
+                return True
+
+        return int_to_base36(int(ipaddress.ip_address(ip_address))) in domain
+
+
+__all__ = ['IpEncodingClassifier',
+           'contains_octets_in_order',
+           'contains_delimited_octets',
+           'int_to_base36',
+           'ipv4_hex_and_base36',
+           ]
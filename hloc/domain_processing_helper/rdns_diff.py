@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Computes the differences between two rDNS snapshots in bounded memory
+Both snapshots are given as 'ip,name' pair lines. Every side is sorted with an external merge
+sort: sorted runs of at most run_size lines are written to temporary files and merged
+afterwards. The two sorted streams are then merged and the differences are grouped per IP.
+All lines of one IP are next to each other in the sorted order because they share the prefix
+'ip,'.
+"""
+
+import heapq
+import itertools
+import os
+import tempfile
+import typing
+
+# the differences of one IP: (ip, removed names, added names)
+IpDiff = typing.Tuple[str, typing.List[str], typing.List[str]]
+
+
+def pair_line(ip_address: str, domain: str) -> str:
+    """Returns the line representing the (ip, domain) pair"""
+    return '{},{}'.format(ip_address, domain)
+
+
+def split_pair_line(line: str) -> typing.Tuple[str, str]:
+    """Returns the (ip, domain) pair of the line"""
+    ip_address, _, domain = line.partition(',')
+    return ip_address, domain
+
+
+class ExternalSorter(object):
+    """
+    Sorts lines which do not fit into memory
+    At most run_size lines are held in memory. Full runs are sorted and written to temporary
+    files which are removed with close.
+    """
+
+    def __init__(self, run_size: int=10**6, directory: typing.Optional[str]=None,
+                 encoding: str='utf-8'):
+        """
+        :param run_size: the maximum number of lines sorted in memory
+        :param directory: the directory for the temporary run files. Defaults to the system
+            temp directory
+        :param encoding: the encoding of the run files
+        """
+        self.run_size = run_size
+        self.directory = directory
+        self.encoding = encoding
+        self._lines = []
+        self._run_filepaths = []
+
+    def add(self, line: str):
+        self._lines.append(line)
+        if len(self._lines) >= self.run_size:
+            self._write_run()
+
+    def extend(self, lines: typing.Iterable[str]):
+        for line in lines:
+            self.add(line)
+
+    def _write_run(self):
+        self._lines.sort()
+        run_file_descriptor, run_filepath = tempfile.mkstemp(prefix='rdns-run-', suffix='.txt',
+                                                             dir=self.directory)
+        self._run_filepaths.append(run_filepath)
+        with open(run_file_descriptor, 'w', encoding=self.encoding, newline='\n') as run_file:
+            for line in self._lines:
+                run_file.write(line)
+                run_file.write('\n')
+        self._lines = []
+
+    def sorted_lines(self) -> typing.Generator[str, None, None]:
+        """Yields all added lines sorted and without duplicates"""
+        if not self._run_filepaths:
+            line_iterators = [sorted(self._lines)]
+        else:
+            if self._lines:
+                self._write_run()
+            run_files = [open(run_filepath, encoding=self.encoding, newline='\n')
+                         for run_filepath in self._run_filepaths]
+            line_iterators = [(line[:-1] for line in run_file) for run_file in run_files]
+
+        try:
+            previous_line = None
+            for line in heapq.merge(*line_iterators):
+                if line != previous_line:
+                    yield line
+                    previous_line = line
+        finally:
+            if self._run_filepaths:
+                for run_file in run_files:
+                    run_file.close()
+
+    def close(self):
+        """Removes the run files"""
+        for run_filepath in self._run_filepaths:
+            try:
+                os.remove(run_filepath)
+            except FileNotFoundError:
+                pass
+        self._run_filepaths = []
+        self._lines = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def diff_sorted_lines(old_lines: typing.Iterable[str], new_lines: typing.Iterable[str]) \
+        -> typing.Generator[typing.Tuple[bool, str], None, None]:
+    """
+    Merges two sorted streams of unique lines
+    :returns (added, line) for every line only contained in one of the streams. added is False
+        for lines only in old_lines
+    """
+    old_iterator = iter(old_lines)
+    new_iterator = iter(new_lines)
+    old_line = next(old_iterator, None)
+    new_line = next(new_iterator, None)
+
+    while old_line is not None and new_line is not None:
+        if old_line == new_line:
+            old_line = next(old_iterator, None)
+            new_line = next(new_iterator, None)
+        elif old_line < new_line:
+            yield False, old_line
+            old_line = next(old_iterator, None)
+        else:
+            yield True, new_line
+            new_line = next(new_iterator, None)
+
+    while old_line is not None:
+        yield False, old_line
+        old_line = next(old_iterator, None)
+
+    while new_line is not None:
+        yield True, new_line
+        new_line = next(new_iterator, None)
+
+
+def diff_by_ip(old_lines: typing.Iterable[str], new_lines: typing.Iterable[str]) \
+        -> typing.Generator[IpDiff, None, None]:
+    """
+    Groups the differences of two sorted streams of unique pair lines per IP
+    An IP with removed and added names had its names changed.
+    """
+    line_diffs = ((added,) + split_pair_line(line)
+                  for added, line in diff_sorted_lines(old_lines, new_lines))
+    for ip_address, ip_diffs in itertools.groupby(line_diffs, key=lambda diff: diff[1]):
+        removed_names = []
+        added_names = []
+        for added, _, domain in ip_diffs:
+            if added:
+                added_names.append(domain)
+            else:
+                removed_names.append(domain)
+        yield ip_address, removed_names, added_names
+
+
+__all__ = ['ExternalSorter',
+           'IpDiff',
+           'diff_sorted_lines',
+           'diff_by_ip',
+           'pair_line',
+           'split_pair_line',
+           ]
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Records which entries of a whitelist occur in the rDNS files across processes
+Only the whitelist entries are tracked, so the memory depends on the size of the whitelist and
+not on the number of parsed IPs. Every entry (address or merged prefix) of the whitelist IpSet
+has one flag byte in shared memory.
+"""
+
+import multiprocessing as mp
+import typing
+
+import numpy as np
+
+from hloc.ip_set import IpSet
+
+
+class WhitelistCoverage(object):
+    """
+    Shared found flags for the entries of a whitelist
+    The processes only set flags to 1. Concurrent writes of the same value do not conflict, so
+    no lock is needed. The coverage has to be created before the processes are started.
+    """
+
+    def __init__(self, whitelist: IpSet):
+        """
+        :param whitelist: the whitelisted IP addresses and prefixes
+        """
+        self.whitelist = whitelist
+        self._found_flags = mp.RawArray('B', max(len(whitelist), 1))
+
+    def add_parsed(self, ip_addresses: typing.Iterable[str]):
+        """Marks the whitelist entries containing the parsed IPs as found"""
+        entry_indexes = self.whitelist.entry_indexes(list(set(ip_addresses)))
+        found_flags = np.frombuffer(self._found_flags, dtype=np.uint8)
+        found_flags[entry_indexes[entry_indexes >= 0]] = 1
+
+    def missing_ips(self) -> typing.List[str]:
+        """Returns the whitelisted addresses and prefixes without any parsed IP"""
+        found_flags = np.frombuffer(self._found_flags, dtype=np.uint8)[:len(self.whitelist)]
+        return [self.whitelist.entry_string(int(entry_index))
+                for entry_index in np.flatnonzero(found_flags == 0)]
+
+
+__all__ = ['WhitelistCoverage']
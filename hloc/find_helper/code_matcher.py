@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+Multi pattern matching of location codes in domain labels
+"""
+
+import typing
+
+import ahocorasick
+import marisa_trie
+import numpy as np
+
+BLACKLIST_CODE_TYPE = -1
+
+# boundary flags of a match
+START_ALIGNED = 1
+END_ALIGNED = 2
+
+# the share of the matches of a code type which are expected to be the correct location
+# short codes like iata codes also occur often as part of other words
+CODE_TYPE_PRIORS = np.array([
+    0.5,  # iata
+    0.6,  # icao
+    0.4,  # faa
+    0.9,  # clli
+    0.7,  # locode
+    0.8,  # geonames
+], dtype=np.float32)
+
+
+def create_code_automaton(codes: typing.Iterable[str]) -> typing.Optional[ahocorasick.Automaton]:
+    """
+    Creates an Aho-Corasick automaton which stores the length of every code
+    :returns the automaton or None if there are no codes
+    """
+    automaton = ahocorasick.Automaton(ahocorasick.STORE_LENGTH)
+    for code in codes:
+        automaton.add_word(code)
+
+    if not len(automaton):
+        return None
+
+    automaton.make_automaton()
+    return automaton
+
+
+def match_boundary_flags(label: str, code_offset: int, code_length: int) -> int:
+    """
+    Returns which ends of the code are aligned to a boundary of the label
+    A code end is aligned if it is at the start or the end of the label or next to a character
+    which is not a letter (e.g. a dash or a digit)
+    """
+    flags = 0
+    if code_offset == 0 or not label[code_offset - 1].isalpha():
+        flags |= START_ALIGNED
+    code_end = code_offset + code_length
+    if code_end == len(label) or not label[code_end].isalpha():
+        flags |= END_ALIGNED
+    return flags
+
+
+def match_prior_scores(code_types: np.ndarray, code_lengths: np.ndarray,
+                       label_lengths: np.ndarray, boundary_flags: np.ndarray) -> np.ndarray:
+    """
+    Computes a cheap prior score between 0 and 1 for matches before they are validated
+    The prior of the code type is weighted with the number of aligned code ends and the share
+    of the label covered by the code
+    """
+    aligned_ends = (boundary_flags & START_ALIGNED).astype(np.float32) + \
+        ((boundary_flags & END_ALIGNED) >> 1).astype(np.float32)
+    coverage = code_lengths.astype(np.float32) / np.maximum(label_lengths, 1)
+    prior_scores = CODE_TYPE_PRIORS[code_types] * (1 + aligned_ends) / 3 * (0.5 + 0.5 * coverage)
+    return prior_scores.astype(np.float32)
+
+
+def label_contains_code(automaton: typing.Optional[ahocorasick.Automaton], label: str) -> bool:
+    """Checks if any code of the automaton occurs in the label"""
+    if automaton is None:
+        return False
+
+    for _ in automaton.iter(label):
+        return True
+    return False
+
+
+class BlacklistIndex(object):
+    """
+    Answers the blacklist checks of CodeMatcher.search with set lookups
+    For every blacklisted word the codes which are part of it are found once with the code
+    automaton. The words of the code to location blacklist are compiled into an automaton which
+    finds all of them in a label with one pass.
+    """
+
+    __slots__ = ['_code_automaton', '_covered_codes', 'code_to_location_blacklist',
+                 '_location_blacklist_automaton', '_always_blacklisted_codes']
+
+    def __init__(self, code_automaton: typing.Optional[ahocorasick.Automaton],
+                 code_to_location_blacklist: typing.Dict[str, typing.List[str]]):
+        """
+        :param code_automaton: the STORE_LENGTH automaton with all codes of the trie
+        :param code_to_location_blacklist: code to blacklisted words mapping
+        """
+        self._code_automaton = code_automaton
+        self._covered_codes = {}
+        self.code_to_location_blacklist = {code: frozenset(words) for code, words in
+                                           code_to_location_blacklist.items()}
+        # an empty word is part of every label
+        self._always_blacklisted_codes = frozenset(
+            code for code, words in self.code_to_location_blacklist.items() if '' in words)
+        self._location_blacklist_automaton = create_code_automaton(
+            {word for words in self.code_to_location_blacklist.values() for word in words
+             if word})
+
+    def covered_codes(self, blacklisted_word: str) -> typing.FrozenSet[str]:
+        """Returns all codes which are part of the blacklisted word"""
+        try:
+            return self._covered_codes[blacklisted_word]
+        except KeyError:
+            pass
+
+        covered_codes = frozenset(
+            blacklisted_word[end_index - length + 1:end_index + 1]
+            for end_index, length in self._code_automaton.iter(blacklisted_word))
+        self._covered_codes[blacklisted_word] = covered_codes
+        return covered_codes
+
+    def location_blacklist_words(self, label: str) -> typing.Set[str]:
+        """Returns all words of the code to location blacklist which are part of the label"""
+        if self._location_blacklist_automaton is None:
+            return set()
+
+        return {label[end_index - length + 1:end_index + 1]
+                for end_index, length in self._location_blacklist_automaton.iter(label)}
+
+    def is_location_blacklisted(self, code: str, label_words: typing.Set[str]) -> bool:
+        """
+        Checks if a blacklisted word of the code is part of the label
+        :param label_words: the result of location_blacklist_words for the label
+        """
+        return code in self._always_blacklisted_codes or \
+            not self.code_to_location_blacklist[code].isdisjoint(label_words)
+
+
+class MatchBatch(object):
+    """
+    The matches of a block of labels in columnar form
+    Every match is described by the index of its label in the block, the index of its location
+    id in location_ids, the code type and the offset and length of the code in the label.
+    """
+
+    __slots__ = ['label_index', 'location_index', 'code_type', 'code_offset', 'code_length',
+                 'location_ids']
+
+    def __init__(self, label_index: np.ndarray, location_index: np.ndarray,
+                 code_type: np.ndarray, code_offset: np.ndarray, code_length: np.ndarray,
+                 location_ids: typing.List[str]):
+        self.label_index = label_index
+        self.location_index = location_index
+        self.code_type = code_type
+        self.code_offset = code_offset
+        self.code_length = code_length
+        self.location_ids = location_ids
+
+    @staticmethod
+    def from_match_lists(label_indexes: typing.List[int], location_ids: typing.List[str],
+                         code_types: typing.List[int], code_offsets: typing.List[int],
+                         code_lengths: typing.List[int]) -> 'MatchBatch':
+        """Creates the batch from one list per column with the location ids as strings"""
+        location_indexes = {}
+        location_index = np.fromiter(
+            (location_indexes.setdefault(location_id, len(location_indexes))
+             for location_id in location_ids), dtype=np.int32, count=len(location_ids))
+
+        return MatchBatch(np.array(label_indexes, dtype=np.int32), location_index,
+                          np.array(code_types, dtype=np.int8),
+                          np.array(code_offsets, dtype=np.int32),
+                          np.array(code_lengths, dtype=np.int16),
+                          list(location_indexes.keys()))
+
+    def __len__(self):
+        return len(self.label_index)
+
+    def matched_label_count(self) -> int:
+        """Returns the number of labels with at least one match"""
+        return len(np.unique(self.label_index))
+
+    def code_type_counts(self) -> typing.Dict[int, int]:
+        """Returns the number of matches per code type"""
+        code_types, counts = np.unique(self.code_type, return_counts=True)
+        return dict(zip(code_types.tolist(), counts.tolist()))
+
+    def positional_metadata(self, names: typing.Sequence[str]) \
+            -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the boundary flags and the prior scores of all matches
+        :param names: the label names the batch was created for
+        """
+        boundary_flags = np.fromiter(
+            (match_boundary_flags(names[label_index], code_offset, code_length)
+             for label_index, code_offset, code_length in zip(
+                 self.label_index.tolist(), self.code_offset.tolist(),
+                 self.code_length.tolist())),
+            dtype=np.int8, count=len(self))
+        label_lengths = np.fromiter((len(name) for name in names), dtype=np.int32,
+                                    count=len(names))[self.label_index]
+        prior_scores = match_prior_scores(self.code_type, self.code_length, label_lengths,
+                                          boundary_flags)
+        return boundary_flags, prior_scores
+
+    def iter_matches(self, names: typing.Sequence[str]) \
+            -> typing.Generator[typing.Tuple[int, str, str, int], None, None]:
+        """
+        Yields the matches as (label_index, location_id, code, code_type) tuples
+        :param names: the label names the batch was created for
+        """
+        for label_index, location_index, code_type, code_offset, code_length in zip(
+                self.label_index.tolist(), self.location_index.tolist(),
+                self.code_type.tolist(), self.code_offset.tolist(), self.code_length.tolist()):
+            yield (label_index, self.location_ids[location_index],
+                   names[label_index][code_offset:code_offset + code_length], code_type)
+
+
+class CodeMatcher(object):
+    """
+    Finds all codes of a location code trie in a label with one Aho-Corasick pass
+    The RecordTrie keeps the records for every code while the automaton only stores the code
+    lengths. Therefore the automaton does not hold any python objects and can be shared with
+    forked processes.
+    """
+
+    __slots__ = ['trie', 'code_to_location_blacklist', '_automaton', '_blacklist_index']
+
+    def __init__(self, trie: marisa_trie.RecordTrie,
+                 code_to_location_blacklist: typing.Dict[str, typing.List[str]]=None):
+        """
+        :param trie: the RecordTrie created with find.create_trie_obj
+        :param code_to_location_blacklist: code to blacklisted words mapping. A code is skipped
+            if one of its words is part of the label
+        """
+        self.trie = trie
+        self.code_to_location_blacklist = code_to_location_blacklist or {}
+        self._automaton = create_code_automaton(trie.keys())
+        self._blacklist_index = BlacklistIndex(self._automaton, self.code_to_location_blacklist)
+
+    def code_occurrences(self, label: str) -> typing.List[typing.Tuple[int, str]]:
+        """
+        Returns all codes occurring in the label as (start index, code) tuples
+        The tuples are sorted by the start index and for the same start the longest code is first
+        """
+        if self._automaton is None:
+            return []
+
+        occurrences = [(end_index - length + 1, label[end_index - length + 1:end_index + 1])
+                       for end_index, length in self._automaton.iter(label)]
+        occurrences.sort(key=lambda occurrence: (occurrence[0], -len(occurrence[1])))
+        return occurrences
+
+    def search(self, label_name: str) -> typing.List[typing.Tuple[str, str, int]]:
+        """
+        Searches for all location codes in the label
+        Every dash separated sub label is searched on its own. A code is skipped if it is part
+        of a blacklisted word found before it in the same sub label.
+        :param label_name: the domain label string
+        :return: a list of (location_id, code, code_type) tuples
+        """
+        return [(location_id, code, code_type)
+                for location_id, code, code_type, _ in self.search_with_offsets(label_name)]
+
+    def search_with_offsets(self, label_name: str) \
+            -> typing.List[typing.Tuple[str, str, int, int]]:
+        """
+        Searches for all location codes in the label like search
+        :param label_name: the domain label string
+        :return: a list of (location_id, code, code_type, code offset in the label) tuples
+        """
+        location_code_tuples = []
+
+        sub_label_offset = 0
+        for o_label in label_name.split('-'):
+            # all codes which are part of a blacklisted word found before
+            covered_codes = set()
+            location_blacklist_words = None
+
+            for start_index, key in self.code_occurrences(o_label):
+                if key in covered_codes:
+                    continue
+
+                if key in self._blacklist_index.code_to_location_blacklist:
+                    if location_blacklist_words is None:
+                        location_blacklist_words = \
+                            self._blacklist_index.location_blacklist_words(o_label)
+                    if self._blacklist_index.is_location_blacklisted(key,
+                                                                     location_blacklist_words):
+                        continue
+
+                matching_locations = self.trie[key]
+                if [code_type for _, code_type in matching_locations
+                        if code_type == BLACKLIST_CODE_TYPE]:
+                    covered_codes.update(self._blacklist_index.covered_codes(key))
+                    continue
+
+                for location_id, code_type in matching_locations:
+                    location_code_tuples.append((location_id.decode(), key, code_type,
+                                                 sub_label_offset + start_index))
+
+            sub_label_offset += len(o_label) + 1
+
+        return location_code_tuples
+
+
+__all__ = ['CodeMatcher',
+           'BlacklistIndex',
+           'MatchBatch',
+           'create_code_automaton',
+           'label_contains_code',
+           'match_boundary_flags',
+           'match_prior_scores',
+           'BLACKLIST_CODE_TYPE',
+           'START_ALIGNED',
+           'END_ALIGNED',
+           ]
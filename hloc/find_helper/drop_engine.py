@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Applies DRoP rules to a stream of domain names
+"""
+
+import collections
+import re
+import typing
+
+import marisa_trie
+
+from hloc.models import DRoPRule, LocationCodeType
+
+NAMED_TYPE_GROUP = '(?P<type>'
+
+
+class DRoPRuleSet(object):
+    """
+    All rules for one domain suffix
+    The rules are combined into one alternation regex which is checked first. Only if it matches
+    the rules are applied one by one to get every matching rule with its code.
+    """
+
+    __slots__ = ['suffix', 'rules', '_prefilter']
+
+    def __init__(self, suffix: str, drop_rules: typing.List[DRoPRule]):
+        self.suffix = suffix
+        self.rules = [regex_rule for drop_rule in drop_rules
+                      for regex_rule in drop_rule.regex_pattern_rules]
+
+        # the named groups of the rules would collide in the alternation
+        alternatives = ['(?:{})'.format(pattern.pattern.replace(NAMED_TYPE_GROUP, '(?:'))
+                        for pattern, _ in self.rules]
+        try:
+            self._prefilter = re.compile('|'.join(alternatives))
+        except re.error:
+            self._prefilter = None
+
+    def match(self, domain_name: str) -> typing.List[typing.Tuple[str, LocationCodeType]]:
+        """Returns the (code, code type) tuples of all rules matching the domain name"""
+        if self._prefilter is not None and self._prefilter.search(domain_name) is None:
+            return []
+
+        code_tuples = []
+        for pattern, code_type in self.rules:
+            rule_match = pattern.search(domain_name)
+            if rule_match is not None:
+                code_tuples.append((rule_match.group('type'), code_type))
+        return code_tuples
+
+
+class DRoPRuleEngine(object):
+    """
+    Finds location hints in domain names with DRoP rules
+    The rules are grouped by their domain suffix (DRoPRule.name). For a domain only the rule
+    sets of its suffixes are applied. The found codes are mapped to locations with the find trie.
+    """
+
+    __slots__ = ['rule_sets', 'trie']
+
+    def __init__(self, drop_rules: typing.Iterable[DRoPRule], trie: marisa_trie.RecordTrie):
+        """
+        :param drop_rules: the DRoP rules
+        :param trie: the RecordTrie created with find.create_trie_obj
+        """
+        rules_per_suffix = collections.defaultdict(list)
+        for drop_rule in drop_rules:
+            rules_per_suffix[drop_rule.name.strip('.').lower()].append(drop_rule)
+
+        self.rule_sets = {suffix: DRoPRuleSet(suffix, suffix_rules)
+                          for suffix, suffix_rules in rules_per_suffix.items()}
+        self.trie = trie
+
+    def rule_sets_for_domain(self, domain_name: str) -> typing.List[DRoPRuleSet]:
+        """Returns the rule sets of all suffixes of the domain name"""
+        domain_parts = domain_name.lower().strip('.').split('.')
+        rule_sets = []
+        for index in range(len(domain_parts)):
+            rule_set = self.rule_sets.get('.'.join(domain_parts[index:]))
+            if rule_set is not None:
+                rule_sets.append(rule_set)
+        return rule_sets
+
+    def search(self, domain_name: str) -> typing.List[typing.Tuple[str, str, int]]:
+        """
+        Applies all relevant rules to the domain name
+        :return: a list of (location_id, code, code_type) tuples of the locations with the
+            found code and the code type of the rule
+        """
+        location_code_tuples = []
+        found = set()
+
+        for rule_set in self.rule_sets_for_domain(domain_name):
+            for code, code_type in rule_set.match(domain_name):
+                code = code.lower()
+                if (code, code_type) in found or code not in self.trie:
+                    continue
+                found.add((code, code_type))
+
+                for location_id, location_code_type in self.trie[code]:
+                    if location_code_type == code_type.value:
+                        location_code_tuples.append((location_id.decode(), code,
+                                                     location_code_type))
+
+        return location_code_tuples
+
+
+__all__ = ['DRoPRuleEngine',
+           'DRoPRuleSet',
+           ]
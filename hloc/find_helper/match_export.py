@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Exports the matches of find to Parquet or Arrow IPC files instead of (or next to) the database
+Needs the optional pyarrow dependency (pip install hloc[export])
+"""
+
+import os
+import typing
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from hloc.find_helper.code_matcher import MatchBatch
+from hloc.models import LocationCodeType
+
+PARQUET_FORMAT = 'parquet'
+ARROW_FORMAT = 'arrow'
+EXPORT_FORMATS = [PARQUET_FORMAT, ARROW_FORMAT]
+TEMP_FILE_ENDING = '.tmp'
+
+CODE_TYPE_NAMES = [code_type.name for code_type in sorted(LocationCodeType,
+                                                          key=lambda code_type: code_type.value)]
+
+
+def export_schema():
+    """Returns the schema of the exported files"""
+    return pa.schema([
+        ('domain_label_id', pa.int64()),
+        ('domain_label', pa.string()),
+        ('location_id', pa.string()),
+        ('code', pa.string()),
+        ('code_type', pa.string()),
+        ('code_offset', pa.int32()),
+        ('boundary_flags', pa.int8()),
+        ('prior_score', pa.float32()),
+    ])
+
+
+class MatchExporter(object):
+    """
+    Writes the match batches of one search process to one file per id chunk
+    Every match batch is written as its own row group (record batch), so only one batch is held
+    in memory. A chunk file is written as temporary file and renamed when the chunk is finished.
+    Therefore a chunk which is searched again overwrites its old file. The temporary file of a
+    chunk which was not searched completely is deleted with abort_chunk.
+    """
+
+    def __init__(self, directory: str, file_format: str=PARQUET_FORMAT):
+        """
+        :param directory: the directory for the exported files
+        :param file_format: parquet or arrow (Arrow IPC file format)
+        """
+        if pa is None:
+            raise ImportError('the export of matches needs pyarrow (pip install hloc[export])')
+        if file_format not in EXPORT_FORMATS:
+            raise ValueError('{} is not an export format'.format(file_format))
+
+        self.directory = directory
+        self.file_format = file_format
+        self.schema = export_schema()
+        self._filepath = None
+        self._writer = None
+        self._sink = None
+
+        os.makedirs(directory, exist_ok=True)
+
+    def start_chunk(self, chunk: typing.Tuple[int, int]):
+        """Opens the file for the chunk"""
+        # a chunk which was neither finished nor aborted was not searched completely
+        self.abort_chunk()
+
+        self._filepath = os.path.join(self.directory, 'labels-{}-{}.{}'.format(
+            chunk[0], chunk[1], self.file_format))
+        temp_filepath = self._filepath + TEMP_FILE_ENDING
+        if self.file_format == PARQUET_FORMAT:
+            self._writer = pq.ParquetWriter(temp_filepath, self.schema)
+        else:
+            self._sink = pa.OSFile(temp_filepath, 'wb')
+            self._writer = pa.ipc.new_file(self._sink, self.schema)
+
+    def write_batch(self, domain_label_ids: typing.Sequence[int], names: typing.Sequence[str],
+                    match_batch: MatchBatch):
+        """
+        Writes all matches of a block of labels
+        :param domain_label_ids: the ids of the labels in the block
+        :param names: the names of the labels in the block
+        :param match_batch: the matches found in the names
+        """
+        if not len(match_batch):
+            return
+
+        label_ids = np.asarray(domain_label_ids, dtype=np.int64)[match_batch.label_index]
+        label_names = pa.DictionaryArray.from_arrays(
+            pa.array(match_batch.label_index), pa.array(names, type=pa.string()))
+        location_ids = pa.DictionaryArray.from_arrays(
+            pa.array(match_batch.location_index),
+            pa.array(match_batch.location_ids, type=pa.string()))
+        code_types = pa.DictionaryArray.from_arrays(
+            pa.array(match_batch.code_type), pa.array(CODE_TYPE_NAMES, type=pa.string()))
+        codes = [names[label_index][code_offset:code_offset + code_length]
+                 for label_index, code_offset, code_length in zip(
+                     match_batch.label_index.tolist(), match_batch.code_offset.tolist(),
+                     match_batch.code_length.tolist())]
+        boundary_flags, prior_scores = match_batch.positional_metadata(names)
+
+        record_batch = pa.RecordBatch.from_arrays([
+            pa.array(label_ids),
+            label_names.cast(pa.string()),
+            location_ids.cast(pa.string()),
+            pa.array(codes, type=pa.string()),
+            code_types.cast(pa.string()),
+            pa.array(match_batch.code_offset),
+            pa.array(boundary_flags),
+            pa.array(prior_scores),
+        ], schema=self.schema)
+
+        if self.file_format == PARQUET_FORMAT:
+            self._writer.write_table(pa.Table.from_batches([record_batch]))
+        else:
+            self._writer.write_batch(record_batch)
+
+    def finish_chunk(self):
+        """Closes the file of the completely searched chunk and moves it to its final name"""
+        if self._writer is None:
+            return
+
+        filepath = self._close_chunk_file()
+        os.replace(filepath + TEMP_FILE_ENDING, filepath)
+
+    def abort_chunk(self):
+        """Closes and deletes the temporary file of a chunk which was not searched completely"""
+        if self._writer is None:
+            return
+
+        filepath = self._close_chunk_file()
+        try:
+            os.remove(filepath + TEMP_FILE_ENDING)
+        except FileNotFoundError:
+            pass
+
+    def _close_chunk_file(self) -> str:
+        """Closes the writer of the current chunk and returns the final path of its file"""
+        filepath = self._filepath
+        try:
+            self._writer.close()
+            if self._sink is not None:
+                self._sink.close()
+        finally:
+            self._writer = None
+            self._sink = None
+            self._filepath = None
+        return filepath
+
+
+__all__ = ['MatchExporter',
+           'export_schema',
+           'EXPORT_FORMATS',
+           'PARQUET_FORMAT',
+           'ARROW_FORMAT',
+           ]
@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""
+Bulk writer for the location hints found by find
+"""
+
+import array
+import math
+import multiprocessing as mp
+import typing
+import zlib
+
+import sqlalchemy as sqla
+
+from hloc.chunk_coordinator import CommitMarker
+from hloc.db_utils import copy_rows, sequence_id_generator
+from hloc.find_helper.code_matcher import MatchBatch
+from hloc.models import CodeMatch, DRoPMatch, LocationCodeType, LocationHint
+from hloc.models.location import location_hint_label_table, domain_location_hints_table
+
+LOCATION_HINT_COLUMNS = ['id', 'location_id', 'hint_type', 'code_type', 'code']
+LABEL_MATCH_COLUMNS = ['code_offset', 'boundary_flags', 'prior_score']
+
+# the positional metadata of matches without one (e.g. DRoP matches)
+NO_MATCH_METADATA = (-1, 0, math.nan)
+
+
+class HintConnection(object):
+    """The type of the written location hints and the table connecting them"""
+
+    __slots__ = ['hint_class', 'table', 'column_name', 'match_columns']
+
+    def __init__(self, hint_class, table, column_name: str,
+                 match_columns: typing.List[str]=None):
+        """
+        :param hint_class: the CodeMatch class of the hints
+        :param table: the table connecting the hints with labels or domains
+        :param column_name: the column of the table with the label or domain id
+        :param match_columns: the columns of the table for the positional metadata of a match
+        """
+        self.hint_class = hint_class
+        self.table = table
+        self.column_name = column_name
+        self.match_columns = match_columns or []
+
+    @property
+    def hint_type(self) -> str:
+        return self.hint_class.__mapper__.polymorphic_identity
+
+    @property
+    def connection_columns(self) -> typing.List[str]:
+        return ['location_hint_id', self.column_name] + self.match_columns
+
+
+LABEL_HINT_CONNECTION = HintConnection(CodeMatch, location_hint_label_table, 'domain_label_id',
+                                       match_columns=LABEL_MATCH_COLUMNS)
+DOMAIN_HINT_CONNECTION = HintConnection(DRoPMatch, domain_location_hints_table, 'domain_id')
+
+
+def make_location_hint_key(location_id: str, code: str, code_type: int) -> str:
+    return '{},{},{}'.format(location_id, code, code_type)
+
+
+def location_hint_shard(location_id: str, code: str, code_type: int, nr_shards: int) -> int:
+    """
+    Returns the index of the writer owning the location hint
+    crc32 is used because the builtin string hash differs between interpreter processes
+    """
+    return zlib.crc32(make_location_hint_key(location_id, code, code_type).encode()) % nr_shards
+
+
+def pack_matches(match_tuples: typing.List[tuple]) -> tuple:
+    """
+    Packs (location_id, code, code_type, connected_id, code_offset, boundary_flags,
+    prior_score) tuples into arrays and two strings which are much cheaper to pickle than a
+    list of tuples
+    """
+    location_ids, codes, code_types, connected_ids, code_offsets, boundary_flags, \
+        prior_scores = zip(*match_tuples)
+    return ('\n'.join(location_ids), '\n'.join(codes), array.array('b', code_types),
+            array.array('q', connected_ids), array.array('h', code_offsets),
+            array.array('b', boundary_flags), array.array('f', prior_scores))
+
+
+def unpack_matches(packed_matches: tuple) -> typing.Generator[tuple, None, None]:
+    """
+    Yields the (location_id, code, code_type, connected_id, code_offset, boundary_flags,
+    prior_score) tuples of packed matches
+    """
+    location_ids, codes, *arrays = packed_matches
+    yield from zip(location_ids.split('\n'), codes.split('\n'), *arrays)
+
+
+class LocationMatch(object):
+    """
+    A location hint and the ids of the labels or domains it was found in
+    The positional metadata of the match (incl. its prior score) is kept per connected id. The
+    hint itself has no score because it is shared by all labels it was found in.
+    """
+
+    __slots__ = ['id', 'location_id', 'location_code', 'location_code_type', 'connected_ids',
+                 'old_connected_ids']
+
+    def __init__(self, location_hint_id: int, location_id: str, location_code: str,
+                 location_code_type: int):
+        self.id = location_hint_id
+        self.location_id = location_id
+        self.location_code = location_code
+        self.location_code_type = location_code_type
+        self.connected_ids = {}
+        self.old_connected_ids = set()
+
+    def location_hint_row(self, hint_type: str) -> tuple:
+        return (self.id, self.location_id, hint_type,
+                LocationCodeType(self.location_code_type).name, self.location_code)
+
+    def connection_rows(self, with_match_metadata: bool=False) -> typing.List[tuple]:
+        if not with_match_metadata:
+            return [(self.id, connected_id) for connected_id in self.connected_ids]
+        return [(self.id, connected_id) + match_metadata
+                for connected_id, match_metadata in self.connected_ids.items()]
+
+    def add_connected_id(self, connected_id: int,
+                         match_metadata: typing.Tuple[int, int, float]=NO_MATCH_METADATA):
+        """
+        Adds the connection
+        :param match_metadata: the code_offset, boundary_flags and prior_score of the match
+        """
+        if connected_id not in self.connected_ids and connected_id not in self.old_connected_ids:
+            self.connected_ids[connected_id] = match_metadata
+
+    def handled_connections(self):
+        self.old_connected_ids.update(self.connected_ids)
+        self.connected_ids.clear()
+
+    def __hash__(self):
+        return hash(make_location_hint_key(self.location_id, self.location_code,
+                                           self.location_code_type))
+
+
+class LocationHintWriter(object):
+    """
+    Collects location code matches and writes them in batches with COPY FROM STDIN
+    The ids of new location hints are taken from a range reserved from the sequence of the
+    location_hints table. Therefore no round trip is needed to get the ids of inserted rows.
+    """
+
+    def __init__(self, db_session, hint_connection: HintConnection=LABEL_HINT_CONNECTION,
+                 batch_size: int=10**4, batches_per_commit: int=10,
+                 on_commit: typing.Optional[typing.Callable[[], None]]=None):
+        """
+        :param db_session: a data base session used only by this writer
+        :param hint_connection: the type of the hints and how they are connected
+        :param batch_size: the number of matches after which the rows are written
+        :param batches_per_commit: the number of written batches after which is committed
+        :param on_commit: called after every commit. All matches added before are committed
+        """
+        self.db_session = db_session
+        self.hint_connection = hint_connection
+        self.batch_size = batch_size
+        self.batches_per_commit = batches_per_commit
+        self.on_commit = on_commit
+        self.location_hints = {}
+        self._new_matches = []
+        self._matches_to_save = set()
+        self._counter = 0
+        self._batch_counter = 0
+        self._new_ids = sequence_id_generator(LocationHint.__table__, db_session,
+                                              block_size=batch_size)
+
+    def load_existing_hints(self, shard_index: int=0, nr_shards: int=1):
+        """
+        Loads the existing location hints so new matches reuse them
+        Only the hints owned by the shard are loaded
+        """
+        hint_class = self.hint_connection.hint_class
+        for code_match in self.db_session.query(hint_class).filter(
+                hint_class.hint_type == self.hint_connection.hint_type):
+            code_type = code_match.code_type.value
+            if nr_shards > 1 and location_hint_shard(code_match.location_id, code_match.code,
+                                                     code_type, nr_shards) != shard_index:
+                continue
+
+            self.location_hints[make_location_hint_key(code_match.location_id, code_match.code,
+                                                       code_type)] = \
+                LocationMatch(code_match.id, code_match.location_id, code_match.code, code_type)
+
+    def add_match(self, location_id: str, location_code: str, location_code_type: int,
+                  connected_id: int,
+                  match_metadata: typing.Tuple[int, int, float]=NO_MATCH_METADATA):
+        """
+        Adds a match and writes all collected matches if the batch size is reached
+        :param match_metadata: the code_offset, boundary_flags and prior_score of the match
+        """
+        location_hint_key = make_location_hint_key(location_id, location_code,
+                                                   location_code_type)
+        try:
+            location_hint = self.location_hints[location_hint_key]
+        except KeyError:
+            location_hint = LocationMatch(next(self._new_ids), location_id, location_code,
+                                          location_code_type)
+            self.location_hints[location_hint_key] = location_hint
+            self._new_matches.append(location_hint)
+
+        self._matches_to_save.add(location_hint)
+        location_hint.add_connected_id(connected_id, match_metadata)
+
+        self._counter += 1
+        if self._counter >= self.batch_size:
+            self.save()
+            self._counter = 0
+
+            self._batch_counter += 1
+            if self._batch_counter >= self.batches_per_commit:
+                self.commit()
+
+    def save(self):
+        """Writes all new location hints and their connections"""
+        hint_type = self.hint_connection.hint_type
+        copy_rows(LocationHint.__table__, LOCATION_HINT_COLUMNS,
+                  (match.location_hint_row(hint_type) for match in self._new_matches),
+                  self.db_session)
+
+        with_match_metadata = bool(self.hint_connection.match_columns)
+        connection_rows = []
+        for match in self._matches_to_save:
+            connection_rows.extend(match.connection_rows(with_match_metadata))
+            match.handled_connections()
+
+        self._new_matches.clear()
+        self._matches_to_save.clear()
+
+        copy_rows(self.hint_connection.table, self.hint_connection.connection_columns,
+                  connection_rows, self.db_session)
+
+    def commit(self):
+        """Commits the written rows. Only matches written with save are committed"""
+        self.db_session.commit()
+        self._batch_counter = 0
+        if self.on_commit is not None:
+            self.on_commit()
+
+    def close(self):
+        """Writes the remaining matches and commits"""
+        self.save()
+        self.commit()
+
+
+class ShardedMatchSender(object):
+    """
+    Distributes the matches of a search process to the location hint writers
+    Every writer owns the location hints of one shard. The matches are buffered and sent packed
+    per shard. Before the matches of a label (or domain) which is searched again are sent, its
+    old location hint connections are deleted and committed. Therefore no writer can insert a
+    connection which is deleted afterwards.
+    """
+
+    def __init__(self, shard_queues: typing.List[mp.Queue], db_session,
+                 hint_connection: HintConnection=LABEL_HINT_CONNECTION, flush_size: int=10**4):
+        """
+        :param shard_queues: one queue per location hint writer
+        :param db_session: a data base session used to delete the old connections
+        :param hint_connection: the type of the hints and how they are connected
+        :param flush_size: the number of buffered matches after which they are sent
+        """
+        self.shard_queues = shard_queues
+        self.db_session = db_session
+        self.hint_connection = hint_connection
+        self.flush_size = flush_size
+        self._ids_to_reset = []
+        self._shard_matches = [[] for _ in shard_queues]
+        self._counter = 0
+
+    def reset(self, connected_id: int):
+        """Marks the label or domain to delete its old location hint connections"""
+        self._ids_to_reset.append(connected_id)
+
+    def add_matches(self, connected_id: int,
+                    location_code_tuples: typing.List[typing.Tuple[str, str, int]]):
+        """Adds the (location_id, code, code_type) matches of one label or domain"""
+        nr_shards = len(self.shard_queues)
+        for location_id, code, code_type in location_code_tuples:
+            shard_index = location_hint_shard(location_id, code, code_type, nr_shards)
+            self._shard_matches[shard_index].append((location_id, code, code_type,
+                                                     connected_id) + NO_MATCH_METADATA)
+
+        self._counter += len(location_code_tuples)
+        if self._counter >= self.flush_size:
+            self.flush()
+
+    def add_batch(self, connected_ids: typing.Sequence[int], names: typing.Sequence[str],
+                  match_batch: MatchBatch):
+        """
+        Adds all matches of a block of labels with their positional metadata
+        :param connected_ids: the ids of the labels in the block
+        :param names: the names of the labels in the block
+        :param match_batch: the matches found in the names
+        """
+        nr_shards = len(self.shard_queues)
+        boundary_flags, prior_scores = match_batch.positional_metadata(names)
+        for (label_index, location_id, code, code_type), code_offset, match_flags, prior_score \
+                in zip(match_batch.iter_matches(names), match_batch.code_offset.tolist(),
+                       boundary_flags.tolist(), prior_scores.tolist()):
+            shard_index = location_hint_shard(location_id, code, code_type, nr_shards)
+            self._shard_matches[shard_index].append((location_id, code, code_type,
+                                                     connected_ids[label_index], code_offset,
+                                                     match_flags, prior_score))
+
+        self._counter += len(match_batch)
+        if self._counter >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Deletes the old connections of the reset ids and sends all buffered matches
+        Only the connections to hints of the hint type of this sender are deleted, the hints of
+        other types connected to the same ids are kept.
+        """
+        if self._ids_to_reset:
+            connection_table = self.hint_connection.table
+            hint_table = LocationHint.__table__
+            delete_expr = connection_table.delete().where(sqla.and_(
+                connection_table.c[self.hint_connection.column_name].in_(self._ids_to_reset),
+                connection_table.c.location_hint_id.in_(
+                    sqla.select(hint_table.c.id).where(
+                        hint_table.c.hint_type == self.hint_connection.hint_type))))
+            self.db_session.execute(delete_expr)
+            self.db_session.commit()
+            self._ids_to_reset.clear()
+
+        for shard_queue, matches in zip(self.shard_queues, self._shard_matches):
+            if matches:
+                shard_queue.put(pack_matches(matches))
+                matches.clear()
+
+        self._counter = 0
+
+    def send_commit_marker(self, item):
+        """
+        Sends all buffered matches and a CommitMarker for the item to every writer
+        The writers acknowledge the marker after they committed all matches sent before it
+        """
+        self.flush()
+        for shard_queue in self.shard_queues:
+            shard_queue.put(CommitMarker(item))
+
+    def close(self):
+        """Sends the remaining matches and closes the queues of this process"""
+        self.flush()
+        for shard_queue in self.shard_queues:
+            shard_queue.close()
+
+
+__all__ = ['LocationHintWriter',
+           'HintConnection',
+           'LABEL_HINT_CONNECTION',
+           'LABEL_MATCH_COLUMNS',
+           'DOMAIN_HINT_CONNECTION',
+           'LocationMatch',
+           'ShardedMatchSender',
+           'make_location_hint_key',
+           'location_hint_shard',
+           'pack_matches',
+           'unpack_matches',
+           ]
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Stores the compiled location code trie on disk to share it between find runs and processes
+The trie is saved in the marisa format which can be memory mapped. The metadata header
+is saved as JSON next to the trie file (<trie file>.meta.json).
+On a rebuild the last artifact is kept as <trie file>.previous to find the changed codes.
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import typing
+
+import marisa_trie
+
+TRIE_RECORD_FORMAT = '<32sh'
+METADATA_FILE_ENDING = '.meta.json'
+PREVIOUS_FILE_ENDING = '.previous'
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+class MetadataKey:
+    record_format = 'record_format'
+    location_checksum = 'location_checksum'
+    code_blacklist_checksum = 'code_blacklist_checksum'
+    word_blacklist_checksum = 'word_blacklist_checksum'
+    code_to_location_blacklist_checksum = 'code_to_location_blacklist_checksum'
+    code_to_location_blacklist = 'code_to_location_blacklist'
+    built_at = 'built_at'
+
+
+INPUT_METADATA_KEYS = [MetadataKey.record_format,
+                       MetadataKey.location_checksum,
+                       MetadataKey.code_blacklist_checksum,
+                       MetadataKey.word_blacklist_checksum,
+                       MetadataKey.code_to_location_blacklist_checksum]
+
+
+def metadata_path(trie_filepath: str) -> str:
+    """Returns the path of the metadata header file for the trie file"""
+    return trie_filepath + METADATA_FILE_ENDING
+
+
+def previous_artifact_path(trie_filepath: str) -> str:
+    """Returns the path of the artifact which was replaced by the last rebuild"""
+    return trie_filepath + PREVIOUS_FILE_ENDING
+
+
+def built_at(metadata: typing.Dict[str, str]) -> datetime.datetime:
+    """Returns the build time of the artifact with the metadata"""
+    return datetime.datetime.strptime(metadata[MetadataKey.built_at], TIMESTAMP_FORMAT)
+
+
+def trie_version(metadata: typing.Dict[str, str]) -> str:
+    """Returns an identifier which only changes if the inputs of the trie change"""
+    md5 = hashlib.md5()
+    for key in INPUT_METADATA_KEYS:
+        md5.update('{}:{};'.format(key, metadata.get(key)).encode())
+    return md5.hexdigest()
+
+
+def file_checksum(filepath: typing.Optional[str]) -> typing.Optional[str]:
+    """Returns the md5 hexdigest of the file content or None if no path is set"""
+    if not filepath:
+        return None
+
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as checksum_file:
+        for block in iter(lambda: checksum_file.read(2 ** 16), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def input_metadata(location_checksum: str, code_blacklist_filepath: typing.Optional[str],
+                   word_blacklist_filepath: typing.Optional[str],
+                   code_to_location_blacklist_filepath: typing.Optional[str]=None) \
+        -> typing.Dict[str, str]:
+    """
+    Creates the metadata describing all inputs of a trie build
+    The code to location blacklist is not part of the trie but changes the matches of find.
+    It is an input of the artifact so a changed blacklist creates a new artifact and the
+    incremental search finds the labels searched with the old blacklist.
+    :param location_checksum: the checksum of the location tables
+    :param code_blacklist_filepath: the path to the code blacklist file
+    :param word_blacklist_filepath: the path to the word blacklist file
+    :param code_to_location_blacklist_filepath: the path to the code to location blacklist file
+    """
+    return {
+        MetadataKey.record_format: TRIE_RECORD_FORMAT,
+        MetadataKey.location_checksum: location_checksum,
+        MetadataKey.code_blacklist_checksum: file_checksum(code_blacklist_filepath),
+        MetadataKey.word_blacklist_checksum: file_checksum(word_blacklist_filepath),
+        MetadataKey.code_to_location_blacklist_checksum:
+            file_checksum(code_to_location_blacklist_filepath),
+    }
+
+
+def read_metadata(trie_filepath: str) -> typing.Optional[typing.Dict[str, str]]:
+    """Returns the metadata of the trie artifact or None if there is no complete artifact"""
+    if not os.path.exists(trie_filepath) or not os.path.exists(metadata_path(trie_filepath)):
+        return None
+
+    with open(metadata_path(trie_filepath)) as metadata_file:
+        return json.load(metadata_file)
+
+
+def is_up_to_date(metadata: typing.Optional[typing.Dict[str, str]],
+                  current_input_metadata: typing.Dict[str, str]) -> bool:
+    """Checks if the artifact with the metadata was built from the current inputs"""
+    if metadata is None:
+        return False
+
+    return all(metadata.get(key) == current_input_metadata[key] for key in INPUT_METADATA_KEYS)
+
+
+def save_trie_artifact(trie: marisa_trie.RecordTrie, trie_filepath: str,
+                       current_input_metadata: typing.Dict[str, str],
+                       code_to_location_blacklist: typing.Dict[str, typing.List[str]]=None) \
+        -> typing.Dict[str, str]:
+    """
+    Saves the trie and its metadata header
+    A complete old artifact is kept as previous artifact. Otherwise the old header is removed
+    first so an interrupted save never looks up to date
+    :param code_to_location_blacklist: the code to location blacklist the artifact is built
+        with. It is saved in the header to find the codes whose entries change later
+    :returns the metadata of the saved artifact
+    """
+    metadata = dict(current_input_metadata)
+    metadata[MetadataKey.code_to_location_blacklist] = code_to_location_blacklist or {}
+    metadata[MetadataKey.built_at] = datetime.datetime.now().strftime(TIMESTAMP_FORMAT)
+
+    if read_metadata(trie_filepath) is not None:
+        previous_filepath = previous_artifact_path(trie_filepath)
+        os.replace(metadata_path(trie_filepath), metadata_path(previous_filepath))
+        os.replace(trie_filepath, previous_filepath)
+    elif os.path.exists(metadata_path(trie_filepath)):
+        os.remove(metadata_path(trie_filepath))
+
+    temp_trie_filepath = trie_filepath + '.tmp'
+    trie.save(temp_trie_filepath)
+    os.replace(temp_trie_filepath, trie_filepath)
+
+    temp_metadata_filepath = metadata_path(trie_filepath) + '.tmp'
+    with open(temp_metadata_filepath, 'w') as metadata_file:
+        json.dump(metadata, metadata_file, indent=2)
+    os.replace(temp_metadata_filepath, metadata_path(trie_filepath))
+
+    return metadata
+
+
+def load_trie_artifact(trie_filepath: str) -> marisa_trie.RecordTrie:
+    """Memory maps the trie file. All processes mapping the same file share its pages"""
+    return marisa_trie.RecordTrie(TRIE_RECORD_FORMAT).mmap(trie_filepath)
+
+
+def changed_codes(old_trie: marisa_trie.RecordTrie,
+                  new_trie: marisa_trie.RecordTrie) -> typing.Set[str]:
+    """Returns all codes which were added, removed or got other records in the new trie"""
+    old_codes = set(old_trie.keys())
+    new_codes = set(new_trie.keys())
+
+    codes = old_codes.symmetric_difference(new_codes)
+    for code in old_codes.intersection(new_codes):
+        if sorted(old_trie[code]) != sorted(new_trie[code]):
+            codes.add(code)
+
+    return codes
+
+
+def changed_blacklist_codes(old_metadata: typing.Dict, new_metadata: typing.Dict) \
+        -> typing.Optional[typing.Set[str]]:
+    """
+    Returns the codes whose code to location blacklist entries differ between two artifacts
+    :returns None if the old artifact has a different blacklist but did not save it
+    """
+    checksum_key = MetadataKey.code_to_location_blacklist_checksum
+    if old_metadata.get(checksum_key) == new_metadata.get(checksum_key):
+        return set()
+
+    old_blacklist = old_metadata.get(MetadataKey.code_to_location_blacklist)
+    if old_blacklist is None:
+        return None
+
+    new_blacklist = new_metadata.get(MetadataKey.code_to_location_blacklist) or {}
+    return {code for code in set(old_blacklist).union(new_blacklist)
+            if set(old_blacklist.get(code, [])) != set(new_blacklist.get(code, []))}
+
+
+__all__ = ['TRIE_RECORD_FORMAT',
+           'MetadataKey',
+           'previous_artifact_path',
+           'built_at',
+           'trie_version',
+           'changed_codes',
+           'changed_blacklist_codes',
+           'file_checksum',
+           'input_metadata',
+           'read_metadata',
+           'is_up_to_date',
+           'save_trie_artifact',
+           'load_trie_artifact',
+           ]
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Vectorized great circle distances on numpy arrays of coordinates in degrees
+The kernels use the same haversine formula as Location.gps_distance_haversine_plain and return
+distances in km. All functions broadcast their arguments like numpy ufuncs.
+"""
+
+import math
+import typing
+
+import numpy as np
+
+from hloc import constants
+
+# widens the bounding boxes to be safe against rounding differences
+BOUNDING_BOX_MARGIN = 1e-9
+
+
+def haversine_distances(lats1, lons1, lats2, lons2) -> np.ndarray:
+    """Returns the pairwise distances between the points of the (broadcast) arrays"""
+    lats1 = np.radians(np.asarray(lats1, dtype=np.float64))
+    lons1 = np.radians(np.asarray(lons1, dtype=np.float64))
+    lats2 = np.radians(np.asarray(lats2, dtype=np.float64))
+    lons2 = np.radians(np.asarray(lons2, dtype=np.float64))
+
+    tmp = np.sin((lats2 - lats1) / 2) ** 2 + \
+        np.cos(lats1) * np.cos(lats2) * np.sin((lons2 - lons1) / 2) ** 2
+    return 2 * np.arcsin(np.sqrt(np.minimum(tmp, 1.0))) * constants.EARTH_RADIUS
+
+
+def distances_to_point(lat: float, lon: float, lats, lons) -> np.ndarray:
+    """Returns the distances of all points of the arrays to one point"""
+    return haversine_distances(lat, lon, lats, lons)
+
+
+def distance_matrix(lats1, lons1, lats2, lons2) -> np.ndarray:
+    """Returns the (n, m) matrix of the distances between n and m points"""
+    return haversine_distances(np.asarray(lats1, dtype=np.float64)[:, np.newaxis],
+                               np.asarray(lons1, dtype=np.float64)[:, np.newaxis],
+                               np.asarray(lats2, dtype=np.float64)[np.newaxis, :],
+                               np.asarray(lons2, dtype=np.float64)[np.newaxis, :])
+
+
+def bounding_box(lat: float, lon: float, radius: float) \
+        -> typing.Tuple[float, float, typing.Optional[float]]:
+    """
+    Returns a box containing all points within the radius of the point
+    :returns (min_lat, max_lat, max_lon_offset). max_lon_offset is the maximal longitude
+        difference in degrees or None if the box contains all longitudes (the radius contains
+        a pole)
+    """
+    angle = radius / constants.EARTH_RADIUS
+    lat_offset = math.degrees(angle) + BOUNDING_BOX_MARGIN
+    min_lat = lat - lat_offset
+    max_lat = lat + lat_offset
+    if min_lat <= -90 or max_lat >= 90 or angle >= math.pi / 2:
+        return max(min_lat, -90), min(max_lat, 90), None
+
+    lon_offset = math.degrees(math.asin(min(math.sin(angle) / math.cos(math.radians(lat)), 1)))
+    return min_lat, max_lat, lon_offset + BOUNDING_BOX_MARGIN
+
+
+def indexes_within_radius(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray,
+                          radius: float) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Finds the points of the arrays within the radius of the point
+    Only the points inside the bounding box of the radius are checked with the haversine
+    distance.
+    :returns the ascending indexes of the points and their distances
+    """
+    min_lat, max_lat, max_lon_offset = bounding_box(lat, lon, radius)
+    in_box = (lats >= min_lat) & (lats <= max_lat)
+    if max_lon_offset is not None:
+        in_box &= np.abs((lons - lon + 180) % 360 - 180) <= max_lon_offset
+
+    indexes = np.flatnonzero(in_box)
+    distances = distances_to_point(lat, lon, lats[indexes], lons[indexes])
+    within_radius = distances <= radius
+    return indexes[within_radius], distances[within_radius]
+
+
+__all__ = ['haversine_distances',
+           'distances_to_point',
+           'distance_matrix',
+           'bounding_box',
+           'indexes_within_radius',
+           ]
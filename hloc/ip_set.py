@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+Compact sets of IP addresses and prefixes for whitelists and IP filter files
+Single addresses are saved in sorted arrays (uint32 for IPv4 and 16 byte big endian strings
+for IPv6) and prefixes as sorted, merged [start, end] ranges. Lookups are binary searches.
+A set loaded from a file is cached in a directory of .npy files next to it which is memory
+mapped by later runs, so processes forked afterwards share the pages.
+"""
+
+import ipaddress
+import json
+import os
+import re
+import typing
+
+import numpy as np
+
+IPV4_REGEX = re.compile(r'[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}')
+# matches a block of IPv4 addresses separated by newlines with one regex call
+IPV4_BLOCK_REGEX = re.compile(r'{0}(?:\n{0})*'.format(IPV4_REGEX.pattern))
+IPV6_DTYPE = 'S16'
+CACHE_DIRECTORY_ENDING = '.ipset'
+CACHE_FORMAT_VERSION = 1
+# the number of IPv4 address strings converted together while loading
+LOAD_BATCH_SIZE = 10**6
+ARRAY_NAMES = ['ipv4_addresses', 'ipv4_range_starts', 'ipv4_range_ends',
+               'ipv6_addresses', 'ipv6_range_starts', 'ipv6_range_ends']
+
+
+def ipv4_values(ip_addresses: typing.List[str]) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Converts IPv4 address strings with decimal octets into uint32 values
+    A block of valid addresses is checked with one regex call and parsed with np.fromstring.
+    Only blocks containing invalid strings are checked line by line.
+    :returns the values and a mask of the valid addresses. Invalid addresses have the value 0
+    """
+    octet_values = np.zeros((len(ip_addresses), 4), dtype=np.int64)
+    if not ip_addresses:
+        return np.empty(0, dtype=np.uint32), np.empty(0, dtype=bool)
+
+    text = '\n'.join(ip_addresses)
+    if IPV4_BLOCK_REGEX.fullmatch(text):
+        valid = np.ones(len(ip_addresses), dtype=bool)
+        octet_values[:] = np.fromstring(text.replace('\n', '.'), dtype=np.int64,
+                                        sep='.').reshape(-1, 4)
+    else:
+        valid = np.array([IPV4_REGEX.fullmatch(ip_address) is not None
+                          for ip_address in ip_addresses], dtype=bool)
+        if valid.any():
+            octet_values[valid] = np.fromstring(
+                '.'.join(ip_address for ip_address, is_valid in zip(ip_addresses, valid)
+                         if is_valid),
+                dtype=np.int64, sep='.').reshape(-1, 4)
+
+    valid &= (octet_values <= 255).all(axis=1)
+    octet_values[~valid] = 0
+    values = (octet_values[:, 0] << 24) | (octet_values[:, 1] << 16) | \
+        (octet_values[:, 2] << 8) | octet_values[:, 3]
+    return values.astype(np.uint32), valid
+
+
+def ipv6_value(ip_address: typing.Union[int, ipaddress.IPv6Address]) -> bytes:
+    """Returns the 16 byte big endian representation which sorts like the integer value"""
+    return int(ip_address).to_bytes(16, 'big')
+
+
+def _merged_ranges(ranges: typing.List[typing.Tuple[int, int]]) \
+        -> typing.List[typing.Tuple[int, int]]:
+    """Merges overlapping and adjacent [start, end] ranges"""
+    merged_ranges = []
+    for start, end in sorted(ranges):
+        if merged_ranges and start <= merged_ranges[-1][1] + 1:
+            if end > merged_ranges[-1][1]:
+                merged_ranges[-1] = (merged_ranges[-1][0], end)
+        else:
+            merged_ranges.append((start, end))
+    return merged_ranges
+
+
+def _range_indexes(values: np.ndarray, range_starts: np.ndarray,
+                   range_ends: np.ndarray) -> np.ndarray:
+    """Returns the index of the range containing every value or -1"""
+    if not len(range_starts):
+        return np.full(len(values), -1, dtype=np.int64)
+
+    indexes = np.searchsorted(range_starts, values, side='right') - 1
+    contained = (indexes >= 0) & (values <= range_ends[indexes.clip(0)])
+    return np.where(contained, indexes, -1)
+
+
+def _address_indexes(values: np.ndarray, addresses: np.ndarray) -> np.ndarray:
+    """Returns the index of every value in the sorted addresses or -1"""
+    if not len(addresses):
+        return np.full(len(values), -1, dtype=np.int64)
+
+    indexes = np.searchsorted(addresses, values).clip(0, len(addresses) - 1)
+    return np.where(addresses[indexes] == values, indexes, -1)
+
+
+def _uncovered_addresses(addresses: np.ndarray, range_starts: np.ndarray,
+                         range_ends: np.ndarray) -> np.ndarray:
+    return addresses[_range_indexes(addresses, range_starts, range_ends) < 0]
+
+
+class IpSet(object):
+    """
+    A set of IPv4 and IPv6 addresses and prefixes
+    Every single address and every merged prefix range is an entry of the set. The entries are
+    numbered in the order IPv4 addresses, IPv4 ranges, IPv6 addresses, IPv6 ranges. Addresses
+    covered by a prefix are only contained in the range entry.
+    """
+
+    def __init__(self, ipv4_addresses: np.ndarray, ipv4_range_starts: np.ndarray,
+                 ipv4_range_ends: np.ndarray, ipv6_addresses: np.ndarray,
+                 ipv6_range_starts: np.ndarray, ipv6_range_ends: np.ndarray,
+                 invalid_lines: int=0):
+        """
+        The arrays have to be sorted and the ranges merged. Use from_strings or load_ip_set.
+        :param invalid_lines: the number of lines which could not be parsed while loading
+        """
+        self.ipv4_addresses = ipv4_addresses
+        self.ipv4_range_starts = ipv4_range_starts
+        self.ipv4_range_ends = ipv4_range_ends
+        self.ipv6_addresses = ipv6_addresses
+        self.ipv6_range_starts = ipv6_range_starts
+        self.ipv6_range_ends = ipv6_range_ends
+        self.invalid_lines = invalid_lines
+
+        self._ipv4_ranges_offset = len(ipv4_addresses)
+        self._ipv6_addresses_offset = self._ipv4_ranges_offset + len(ipv4_range_starts)
+        self._ipv6_ranges_offset = self._ipv6_addresses_offset + len(ipv6_addresses)
+        self._length = self._ipv6_ranges_offset + len(ipv6_range_starts)
+
+    @classmethod
+    def from_strings(cls, lines: typing.Iterable[str]) -> 'IpSet':
+        """
+        Builds the set from IP addresses and CIDR prefixes, one per line
+        Empty lines and comments starting with # are skipped. Lines which are no IP address or
+        prefix are counted in invalid_lines.
+        """
+        ipv4_batch = []
+        ipv4_arrays = []
+        ipv6_addresses = set()
+        ipv4_ranges = []
+        ipv6_ranges = []
+        invalid_lines = 0
+
+        def add_ipv4_batch():
+            nonlocal invalid_lines
+            values, valid = ipv4_values(ipv4_batch)
+            invalid_lines += int(np.count_nonzero(~valid))
+            ipv4_arrays.append(np.unique(values[valid]))
+            ipv4_batch.clear()
+
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            if '/' not in line and ':' not in line:
+                ipv4_batch.append(line)
+                if len(ipv4_batch) >= LOAD_BATCH_SIZE:
+                    add_ipv4_batch()
+                continue
+
+            try:
+                if '/' in line:
+                    network = ipaddress.ip_network(line, strict=False)
+                    ranges = ipv4_ranges if network.version == 4 else ipv6_ranges
+                    ranges.append((int(network.network_address),
+                                   int(network.broadcast_address)))
+                else:
+                    ipv6_addresses.add(ipv6_value(ipaddress.IPv6Address(line)))
+            except ValueError:
+                invalid_lines += 1
+
+        add_ipv4_batch()
+        ipv4_address_array = np.unique(np.concatenate(ipv4_arrays))
+
+        ipv4_ranges = _merged_ranges(ipv4_ranges)
+        ipv4_range_starts = np.array([start for start, _ in ipv4_ranges], dtype=np.uint32)
+        ipv4_range_ends = np.array([end for _, end in ipv4_ranges], dtype=np.uint32)
+
+        ipv6_ranges = _merged_ranges(ipv6_ranges)
+        ipv6_range_starts = np.array([ipv6_value(start) for start, _ in ipv6_ranges],
+                                     dtype=IPV6_DTYPE)
+        ipv6_range_ends = np.array([ipv6_value(end) for _, end in ipv6_ranges],
+                                   dtype=IPV6_DTYPE)
+        ipv6_address_array = np.array(sorted(ipv6_addresses), dtype=IPV6_DTYPE)
+
+        return cls(_uncovered_addresses(ipv4_address_array, ipv4_range_starts, ipv4_range_ends),
+                   ipv4_range_starts, ipv4_range_ends,
+                   _uncovered_addresses(ipv6_address_array, ipv6_range_starts, ipv6_range_ends),
+                   ipv6_range_starts, ipv6_range_ends, invalid_lines=invalid_lines)
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def has_prefixes(self) -> bool:
+        return bool(len(self.ipv4_range_starts) or len(self.ipv6_range_starts))
+
+    def __contains__(self, ip_address: str) -> bool:
+        return bool(self.entry_indexes([ip_address])[0] >= 0)
+
+    def entry_indexes(self, ip_addresses: typing.Sequence[str]) -> np.ndarray:
+        """Returns the index of the entry containing every IP address or -1"""
+        entry_indexes = np.full(len(ip_addresses), -1, dtype=np.int64)
+
+        ipv4_positions = []
+        ipv4_strings = []
+        ipv6_positions = []
+        ipv6_values = []
+        for position, ip_address in enumerate(ip_addresses):
+            if ':' not in ip_address:
+                ipv4_positions.append(position)
+                ipv4_strings.append(ip_address)
+            else:
+                try:
+                    ipv6_values.append(ipv6_value(ipaddress.IPv6Address(ip_address)))
+                    ipv6_positions.append(position)
+                except ValueError:
+                    pass
+
+        if ipv4_positions:
+            values, valid = ipv4_values(ipv4_strings)
+            ipv4_entry_indexes = self._entry_indexes(
+                values, self.ipv4_addresses, self.ipv4_range_starts, self.ipv4_range_ends, 0,
+                self._ipv4_ranges_offset)
+            entry_indexes[ipv4_positions] = np.where(valid, ipv4_entry_indexes, -1)
+        if ipv6_positions:
+            entry_indexes[ipv6_positions] = self._entry_indexes(
+                np.array(ipv6_values, dtype=IPV6_DTYPE), self.ipv6_addresses,
+                self.ipv6_range_starts, self.ipv6_range_ends, self._ipv6_addresses_offset,
+                self._ipv6_ranges_offset)
+
+        return entry_indexes
+
+    @staticmethod
+    def _entry_indexes(values: np.ndarray, addresses: np.ndarray, range_starts: np.ndarray,
+                       range_ends: np.ndarray, addresses_offset: int,
+                       ranges_offset: int) -> np.ndarray:
+        address_indexes = _address_indexes(values, addresses)
+        range_indexes = _range_indexes(values, range_starts, range_ends)
+        return np.where(address_indexes >= 0, address_indexes + addresses_offset,
+                        np.where(range_indexes >= 0, range_indexes + ranges_offset, -1))
+
+    def contains_many(self, ip_addresses: typing.Sequence[str]) -> np.ndarray:
+        """Returns a boolean array which is True for the contained IP addresses"""
+        return self.entry_indexes(ip_addresses) >= 0
+
+    def entry_string(self, entry_index: int) -> str:
+        """Returns the address or the prefixes of the entry"""
+        if entry_index < self._ipv4_ranges_offset:
+            return str(ipaddress.IPv4Address(int(self.ipv4_addresses[entry_index])))
+        elif entry_index < self._ipv6_addresses_offset:
+            range_index = entry_index - self._ipv4_ranges_offset
+            start = ipaddress.IPv4Address(int(self.ipv4_range_starts[range_index]))
+            end = ipaddress.IPv4Address(int(self.ipv4_range_ends[range_index]))
+        elif entry_index < self._ipv6_ranges_offset:
+            return str(ipaddress.IPv6Address(
+                self.ipv6_addresses[entry_index - self._ipv6_addresses_offset].ljust(16, b'\0')))
+        else:
+            range_index = entry_index - self._ipv6_ranges_offset
+            start = ipaddress.IPv6Address(self.ipv6_range_starts[range_index].ljust(16, b'\0'))
+            end = ipaddress.IPv6Address(self.ipv6_range_ends[range_index].ljust(16, b'\0'))
+
+        return ' '.join(str(network) for network in ipaddress.summarize_address_range(start, end))
+
+    def save(self, directory: str, cache_key: dict=None):
+        """
+        Saves the arrays as .npy files in the directory
+        The meta file is written last, so an interrupted save is not used as cache.
+        """
+        os.makedirs(directory, exist_ok=True)
+        for array_name in ARRAY_NAMES:
+            np.save(os.path.join(directory, array_name + '.npy'), getattr(self, array_name))
+
+        with open(os.path.join(directory, 'meta.json'), 'w') as meta_file:
+            json.dump({'version': CACHE_FORMAT_VERSION, 'key': cache_key,
+                       'invalid_lines': self.invalid_lines}, meta_file)
+
+    @classmethod
+    def load(cls, directory: str, cache_key: dict=None) -> typing.Optional['IpSet']:
+        """
+        Memory maps the arrays of a saved set
+        :returns None if there is no saved set with the same cache_key
+        """
+        try:
+            with open(os.path.join(directory, 'meta.json')) as meta_file:
+                meta = json.load(meta_file)
+            if meta['version'] != CACHE_FORMAT_VERSION or meta['key'] != cache_key:
+                return None
+
+            arrays = []
+            for array_name in ARRAY_NAMES:
+                array_filepath = os.path.join(directory, array_name + '.npy')
+                try:
+                    arrays.append(np.load(array_filepath, mmap_mode='r'))
+                except ValueError:
+                    # empty arrays can not be memory mapped
+                    arrays.append(np.load(array_filepath))
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+        return cls(*arrays, invalid_lines=meta['invalid_lines'])
+
+
+def load_ip_set(filepath: str, use_cache: bool=True) -> IpSet:
+    """
+    Loads the IP addresses and prefixes of the file
+    The set is memory mapped from the cache directory <file>.ipset if it belongs to the same
+    file version. Otherwise the file is parsed and the cache is written.
+    :param filepath: the file with one IP address or CIDR prefix per line
+    :param use_cache: read and write the cache directory
+    """
+    cache_directory = filepath + CACHE_DIRECTORY_ENDING
+    file_stat = os.stat(filepath)
+    cache_key = {'size': file_stat.st_size, 'mtime': file_stat.st_mtime}
+
+    if use_cache:
+        ip_set = IpSet.load(cache_directory, cache_key)
+        if ip_set is not None:
+            return ip_set
+
+    with open(filepath) as ip_file:
+        ip_set = IpSet.from_strings(ip_file)
+
+    if use_cache:
+        try:
+            ip_set.save(cache_directory, cache_key)
+        except OSError:
+            pass
+
+    return ip_set
+
+
+__all__ = ['IpSet',
+           'load_ip_set',
+           'ipv4_values',
+           ]
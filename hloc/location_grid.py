@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+A grid index over the unit sphere for radius queries on locations
+The locations are bucketed by their xyz position on the unit sphere in cubic cells whose edge
+is the chord length of the query radius. All locations within the radius of a point are
+therefore in the 27 cells around the cell of the point. The index only returns candidates,
+the exact distance still has to be checked by the caller.
+"""
+
+import collections
+import math
+import typing
+
+import numpy as np
+
+from hloc import constants
+
+# widens the cells to be safe against rounding differences of the distance functions
+CELL_SIZE_MARGIN = 1e-9
+
+
+def unit_sphere_coordinates(lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """Returns the xyz coordinates on the unit sphere for degree coordinates as (n, 3) array"""
+    lats = np.radians(lats)
+    lons = np.radians(lons)
+    cos_lats = np.cos(lats)
+    return np.stack([cos_lats * np.cos(lons), cos_lats * np.sin(lons), np.sin(lats)], axis=-1)
+
+
+class LocationGrid(object):
+    """Buckets the indexes of locations for radius queries. Locations without coordinates are
+    not indexed"""
+
+    def __init__(self, locations: typing.Sequence, radius: float):
+        """
+        :param locations: objects with lat and lon attributes in degrees
+        :param radius: the query radius in km
+        """
+        angle = min(radius / constants.EARTH_RADIUS, math.pi)
+        self.cell_size = 2 * math.sin(angle / 2) * (1 + CELL_SIZE_MARGIN) + CELL_SIZE_MARGIN
+        self._cells = collections.defaultdict(list)
+
+        indexes = [index for index, location in enumerate(locations)
+                   if location.lat is not None and location.lon is not None]
+        if not indexes:
+            return
+
+        coordinates = unit_sphere_coordinates(
+            np.array([locations[index].lat for index in indexes], dtype=np.float64),
+            np.array([locations[index].lon for index in indexes], dtype=np.float64))
+        cell_keys = np.floor(coordinates / self.cell_size).astype(np.int64).tolist()
+        for index, cell_key in zip(indexes, cell_keys):
+            self._cells[tuple(cell_key)].append(index)
+
+    def candidate_indexes(self, lat: float, lon: float) -> typing.List[int]:
+        """
+        Returns the sorted indexes of all locations which can be within the radius of the
+        point
+        """
+        cell_x, cell_y, cell_z = np.floor(
+            unit_sphere_coordinates(np.float64(lat), np.float64(lon)) / self.cell_size) \
+            .astype(np.int64).tolist()
+
+        candidates = []
+        for offset_x in (-1, 0, 1):
+            for offset_y in (-1, 0, 1):
+                for offset_z in (-1, 0, 1):
+                    cell = self._cells.get((cell_x + offset_x, cell_y + offset_y,
+                                            cell_z + offset_z))
+                    if cell:
+                        candidates.extend(cell)
+
+        candidates.sort()
+        return candidates
+
+
+__all__ = ['LocationGrid',
+           'unit_sphere_coordinates',
+           ]
@@ -8,7 +8,7 @@ from .measurement_result import MeasurementResult, RipeMeasurementResult, \
     CaidaArkMeasurementResult, ZmapMeasurementResult
 from .probe import Probe, RipeAtlasProbe, CaidaArkProbe, ZmapProbe
 from .json_base import JSONBase
-from .domain import Domain, DomainLabel, CodeMatch
+from .domain import Domain, DomainLabel, CodeMatch, DRoPMatch
 from .drop_rule import DRoPRule
 
 
@@ -27,6 +27,7 @@ __all__ = ['MeasurementResult',
            'Domain',
            'DomainLabel',
            'CodeMatch',
+           'DRoPMatch',
            'DRoPRule',
            'DomainType',
            'DomainLocationType',
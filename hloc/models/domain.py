@@ -32,9 +32,16 @@ class CodeMatch(LocationHint):
             self.labels.append(domain_label)
 
 
+class DRoPMatch(CodeMatch):
+    """The model for a Match between a domain name and a location code found by a DRoP rule"""
+
+    __mapper_args__ = {'polymorphic_identity': 'drop_match'}
+
+
 domain_to_label_table = sqla.Table('domain_to_labels', Base.metadata,
                                     sqla.Column('domain_id', sqla.Integer,
-                                                sqla.ForeignKey('domains.id', ondelete='cascade')),
+                                                sqla.ForeignKey('domains.id', ondelete='cascade'),
+                                                index=True),
                                     sqla.Column('domain_label_id', sqla.Integer,
                                                 sqla.ForeignKey('domain_labels.id', ondelete='cascade')))
 
@@ -46,7 +53,7 @@ class DomainLabel(Base):
 
     id = sqla.Column(sqla.Integer, primary_key=True)
     name = sqla.Column(sqla.String(100), unique=True, index=True, nullable=False)
-    last_searched = sqla.Column(sqla.DateTime)
+    last_searched = sqla.Column(sqla.DateTime, index=True)
 
 
     domains = sqlorm.relationship("Domain",
@@ -124,6 +131,25 @@ class Domain(Base):
                     matches.append(match)
         return matches
 
+    @property
+    def drop_matches(self):
+        """Returns the matches of the DRoP rules connected to the domain"""
+        return [hint for hint in self.hints if isinstance(hint, DRoPMatch)]
+
+    @property
+    def all_matches(self):
+        """
+        Returns the label matches and the DRoP matches of the domain
+        DRoP matches of a location which is already matched in a label are left out
+        """
+        matches = self.all_label_matches
+        location_ids = {match.location_id for match in matches}
+        for match in self.drop_matches:
+            if match.location_id not in location_ids:
+                location_ids.add(match.location_id)
+                matches.append(match)
+        return matches
+
     @property
     def possible_matches(self):
         """Returns all matches which are possible (according to measurements)"""
@@ -156,4 +182,5 @@ class Domain(Base):
 __all__ = ['Domain',
            'DomainLabel',
            'CodeMatch',
+           'DRoPMatch',
            ]
@@ -4,12 +4,13 @@
 import math
 
 import hashlib
+import numpy as np
 import sqlalchemy as sqla
 import sqlalchemy.orm as sqlorm
 import string
 from sqlalchemy.dialects import postgresql
 
-from hloc import constants
+from hloc import constants, geo
 from .enums import LocationCodeType, AvailableType
 from .sql_alchemy_base import Base
 
@@ -99,8 +100,8 @@ class Location(Base):
         else:
             raise ValueError('no valid ip version in ip versions list')
 
-        sorted_prbs = sorted(self.probes,
-                             key=lambda probe: self.gps_distance_haversine(probe.location))
+        sorted_prbs = self.sorted_by_distance(self.probes,
+                                              [probe.location for probe in self.probes])
         return [probe for probe in sorted_prbs if probe.available() in ip_versions_needed][:25]
 
     def idfy_location(self):
@@ -110,6 +111,23 @@ class Location(Base):
         """
         self.id = hashlib.md5('{}:{}'.format(self.lat, self.lon).encode()).hexdigest()
 
+    @staticmethod
+    def coordinate_arrays(locations: ['Location']) -> (np.ndarray, np.ndarray):
+        """Returns the latitudes and longitudes of the locations as float arrays"""
+        return np.array([location.lat for location in locations], dtype=np.float64), \
+            np.array([location.lon for location in locations], dtype=np.float64)
+
+    def distances_to(self, locations: ['Location']) -> np.ndarray:
+        """Returns the haversine distances [km] to all locations with one array operation"""
+        return geo.distances_to_point(self.lat, self.lon, *self.coordinate_arrays(locations))
+
+    def sorted_by_distance(self, items: list, locations: ['Location']) -> list:
+        """Sorts the items by the distance of their locations, equal distances keep the order"""
+        if not items:
+            return []
+        order = np.argsort(self.distances_to(locations), kind='stable')
+        return [items[index] for index in order]
+
     def is_in_radius(self, location, radius):
         """Returns a True if the location is within the radius [km] with the haversine method"""
         return self.gps_distance_haversine(location) <= radius
@@ -233,8 +251,8 @@ class LocationInfo(Location):
         else:
             raise ValueError('no valid ip version in ip versions list')
 
-        sorted_prbs = sorted(self.nearby_probes,
-                             key=lambda probe: self.gps_distance_haversine(probe.location))
+        sorted_prbs = self.sorted_by_distance(self.nearby_probes,
+                                              [probe.location for probe in self.nearby_probes])
         return [probe for probe in sorted_prbs if probe.available() in ip_versions_needed][:25]
 
     def add_airport_info(self):
@@ -285,7 +303,8 @@ domain_location_hints_table = sqla.Table('domain_location_hints', Base.metadata,
                                                                      ondelete='cascade')),
                                          sqla.Column('domain_id', sqla.Integer,
                                                      sqla.ForeignKey('domains.id',
-                                                                     ondelete='cascade')))
+                                                                     ondelete='cascade'),
+                                                     index=True))
 
 
 location_hint_label_table = sqla.Table('location_hint_labels', Base.metadata,
@@ -296,7 +315,11 @@ location_hint_label_table = sqla.Table('location_hint_labels', Base.metadata,
                                        sqla.Column('domain_label_id', sqla.Integer,
                                                    sqla.ForeignKey('domain_labels.id',
                                                                    ondelete='cascade'),
-                                                   primary_key=True))
+                                                   primary_key=True, index=True),
+                                       # where the code was found in the label
+                                       sqla.Column('code_offset', sqla.SmallInteger),
+                                       sqla.Column('boundary_flags', sqla.SmallInteger),
+                                       sqla.Column('prior_score', sqla.Float))
 
 
 class LocationHint(Base):
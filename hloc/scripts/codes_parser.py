@@ -17,12 +17,14 @@ import time
 from string import ascii_lowercase, ascii_letters, digits
 from time import sleep
 
+import numpy as np
 import requests
 from html.parser import HTMLParser
 
 from hloc.models import LocationInfo, State
 from hloc.util import setup_logger
 from hloc.db_utils import recreate_db, create_session_for_process, create_engine
+from hloc.location_grid import LocationGrid
 
 logger = None
 engine = None
@@ -493,24 +495,35 @@ def location_merge(location1: LocationInfo, location2: LocationInfo, db_session)
         location1.population = location2.population
 
 
-def merge_locations_to_location(location: LocationInfo, locations: [LocationInfo], radius: int,
+def merge_locations_to_location(location: LocationInfo, locations: [LocationInfo],
+                                location_grid: LocationGrid, merged: np.ndarray, radius: int,
                                 db_session, start: int=0):
-    """Merge all locations from the locations list to the location if they are near enough"""
-    near_locations = []
+    """
+    Merge all locations from the locations list to the location if they are near enough
+    Only the candidates of the location_grid are checked with the haversine distance. The
+    indexes of the merged locations are set in the merged bitmap instead of removing them
+    from the list.
+    """
+    for index in location_grid.candidate_indexes(location.lat, location.lon):
+        if index < start or merged[index]:
+            continue
 
-    for j in range(start, len(locations)):
-        if location.is_in_radius(locations[j], radius):
-            near_locations.append(locations[j])
+        near_location = locations[index]
+        if not location.is_in_radius(near_location, radius):
+            continue
 
-    for mloc in near_locations:
         try:
-            location_merge(location, mloc, db_session)
-            locations.remove(mloc)
-            del mloc
+            location_merge(location, near_location, db_session)
+            merged[index] = True
         except ValueError:
             continue
 
 
+def remove_merged_locations(locations: [LocationInfo], merged: np.ndarray):
+    """Removes the locations flagged in the merged bitmap from the list in place"""
+    locations[:] = [location for location, is_merged in zip(locations, merged) if not is_merged]
+
+
 def add_locations(locations: [LocationInfo], to_add_locations: [LocationInfo], radius: int,
                   db_session, create_new_locations: bool=True):
     """
@@ -524,8 +537,15 @@ def add_locations(locations: [LocationInfo], to_add_locations: [LocationInfo], r
     :param create_new_locations: Set false if the add_locations are not allowed to
         create new location objects Default is true
     """
-    for i, location in enumerate(locations):
-        merge_locations_to_location(location, to_add_locations, radius, db_session)
+    location_grid = LocationGrid(to_add_locations, radius)
+    merged = np.zeros(len(to_add_locations), dtype=bool)
+    for location in locations:
+        if location.lat is None or location.lon is None:
+            continue
+
+        merge_locations_to_location(location, to_add_locations, location_grid, merged, radius,
+                                    db_session)
+    remove_merged_locations(to_add_locations, merged)
 
     if create_new_locations:
         merge_locations_by_gps(to_add_locations, radius, db_session)
@@ -541,17 +561,20 @@ def merge_locations_by_gps(locations: [LocationInfo], radius: int, db_session):
     """
     this method starts at the beginning and matches all locations which are in a
     range of `radius` kilometers
+    The merged locations are removed from the list after all locations were handled
     """
-    i = 0
-    while i < len(locations):
-        location = locations[i]
-        i += 1
+    location_grid = LocationGrid(locations, radius)
+    merged = np.zeros(len(locations), dtype=bool)
+    for i, location in enumerate(locations):
         lat_is_none = location.lat is None
         lon_is_none = location.lon is None
-        if lat_is_none or lon_is_none:
+        if merged[i] or lat_is_none or lon_is_none:
             continue
 
-        merge_locations_to_location(location, locations, radius, db_session, start=i)
+        merge_locations_to_location(location, locations, location_grid, merged, radius,
+                                    db_session, start=i + 1)
+
+    remove_merged_locations(locations, merged)
 
 
 def state_for_code(state_code, state_name):
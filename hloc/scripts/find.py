@@ -12,16 +12,23 @@ import configargparse
 import datetime
 import json
 import multiprocessing as mp
-import queue
 import threading
 import typing
 
-from hloc import util
-from hloc.db_utils import get_all_domain_labels, create_session_for_process, \
-    create_engine
-from hloc.models import CodeMatch, Location, LocationCodeType, DomainLabel, LocationInfo
-from hloc.models.location import location_hint_label_table
-
+from hloc import util, json_util
+from hloc.db_utils import create_session_for_process, create_engine, \
+    location_table_checksum, id_range, stream_domain_labels, stream_domains
+from hloc.chunk_coordinator import ChunkCoordinator, Chunk, CommitMarker, save_committed_chunks
+from hloc.find_helper import trie_artifact
+from hloc.find_helper.code_matcher import CodeMatcher, MatchBatch, BLACKLIST_CODE_TYPE, \
+    create_code_automaton, label_contains_code
+from hloc.find_helper.drop_engine import DRoPRuleEngine
+from hloc.find_helper.match_export import MatchExporter, EXPORT_FORMATS, PARQUET_FORMAT
+from hloc.find_helper.match_writer import LocationHintWriter, ShardedMatchSender, \
+    HintConnection, unpack_matches, LABEL_HINT_CONNECTION, DOMAIN_HINT_CONNECTION
+from hloc.models import Location, LocationCodeType, Domain, DomainLabel, LocationInfo
+
+import sqlalchemy as sqla
 from sqlalchemy import update
 
 logger = None
@@ -32,6 +39,9 @@ def __create_parser_arguments(parser):
     """Creates the arguments for the parser"""
     parser.add_argument('-p', '--number-processes', type=int, default=4,
                         help='specify the number of processes used')
+    parser.add_argument('-w', '--number-writer-processes', type=int, default=1,
+                        help='specify the number of processes writing the location hints. '
+                             'Every writer owns a shard of the location hints')
     parser.add_argument('-c', '--code-blacklist-file', type=str, help='The code blacklist file')
     parser.add_argument('-f', '--word-blacklist-file', type=str, help='The word blacklist file')
     parser.add_argument('-s', '--code-to-location-blacklist-file', type=str,
@@ -41,6 +51,36 @@ def __create_parser_arguments(parser):
                              ' per Process. Default is 0 which means all dns entries')
     parser.add_argument('-n', '--domain-block-limit', type=int, default=1000,
                         help='The number of domains taken per block to process them')
+    parser.add_argument('--chunk-size', type=int, default=10**5,
+                        help='The number of label ids a process takes at once from the '
+                             'coordinator')
+    parser.add_argument('--checkpoint-file', type=str,
+                        help='The file where the finished label id chunks are saved')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip the chunks which are saved as finished in the checkpoint file')
+    parser.add_argument('-b', '--match-block-size', type=int, default=5*10**4,
+                        help='The number of labels searched together in one block')
+    parser.add_argument('-t', '--trie-file', type=str, default='find_trie.marisa',
+                        help='The path of the compiled trie file. The trie is only rebuilt if '
+                             'the location tables or the blacklists changed')
+    parser.add_argument('--build-trie-only', action='store_true',
+                        help='Only build the trie file and do not search for location hints')
+    parser.add_argument('--force-trie-rebuild', action='store_true',
+                        help='Rebuild the trie file even if it is up to date')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='Only search labels which were never searched or searched with an '
+                             'older trie. Of the latter only labels containing a code changed '
+                             'since the previous trie are searched again')
+    parser.add_argument('-r', '--drop-rules-file', type=str,
+                        help='A JSON file with DRoP rules. If set the rules are applied to the '
+                             'domain names instead of searching the codes in the labels')
+    parser.add_argument('-e', '--export-dir', type=str,
+                        help='A directory where the matches are written to one Parquet or Arrow '
+                             'file per label id chunk. Needs pyarrow')
+    parser.add_argument('--export-format', type=str, default=PARQUET_FORMAT,
+                        choices=EXPORT_FORMATS, help='The file format of the exported matches')
+    parser.add_argument('--export-only', action='store_true',
+                        help='Only export the matches and do not write them to the database')
     parser.add_argument('-dbn', '--database-name', type=str, default='hloc-measurements')
     parser.add_argument('-l', '--logging-file', type=str, default='find_trie.log',
                         help='Specify a logging file where the log should be saved')
@@ -56,38 +96,131 @@ def main():
     __create_parser_arguments(parser)
     args = parser.parse_args()
 
+    if args.export_only and not args.export_dir:
+        parser.error('--export-only needs an --export-dir')
+    if args.export_dir and args.drop_rules_file:
+        parser.error('the matches of DRoP rules cannot be exported')
+
     global logger
     logger = util.setup_logger(args.logging_file, 'find', loglevel=args.log_level)
 
     global engine
     engine = create_engine(args.database_name)
 
-    trie = create_trie(args.code_blacklist_file, args.word_blacklist_file)
+    code_to_location_blacklist = load_code_to_location_blacklist(
+        args.code_to_location_blacklist_file)
 
-    code_to_location_blacklist = {}
-    if args.code_to_location_blacklist_file:
-        with open(args.code_to_location_blacklist_file) as code_to_location_blacklist_file:
-            json_txt = ""
-            for line in code_to_location_blacklist_file:
-                line = line.strip()
-                if line[0] != '#':
-                    json_txt += line
-            code_to_location_blacklist = json.loads(json_txt)
+    trie_metadata = build_trie_artifact(args.trie_file, args.code_blacklist_file,
+                                        args.word_blacklist_file,
+                                        args.code_to_location_blacklist_file,
+                                        code_to_location_blacklist,
+                                        force_rebuild=args.force_trie_rebuild)
+
+    if args.build_trie_only:
+        return 0
+
+    # the trie file is memory mapped and the matcher is created before the processes are forked
+    # therefore all processes share the same pages
+    trie = trie_artifact.load_trie_artifact(args.trie_file)
+
+    if args.drop_rules_file:
+        with open(args.drop_rules_file) as drop_rules_file:
+            drop_rule_engine = DRoPRuleEngine(json_util.json_load(drop_rules_file), trie)
+        logger.info('loaded DRoP rules for {} domain suffixes'.format(
+            len(drop_rule_engine.rule_sets)))
+
+        run_search_processes(args, Domain, DOMAIN_HINT_CONNECTION, drop_search_process,
+                             drop_rule_engine, {'amount': args.amount})
+        return 0
+
+    code_matcher = CodeMatcher(trie, code_to_location_blacklist)
+
+    search_kwargs = {'amount': args.amount, 'debug': args.log_level == 'DEBUG',
+                     'match_block_size': args.match_block_size}
+    if args.incremental:
+        search_kwargs.update(incremental_search_kwargs(args.trie_file, trie, trie_metadata))
+
+    if args.export_dir:
+        search_kwargs['export_directory'] = args.export_dir
+        search_kwargs['export_format'] = args.export_format
+
+    run_search_processes(args, DomainLabel, LABEL_HINT_CONNECTION, search_process, code_matcher,
+                         search_kwargs)
+
+    if args.export_only:
+        return 0
+
+    Session = create_session_for_process(engine)
+    db_session = Session()
+    update_query = update(DomainLabel).values(last_searched=datetime.datetime.now())
+    if args.incremental:
+        update_query = update_query.where(
+            sqla.or_(
+                DomainLabel.last_searched.is_(None),
+                DomainLabel.last_searched < search_kwargs['searched_before']
+            ))
+    db_session.execute(update_query)
+    db_session.commit()
+    db_session.close()
+
+
+def run_search_processes(args, model_class, hint_connection: HintConnection,
+                         search_target: typing.Callable, matcher, search_kwargs: typing.Dict):
+    """
+    Starts the writer processes and the search processes and waits until all finished
+    :param args: the parsed arguments
+    :param model_class: DomainLabel or Domain whose ids are handed out to the search processes
+    :param hint_connection: the type of the hints and how they are connected
+    :param search_target: the search process function
+    :param matcher: the CodeMatcher or DRoPRuleEngine passed to the search processes
+    :param search_kwargs: the keyword arguments for the search processes
+    """
+    # without writer processes the search processes do not touch the location hints
+    nr_writer_processes = 0 if args.export_only else args.number_writer_processes
+    # the writers acknowledge the chunks whose matches they committed. A chunk is only saved in
+    # the checkpoint file after all writers acknowledged it
+    acknowledgement_queue = None
+    if nr_writer_processes and args.checkpoint_file:
+        acknowledgement_queue = mp.Queue()
+
+    location_match_queues = []
+    writer_processes = []
+    for shard_index in range(0, nr_writer_processes):
+        location_match_queue = mp.Queue()
+        writer_process = mp.Process(target=handle_location_matches,
+                                    args=(shard_index, nr_writer_processes,
+                                          location_match_queue),
+                                    kwargs={'load_existing_hints': args.incremental,
+                                            'hint_connection': hint_connection,
+                                            'acknowledgement_queue': acknowledgement_queue},
+                                    name='handle_location_matches_{}'.format(shard_index))
+        writer_process.start()
+        location_match_queues.append(location_match_queue)
+        writer_processes.append(writer_process)
+
+    Session = create_session_for_process(engine)
+    db_session = Session()
+    start_id, end_id = id_range(model_class, db_session)
+    db_session.close()
+    Session.remove()
+
+    chunk_coordinator = ChunkCoordinator(start_id, end_id, args.chunk_size,
+                                         checkpoint_filepath=args.checkpoint_file,
+                                         resume=args.resume)
 
-    location_match_queue = mp.Queue()
-    stop_event = threading.Event()
-    handle_location_matches_thread = threading.Thread(target=handle_location_matches,
-                                                      name='handle-location-matches',
-                                                      args=(location_match_queue, stop_event))
-    handle_location_matches_thread.start()
+    checkpoint_thread = None
+    if acknowledgement_queue is not None:
+        checkpoint_thread = threading.Thread(target=save_committed_chunks,
+                                             args=(chunk_coordinator, acknowledgement_queue,
+                                                   nr_writer_processes))
+        checkpoint_thread.start()
 
     processes = []
     for index in range(0, args.number_processes):
-        process = mp.Process(target=search_process,
-                             args=(index, trie, code_to_location_blacklist,
-                                   args.domain_block_limit, args.number_processes,
-                                   location_match_queue),
-                             kwargs={'amount': args.amount, 'debug': args.log_level == 'DEBUG'},
+        process = mp.Process(target=search_target,
+                             args=(chunk_coordinator, matcher, args.domain_block_limit,
+                                   location_match_queues),
+                             kwargs=search_kwargs,
                              name='find_locations_{}'.format(index))
         process.start()
         processes.append(process)
@@ -95,15 +228,104 @@ def main():
     for process in processes:
         process.join()
 
+    for location_match_queue in location_match_queues:
+        location_match_queue.put(None)
+
+    for writer_process in writer_processes:
+        writer_process.join()
+
+    if checkpoint_thread is not None:
+        acknowledgement_queue.put(None)
+        checkpoint_thread.join()
+
+
+def incremental_search_kwargs(trie_filepath: str, trie, trie_metadata) -> typing.Dict:
+    """
+    Creates the arguments for an incremental search_process
+    Labels searched after the trie was built are not loaded. Labels searched after the previous
+    trie was built are only searched again if they contain a code which changed between the
+    previous and the current trie or whose code to location blacklist entry changed. If the
+    changed blacklist entries are unknown all labels searched before the trie was built are
+    searched again.
+    """
+    search_kwargs = {'searched_before': trie_artifact.built_at(trie_metadata)}
+
+    previous_trie_filepath = trie_artifact.previous_artifact_path(trie_filepath)
+    previous_metadata = trie_artifact.read_metadata(previous_trie_filepath)
+    if previous_metadata is not None:
+        previous_trie = trie_artifact.load_trie_artifact(previous_trie_filepath)
+        changed_codes = trie_artifact.changed_codes(previous_trie, trie)
+        changed_blacklist_codes = trie_artifact.changed_blacklist_codes(previous_metadata,
+                                                                        trie_metadata)
+        if changed_blacklist_codes is None:
+            logger.info('the code to location blacklist of the previous trie is unknown, '
+                        'all labels are searched again')
+            return search_kwargs
+
+        changed_codes.update(changed_blacklist_codes)
+        logger.info('{} codes changed since the previous trie'.format(len(changed_codes)))
+
+        search_kwargs['previous_trie_built_at'] = trie_artifact.built_at(previous_metadata)
+        search_kwargs['changed_codes_automaton'] = create_code_automaton(changed_codes)
+
+    return search_kwargs
+
+
+def load_code_to_location_blacklist(code_to_location_blacklist_filepath: str) \
+        -> typing.Dict[str, typing.List[str]]:
+    """
+    Reads the code to location blacklist (JSON with # comment lines)
+    :returns an empty dictionary if no path is set
+    """
+    code_to_location_blacklist = {}
+    if code_to_location_blacklist_filepath:
+        with open(code_to_location_blacklist_filepath) as code_to_location_blacklist_file:
+            json_txt = ""
+            for line in code_to_location_blacklist_file:
+                line = line.strip()
+                if line[0] != '#':
+                    json_txt += line
+            code_to_location_blacklist = json.loads(json_txt)
+    return code_to_location_blacklist
+
+
+def build_trie_artifact(trie_filepath: str, code_blacklist_filepath: str,
+                        word_blacklist_filepath: str, code_to_location_blacklist_filepath: str,
+                        code_to_location_blacklist: typing.Dict[str, typing.List[str]],
+                        force_rebuild: bool=False):
+    """
+    Creates the trie and saves it to the trie file if the location tables or the blacklists
+    changed since the last build
+    :param trie_filepath: the path of the trie file
+    :param code_blacklist_filepath: the path to the code blacklist file
+    :param word_blacklist_filepath: the path to the word blacklist file
+    :param code_to_location_blacklist_filepath: the path to the code to location blacklist file
+    :param code_to_location_blacklist: the content of the code to location blacklist file
+    :param force_rebuild: rebuild the trie even if the saved one is up to date
+    :returns the metadata of the trie file
+    """
     Session = create_session_for_process(engine)
     db_session = Session()
-    update_query = update(DomainLabel).values(last_searched=datetime.datetime.now())
-    db_session.execute(update_query)
-    db_session.close()
+    try:
+        location_checksum = location_table_checksum(db_session)
+    finally:
+        db_session.close()
+        Session.remove()
+
+    current_input_metadata = trie_artifact.input_metadata(location_checksum,
+                                                          code_blacklist_filepath,
+                                                          word_blacklist_filepath,
+                                                          code_to_location_blacklist_filepath)
+    metadata = trie_artifact.read_metadata(trie_filepath)
 
-    stop_event.set()
-    handle_location_matches_thread.join()
-    location_match_queue.join_thread()
+    if not force_rebuild and trie_artifact.is_up_to_date(metadata, current_input_metadata):
+        logger.info('trie file {} is up to date'.format(trie_filepath))
+        return metadata
+
+    logger.info('building trie file {}'.format(trie_filepath))
+    trie = create_trie(code_blacklist_filepath, word_blacklist_filepath)
+    return trie_artifact.save_trie_artifact(trie, trie_filepath, current_input_metadata,
+                                            code_to_location_blacklist)
 
 
 def create_trie(code_blacklist_filepath: str, word_blacklist_filepath: str):
@@ -158,130 +380,100 @@ def create_trie_obj(location_list: [Location], code_blacklist: {str}, word_black
                            len(code_tuple[0]) > 2]
 
     for code in word_blacklist:
-        code_id_type_tuples.append((code, ('0'*32, -1)))
+        code_id_type_tuples.append((code, ('0'*32, BLACKLIST_CODE_TYPE)))
 
     encoded_tuples = [(code, (uid.encode(), code_type))
                       for code, (uid, code_type) in code_id_type_tuples]
 
-    return marisa_trie.RecordTrie('<32sh', encoded_tuples)
-
-
-def handle_location_matches(location_match_queue: mp.Queue, stop_event: threading.Event):
-    class LocationMatch:
-        def __init__(self, location_hint):
-            self.id = 0
-            self.location_hint = location_hint
-            self.location_code = location_hint.code
-            self.location_code_type = location_hint.code_type
-            self.location_id = location_hint.location_id
-            self.domain_label_ids = set()
-            self.old_domain_label_ids = set()
-
-        def get_insert_values(self):
-            return [{'location_hint_id': self.id,
-                     'domain_label_id': domain_label_id}
-                    for domain_label_id in self.domain_label_ids]
-
-        def add_domain_label_id(self, domain_label_id):
-            if domain_label_id not in self.domain_label_ids and \
-                    domain_label_id not in self.old_domain_label_ids:
-                self.domain_label_ids.add(domain_label_id)
-
-        def handled_domains(self):
-            self.old_domain_label_ids = self.old_domain_label_ids.union(self.domain_label_ids)
-            self.domain_label_ids.clear()
-
-        def __hash__(self):
-            return hash(make_location_hint_key(self.location_id, self.location_code,
-                                               self.location_code_type))
+    return marisa_trie.RecordTrie(trie_artifact.TRIE_RECORD_FORMAT, encoded_tuples)
 
-    def make_location_hint_key(location_id, code, code_type):
-        return '{},{},{}'.format(location_id, code, code_type)
 
-    def save(matches_to_save, new_matches, db_sess):
-        if new_matches:
-            db_sess.bulk_save_objects([match.location_hint for match in new_matches],
-                                      return_defaults=True)
-            for new_match in new_matches:
-                new_match.id = new_match.location_hint.id
-
-        insert_values = []
-        for match in matches_to_save:
-            insert_values.extend(match.get_insert_values())
-            match.handled_domains()
+def handle_location_matches(shard_index: int, nr_shards: int, location_match_queue: mp.Queue,
+                            load_existing_hints: bool=False,
+                            hint_connection: HintConnection=LABEL_HINT_CONNECTION,
+                            acknowledgement_queue: typing.Optional[mp.Queue]=None):
+    """
+    Writes the location hints of one shard until None is received from the queue
+    The chunks of the received CommitMarkers are put on the acknowledgement_queue after the
+    next commit of the writer
+    """
+    Session = create_session_for_process(engine)
+    db_session = Session()
 
-        new_matches.clear()
-        matches_to_save.clear()
+    received_chunks = []
 
-        if insert_values:
-            insert_expr = location_hint_label_table.insert().values(insert_values)
-            db_sess.execute(insert_expr)
+    def acknowledge_chunks():
+        if acknowledgement_queue is not None:
+            for chunk in received_chunks:
+                acknowledgement_queue.put(chunk)
+        received_chunks.clear()
 
-    Session = create_session_for_process(engine)
-    db_session = Session()
+    location_hint_writer = LocationHintWriter(db_session, hint_connection=hint_connection,
+                                              on_commit=acknowledge_chunks)
 
-    new_matches = []
-    matches_to_save = set()
-    location_hints = {}
-    counter = 0
-    ccounter = 0
+    if load_existing_hints:
+        location_hint_writer.load_existing_hints(shard_index, nr_shards)
+        logger.info('loaded {} existing location hints'.format(
+            len(location_hint_writer.location_hints)))
 
-    while not (stop_event.is_set() and location_match_queue.empty()):
-        try:
-            location_matches_tuples = location_match_queue.get(timeout=1)
-            if isinstance(location_matches_tuples, int):
-                delete_expr = location_hint_label_table.delete().where(
-                    'location_hint_labels.domain_label_id' == location_matches_tuples)
-                db_session.execute(delete_expr)
-                logger.debug('saving for {}'.format(location_matches_tuples))
-            else:
-                for location_id, location_code, location_code_type, domain_label_id in \
-                        location_matches_tuples:
-                    location_hint_key = make_location_hint_key(location_id, location_code,
-                                                               location_code_type)
-                    try:
-                        location_hint = location_hints[location_hint_key]
-                    except KeyError:
-                        real_code_type = LocationCodeType(location_code_type)
-                        location_hint_obj = CodeMatch(location_id, code_type=real_code_type,
-                                                      domain_label=None, code=location_code)
-                        db_session.add(location_hint_obj)
-                        location_hint = LocationMatch(location_hint_obj)
-                        location_hints[location_hint_key] = location_hint
-                        new_matches.append(location_hint)
-
-                    matches_to_save.add(location_hint)
-                    location_hint.add_domain_label_id(domain_label_id)
-
-                    counter += 1
-                    if counter >= 10 ** 4:
-                        logger.debug('saving')
-                        save(matches_to_save, new_matches, db_session)
-                        counter = 0
-
-                        ccounter += 1
-                        if ccounter >= 10:
-                            db_session.commit()
-                            ccounter = 0
-
-        except queue.Empty:
-            pass
-
-    save(matches_to_save, new_matches, db_session)
-    db_session.commit()
+    while True:
+        packed_matches = location_match_queue.get()
+        if packed_matches is None:
+            break
+        if isinstance(packed_matches, CommitMarker):
+            received_chunks.append(packed_matches.item)
+            continue
+
+        for location_id, location_code, location_code_type, connected_id, *match_metadata in \
+                unpack_matches(packed_matches):
+            location_hint_writer.add_match(location_id, location_code, location_code_type,
+                                           connected_id, tuple(match_metadata))
+
+    location_hint_writer.close()
+    if acknowledgement_queue is not None:
+        acknowledgement_queue.close()
     db_session.close()
     Session.remove()
-    location_match_queue.close()
     logger.info('stopped')
 
 
-def search_process(index, trie, code_to_location_blacklist, limit, nr_processes,
-                   location_match_queue, amount=1000, debug: bool=False):
+def search_process(chunk_coordinator: ChunkCoordinator, code_matcher: CodeMatcher, limit: int,
+                   location_match_queues: typing.List[mp.Queue], amount=1000, debug: bool=False,
+                   match_block_size: int=5*10**4,
+                   searched_before: datetime.datetime=None,
+                   previous_trie_built_at: datetime.datetime=None,
+                   changed_codes_automaton=None,
+                   export_directory: str=None, export_format: str=PARQUET_FORMAT):
     """
+    Searches the labels of the chunks handed out by the coordinator until none is left
+    A chunk is saved as finished after all writers committed its matches (see CommitMarker).
+    Without writers it is saved as finished after its matches were exported
     for all amount=0
+    If searched_before is set only labels never searched or searched before are loaded
+    (incremental mode). Of these labels the ones searched after previous_trie_built_at are only
+    searched again if they contain a code of the changed_codes_automaton
+    The labels are searched in blocks of match_block_size labels with match_labels
+    If export_directory is set the matches of every chunk are also written to a file of the
+    export_format. Only completely searched chunks are exported. A chunk file contains the
+    matches of all labels of the chunk: labels which are up to date in the database (searched
+    recently or unchanged in incremental mode) are searched and exported as well but their hints
+    are not reset or sent to the database. Without location_match_queues the matches are only
+    exported and labels searched recently are searched anyway because the database
+    (last_searched) is not updated
     """
     Session = create_session_for_process(engine)
     db_session = Session()
+    # the labels are streamed with a server side cursor which would be closed by the commits
+    # of the match sender. Therefore the sender uses its own session
+    sender_db_session = Session.session_factory()
+
+    match_sender = None
+    if location_match_queues:
+        match_sender = ShardedMatchSender(location_match_queues, sender_db_session)
+
+    match_exporter = None
+    if export_directory:
+        match_exporter = MatchExporter(export_directory, file_format=export_format)
 
     match_count = collections.defaultdict(int)
     entries_count = 0
@@ -290,47 +482,122 @@ def search_process(index, trie, code_to_location_blacklist, limit, nr_processes,
     label_wl_count = 0
     label_length = 0
 
-    if debug:
-        last_search = datetime.datetime.now() - datetime.timedelta(minutes=1)
-    else:
-        last_search = datetime.datetime.now() - datetime.timedelta(days=7)
-
-    for domain_label in get_all_domain_labels(index,
-                                              block_limit=limit,
-                                              nr_processes=nr_processes,
-                                              db_session=db_session):
-        label_count += 1
-        label_length += len(domain_label.name)
-
-        if domain_label.last_searched:
-            if domain_label.last_searched > last_search:
-                if domain_label.hints:
+    # labels searched recently are skipped only if the matches are written to the database
+    last_search = None
+    if match_sender is not None:
+        if debug:
+            last_search = datetime.datetime.now() - datetime.timedelta(minutes=1)
+        else:
+            last_search = datetime.datetime.now() - datetime.timedelta(days=7)
+
+    block_label_ids = []
+    block_names = []
+    # labels which are up to date in the database but searched anyway to export complete chunks
+    export_block_label_ids = []
+    export_block_names = []
+
+    def search_block():
+        nonlocal label_wl_count
+        match_batch = match_labels(block_names, code_matcher)
+
+        for code_type, count in match_batch.code_type_counts().items():
+            match_count[LocationCodeType(code_type)] += count
+        label_wl_count += match_batch.matched_label_count()
+
+        if match_sender is not None:
+            match_sender.add_batch(block_label_ids, block_names, match_batch)
+        if match_exporter is not None:
+            match_exporter.write_batch(block_label_ids, block_names, match_batch)
+        block_label_ids.clear()
+        block_names.clear()
+
+    def search_export_block():
+        match_batch = match_labels(export_block_names, code_matcher)
+        match_exporter.write_batch(export_block_label_ids, export_block_names, match_batch)
+        export_block_label_ids.clear()
+        export_block_names.clear()
+
+    def is_up_to_date(last_searched: typing.Optional[datetime.datetime], label_name: str) \
+            -> bool:
+        """:returns True if the hints of the label in the database need no new search"""
+        if not last_searched:
+            return False
+        if searched_before:
+            if last_searched >= searched_before:
+                return True
+            return bool(previous_trie_built_at) and last_searched >= previous_trie_built_at and \
+                not label_contains_code(changed_codes_automaton, label_name)
+        return last_search is not None and last_searched > last_search
+
+    def search_chunk(chunk: Chunk) -> bool:
+        """:returns False if the amount of entries is reached"""
+        nonlocal label_count, label_length, label_wl_count, entries_count
+        # the exported chunk files contain all labels of a chunk. The up to date labels are
+        # therefore loaded, searched and exported as well but not sent to the database
+        domain_labels = stream_domain_labels(
+            chunk[0], chunk[1], block_limit=limit, db_session=db_session,
+            searched_before=searched_before if match_exporter is None else None)
+
+        for label_id, label_name, last_searched, has_hints in domain_labels:
+            label_count += 1
+            label_length += len(label_name)
+
+            if is_up_to_date(last_searched, label_name):
+                if has_hints and not searched_before:
                     label_wl_count += 1
 
+                if match_exporter is not None:
+                    export_block_label_ids.append(label_id)
+                    export_block_names.append(label_name)
+                    if len(export_block_names) >= match_block_size:
+                        search_export_block()
                 continue
-            else:
-                location_match_queue.put(domain_label.id)
 
-        pm_count = collections.defaultdict(int)
+            if last_searched and match_sender is not None:
+                match_sender.reset(label_id)
 
-        temp_gr_count = search_in_label(domain_label, trie, code_to_location_blacklist,
-                                        location_match_queue)
+            block_label_ids.append(label_id)
+            block_names.append(label_name)
+            if len(block_names) >= match_block_size:
+                search_block()
 
-        for key, value in temp_gr_count.items():
-            match_count[key] += value
-            pm_count[key] += value
+            entries_count += 1
 
-        if temp_gr_count:
-            label_wl_count += 1
+            if entries_count == amount:
+                return False
 
-        entries_count += 1
+        return True
 
-        if entries_count == amount:
-            break
+    for chunk in chunk_coordinator.iter_chunks():
+        if match_exporter is not None:
+            match_exporter.start_chunk(chunk)
+
+        try:
+            chunk_searched = search_chunk(chunk)
+
+            if block_names:
+                search_block()
+            if export_block_names:
+                search_export_block()
+        except BaseException:
+            if match_exporter is not None:
+                match_exporter.abort_chunk()
+            raise
+
+        if match_exporter is not None:
+            if chunk_searched:
+                match_exporter.finish_chunk()
+            else:
+                match_exporter.abort_chunk()
 
-        if entries_count == amount:
+        if not chunk_searched:
             break
 
+        if match_sender is not None:
+            match_sender.send_commit_marker(chunk)
+        else:
+            chunk_coordinator.chunk_finished(chunk)
+
     def build_stat_string_for_logger():
         """
         Builds a string for the final output
@@ -346,58 +613,99 @@ def search_process(index, trie, code_to_location_blacklist, limit, nr_processes,
         stats_string += '\n\tmatch count:\n\t\t{}'.format(match_count)
         return stats_string
 
+    if match_sender is not None:
+        match_sender.close()
+
     logger.info(build_stat_string_for_logger())
 
+    sender_db_session.close()
     db_session.close()
     Session.remove()
-    location_match_queue.close()
 
 
-def search_in_label(label_obj: DomainLabel, trie: marisa_trie.RecordTrie, special_filter,
-                    location_match_queue: mp.Queue) \
-        -> typing.DefaultDict[LocationCodeType, int]:
-    """returns all matches for this label"""
-    ids = set()
-    type_count = collections.defaultdict(int)
+def drop_search_process(chunk_coordinator: ChunkCoordinator, drop_rule_engine: DRoPRuleEngine,
+                        limit: int, location_match_queues: typing.List[mp.Queue], amount=0):
+    """
+    Applies the DRoP rules to the valid domains of the chunks handed out by the coordinator
+    The old DRoP hints of every searched domain are replaced
+    A chunk is saved as finished after all writers committed its matches (see CommitMarker)
+    for all amount=0
+    """
+    Session = create_session_for_process(engine)
+    db_session = Session()
+    sender_db_session = Session.session_factory()
+
+    match_sender = ShardedMatchSender(location_match_queues, sender_db_session,
+                                      hint_connection=DOMAIN_HINT_CONNECTION)
+
+    match_count = collections.defaultdict(int)
+    entries_count = 0
+    domain_wl_count = 0
+
+    def search_chunk(chunk: Chunk) -> bool:
+        """:returns False if the amount of entries is reached"""
+        nonlocal entries_count, domain_wl_count
+        for domain_id, domain_name in stream_domains(chunk[0], chunk[1], block_limit=limit,
+                                                     db_session=db_session):
+            match_sender.reset(domain_id)
 
-    location_hint_tuples = []
+            location_code_tuples = drop_rule_engine.search(domain_name)
+            for _, _, code_type in location_code_tuples:
+                match_count[LocationCodeType(code_type)] += 1
+            if location_code_tuples:
+                domain_wl_count += 1
 
-    for o_label in label_obj.sub_labels:
-        label = o_label[:]
-        blacklisted = []
+            match_sender.add_matches(domain_id, location_code_tuples)
 
-        while label:
-            matching_keys = trie.prefixes(label)
-            matching_keys.sort(key=len, reverse=True)
+            entries_count += 1
+            if entries_count == amount:
+                return False
 
-            for key in matching_keys:
-                if [black_word for black_word in blacklisted if key in black_word]:
-                    continue
+        return True
 
-                if key in special_filter and \
-                        [black_word for black_word in special_filter[key]
-                         if black_word in o_label]:
-                    continue
+    for chunk in chunk_coordinator.iter_chunks():
+        if not search_chunk(chunk):
+            break
 
-                matching_locations = trie[key]
-                if [code_type for _, code_type in matching_locations if code_type == -1]:
-                    blacklisted.append(key)
-                    continue
+        match_sender.send_commit_marker(chunk)
 
-                for location_id, code_type in matching_locations:
-                    real_code_type = LocationCodeType(code_type)
-                    if location_id in ids:
-                        continue
+    match_sender.close()
 
-                    location_hint_tuples.append((location_id.decode(), key, code_type,
-                                                 label_obj.id))
-                    type_count[real_code_type] += 1
+    logger.info('Stats for this process following:'
+                '\n\ttotal domains: {}'
+                '\n\tdomains with location found: {}'
+                '\n\tmatches: {}'
+                '\n\tmatch count:\n\t\t{}'.format(entries_count, domain_wl_count,
+                                                sum(match_count.values()), match_count))
 
-            label = label[1:]
+    sender_db_session.close()
+    db_session.close()
+    Session.remove()
 
-    location_match_queue.put(location_hint_tuples)
 
-    return type_count
+def match_labels(names: typing.Sequence[str], code_matcher: CodeMatcher) -> MatchBatch:
+    """
+    Searches for location codes in a block of label names
+    :param names: the label names
+    :param code_matcher: the CodeMatcher used for the names
+    :returns the matches of all names as MatchBatch
+    """
+    label_indexes = []
+    location_ids = []
+    code_types = []
+    code_offsets = []
+    code_lengths = []
+
+    for label_index, name in enumerate(names):
+        for location_id, code, code_type, code_offset in code_matcher.search_with_offsets(name):
+            label_indexes.append(label_index)
+            location_ids.append(location_id)
+            code_types.append(code_type)
+            code_offsets.append(code_offset)
+            code_lengths.append(len(code))
+
+    return MatchBatch.from_match_lists(label_indexes, location_ids, code_types, code_offsets,
+                                       code_lengths)
 
 
 if __name__ == '__main__':
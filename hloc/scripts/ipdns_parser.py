@@ -5,32 +5,53 @@ sanitizing and classification of the domain names
  Merge into ipdns_parser -- important: give alarm if target IP not found in IP2DNS file
 """
 import collections
+import ipaddress
+import itertools
 import json
 import multiprocessing as mp
-import threading
 import time
 import typing
 import os
-import queue
 
 import configargparse
+import sqlalchemy as sqla
 
 import hloc.constants as constants
 from hloc import util
-from hloc.db_utils import recreate_db, create_session_for_process, create_engine
-from hloc.models import Domain, DomainType, DomainLabel
+from hloc.chunk_coordinator import ChunkCoordinator
+from hloc.db_utils import recreate_db, create_session_for_process, create_engine, \
+    reserve_sequence_ids, copy_rows, LabelIdCache
+from hloc.models import Domain, DomainType
 from hloc.domain_processing_helper.domain_name_preprocessing import RegexStrategy, \
     preprocess_domains
+from hloc.domain_processing_helper.file_chunks import FileChunk, FileChunkReader, file_chunks, \
+    iter_file_lines, input_filepaths
+from hloc.domain_processing_helper.rdns_diff import ExternalSorter, IpDiff, diff_by_ip, pair_line
+from hloc.domain_processing_helper.whitelist_coverage import WhitelistCoverage
+from hloc.ip_set import IpSet, load_ip_set
 from hloc.models.domain import domain_to_label_table
 
 logger = None
 engine = None
-BLOCK_SIZE = 10
+DOMAIN_COLUMNS = ['id', 'name', 'ipv4_address', 'ipv6_address', 'classification_type']
+DOMAIN_TO_LABEL_COLUMNS = ['domain_id', 'domain_label_id']
+# the maximum number of label ids cached per process
+LABEL_ID_CACHE_SIZE = 10**6
+PROGRESS_COUNTER_NAMES = ['lines', 'domains', 'bytes', 'chunks']
+# marks checkpoint lines with the committed lines of an unfinished chunk
+PARTIAL_CHUNK_PREFIX = 'lines:'
+# a chunk of one of the input files: (index of the file, file chunk)
+InputChunk = typing.Tuple[int, FileChunk]
+# a chunk in the checkpoint file: (file path, byte offset, byte length)
+CheckpointChunk = typing.Tuple[str, int, int]
 
 
 def __create_parser_arguments(parser):
     """Creates the arguments for the parser"""
-    parser.add_argument('filepath', type=str, help='The path to the rDNS file to parse')
+    parser.add_argument('filepaths', type=str, nargs='+',
+                        help='The rDNS files to parse. Directories and glob patterns are '
+                             'expanded to their files. The files can be compressed with gzip, '
+                             'bz2 or xz')
     parser.add_argument('-p', '--number-processes', type=int, default=4,
                         help='specify the number of processes used')
     parser.add_argument('-t', '--tlds-file', type=str, required=True,
@@ -40,14 +61,46 @@ def __create_parser_arguments(parser):
     parser.add_argument('-s', '--regex-strategy', type=str, choices=RegexStrategy.all_values(),
                         default=RegexStrategy.abstract.value, help='Specify a regex Strategy')
     parser.add_argument('-f', '--white-list-file-path', type=str,
-                        help='path to a file with a white list of IPs')
+                        help='path to a file with a white list of IPs and CIDR prefixes. A '
+                             'compact copy is cached in <file>.ipset')
     parser.add_argument('-d', '--database-recreate', action='store_true',
                         help='Recreates the database structure. Attention deletes all data!')
-    parser.add_argument('-b', '--buffer-lines-per-process', type=int, default=1000,
-                        help='Number of lines buffered for each process')
+    parser.add_argument('-b', '--buffer-lines-per-process', type=int, default=10**4,
+                        help='Number of lines classified and written together with one COPY')
+    parser.add_argument('--commit-lines', type=int, default=10**6,
+                        help='Number of lines of a file chunk written in one transaction. '
+                             'Large chunks (e.g. compressed files with one member) are '
+                             'committed in several parts')
+    parser.add_argument('--file-chunk-size', type=int, default=32 * 2**20,
+                        help='The number of bytes of the file a process reads at once. '
+                             'Compressed files are only split between compression members')
+    parser.add_argument('--checkpoint-file', type=str,
+                        help='The file where the file path, byte offset and length of every '
+                             'committed file chunk and the committed lines of partially '
+                             'written chunks are saved')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip the file chunks and lines which are saved as committed in '
+                             'the checkpoint file')
+    parser.add_argument('--diff-previous-file', type=str,
+                        help='Only apply the differences between this previous rDNS snapshot '
+                             'and the files to the database. Can be a directory or a glob '
+                             'pattern')
+    parser.add_argument('--diff-database', action='store_true',
+                        help='Only apply the differences between the domains table and the '
+                             'files to the database')
+    parser.add_argument('--diff-run-size', type=int, default=10**6,
+                        help='The number of lines sorted in memory for a diff')
+    parser.add_argument('--diff-temp-dir', type=str,
+                        help='The directory for the temporary files of a diff. Defaults to the '
+                             'system temp directory')
+    parser.add_argument('--progress-interval', type=float, default=60,
+                        help='The number of seconds between two progress reports')
     parser.add_argument('-dbn', '--database-name', type=str, default='hloc-measurements')
     parser.add_argument('-l', '--logging-file', type=str, default='preprocess.log',
                         help='Specify a logging file where the log should be saved')
+    parser.add_argument('--stats-directory', type=str,
+                        help='The directory for the character and label statistics of the '
+                             'processes. Defaults to the directory of the logging file')
     parser.add_argument('-ll', '--log-level', type=str, default='INFO', dest='log_level',
                         choices=['NOTSET', 'DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
                         help='Set the preferred log level')
@@ -61,6 +114,20 @@ def main():
     __create_parser_arguments(parser)
     args = parser.parse_args()
 
+    if args.resume and not args.checkpoint_file:
+        parser.error('--resume needs a --checkpoint-file')
+    if args.resume and args.database_recreate:
+        parser.error('--resume can not be used with --database-recreate')
+    diff_mode = args.diff_previous_file or args.diff_database
+    if args.diff_previous_file and args.diff_database:
+        parser.error('--diff-previous-file and --diff-database can not be used together')
+    if diff_mode and (args.checkpoint_file or args.database_recreate):
+        parser.error('a diff can not be used with --checkpoint-file or --database-recreate')
+
+    filepaths = input_filepaths(args.filepaths)
+    if not filepaths:
+        parser.error('no rDNS files found for {}'.format(', '.join(args.filepaths)))
+
     start = time.time()
 
     global logger
@@ -88,50 +155,95 @@ def main():
             if line[0] != '#':
                 tlds.add(line.lower())
 
-    whitelist = set()
+    whitelist = None
     if args.white_list_file_path:
-        with open(args.white_list_file_path) as filter_list_file:
-            for line in filter_list_file:
-                whitelist.add(line.strip())
-    else:
-        whitelist = None
+        whitelist = load_ip_set(args.white_list_file_path)
+        logger.info('loaded {} whitelist entries, {} invalid lines'.format(
+            len(whitelist), whitelist.invalid_lines))
+
+    if diff_mode:
+        Session = create_session_for_process(engine)
+        db_session = Session()
+        label_session = Session.session_factory()
+        try:
+            stats = apply_rdns_diff(args, filepaths, regex_strategy, tlds, whitelist,
+                                    db_session, label_session)
+        finally:
+            label_session.close()
+            db_session.close()
+            Session.remove()
+        logger.info('diff applied: {}'.format(dict(stats)))
+        logger.info('Running time: {0}'.format((time.time() - start)))
+        return
+
+    # the statistics must not be written next to the input files, a directory given as input
+    # would contain them in the next run
+    stats_directory = args.stats_directory or \
+        os.path.dirname(os.path.abspath(args.logging_file))
+    os.makedirs(stats_directory, exist_ok=True)
 
     processes = []
-    parsed_ips = set()
-    parsed_ips_lock = mp.Lock()
-
-    finished_reading_event = mp.Event()
-
-    line_queue = mp.Queue(args.number_processes * args.buffer_lines_per_process)
-    line_thread = threading.Thread(target=read_file,
-                                   args=(args.filepath, line_queue, finished_reading_event),
-                                   name='file-reader')
-    line_thread.start()
-    time.sleep(1)
+    whitelist_coverage = WhitelistCoverage(whitelist) if whitelist is not None else None
+
+    # the processes only get the index of a chunk and read it from the file on their own
+    chunks = []
+    for file_index, filepath in enumerate(filepaths):
+        file_chunk_list = file_chunks(filepath, args.file_chunk_size)
+        logger.info('split {} into {} chunks'.format(filepath, len(file_chunk_list)))
+        chunks.extend((file_index, chunk) for chunk in file_chunk_list)
+    # the largest chunks (e.g. compressed files with only one member) are handed out first so
+    # they do not delay the end of the run
+    chunks.sort(key=lambda input_chunk: (-input_chunk[1][1], input_chunk))
+
+    finished_chunk_indexes = set()
+    committed_chunk_lines = {}
+    if args.checkpoint_file:
+        if args.resume:
+            committed_chunks, committed_chunk_lines = read_checkpoint(args.checkpoint_file)
+            checkpoint_chunks = [(filepaths[file_index],) + chunk for file_index, chunk in chunks]
+            finished_chunk_indexes = {index for index, checkpoint_chunk
+                                      in enumerate(checkpoint_chunks)
+                                      if checkpoint_chunk in committed_chunks}
+            if len(finished_chunk_indexes) != len(committed_chunks) or \
+                    not set(committed_chunk_lines).issubset(checkpoint_chunks):
+                logger.error('the checkpoint file contains chunks which are not chunks of the '
+                             'input files. Was a file or the --file-chunk-size changed?')
+                return
+            logger.info('skipping {} committed chunks and the committed lines of {} partially '
+                        'written chunks'.format(len(finished_chunk_indexes),
+                                                len(committed_chunk_lines)))
+        else:
+            open(args.checkpoint_file, 'w').close()
 
-    stop_event = threading.Event()
-    domain_label_queue = mp.Queue()
-    domain_label_handle_thread = threading.Thread(target=handle_labels,
-                                                  args=(domain_label_queue, stop_event),
-                                                  name='domain-label-handler')
-    domain_label_handle_thread.start()
+    # the coordinator works on chunk indexes and the checkpoint file is written with the byte
+    # offsets of the chunks by the processes
+    chunk_coordinator = ChunkCoordinator(0, len(chunks), 1,
+                                         finished_chunks=[(index, index + 1)
+                                                          for index in finished_chunk_indexes])
+    checkpoint_lock = mp.Lock()
+    progress_counters = util.SharedCounters(PROGRESS_COUNTER_NAMES)
 
     for i in range(0, args.number_processes):
         process = mp.Process(target=preprocess_file_part,
-                             args=(args.filepath, i, line_queue, args.isp_ip_filter, regex_strategy,
-                                   tlds, whitelist, parsed_ips, parsed_ips_lock, domain_label_queue,
-                                   finished_reading_event),
+                             args=(filepaths, i, chunks, chunk_coordinator,
+                                   args.isp_ip_filter, regex_strategy, tlds, whitelist,
+                                   whitelist_coverage, args.buffer_lines_per_process,
+                                   args.commit_lines, args.checkpoint_file,
+                                   committed_chunk_lines, checkpoint_lock,
+                                   progress_counters, stats_directory),
                              name='preprocessing_{}'.format(i))
         processes.append(process)
         process.start()
 
-    line_thread.join()
-
+    total_bytes = sum(chunk[1] for index, (_, chunk) in enumerate(chunks)
+                      if index not in finished_chunk_indexes)
     alive = len(processes)
     while alive > 0:
         try:
-            for process in processes:
-                process.join()
+            alive_processes = [process for process in processes if process.is_alive()]
+            if alive_processes:
+                alive_processes[0].join(args.progress_interval)
+            log_progress(progress_counters, total_bytes, time.time() - start)
             process_sts = [pro.is_alive() for pro in processes]
             if process_sts.count(True) != alive:
                 logger.debug('{} processes alive'.format(process_sts.count(True)))
@@ -139,128 +251,55 @@ def main():
         except KeyboardInterrupt:
             pass
 
-    stop_event.set()
-    domain_label_handle_thread.join()
-    domain_label_queue.join_thread()
-
-    line_queue.close()
-    line_queue.join_thread()
-
-    whitelisted_not_parsed_as_correct = set(parsed_ips) - parsed_ips
-
-    if whitelisted_not_parsed_as_correct:
-        ips_missing = ',\n'.join(whitelisted_not_parsed_as_correct)
-        logger.warning('IP addresses in whitelist but not parsed: \n{}'.format(ips_missing))
+    if whitelist_coverage is not None:
+        if finished_chunk_indexes:
+            logger.info('the whitelist coverage only contains the chunks parsed in this run')
+        ips_missing = whitelist_coverage.missing_ips()
+        if ips_missing:
+            logger.warning('{} IP addresses in whitelist but not parsed: \n{}'.format(
+                len(ips_missing), ',\n'.join(ips_missing)))
 
     end = time.time()
     logger.info('Running time: {0}'.format((end - start)))
 
 
-def read_file(filepath: str, line_queue: mp.Queue, finished_reading_event: mp.Event):
-    with open(filepath, encoding='ISO-8859-1') as rdns_file_handle:
-        for line in rdns_file_handle:
-            try:
-                line_queue.put(line)
-            except queue.Full:
-                time.sleep(0.5)
-
-    finished_reading_event.set()
-
-
-# @util.cprofile('handle.profile')
-def handle_labels(labels_queue: mp.Queue, stop_event: threading.Event):
-    """Handels the label results and saves them to the database not blocking the other db queries"""
-
-    class DomainLabelHolder:
-        def __init__(self, label):
-            self.label = label
-            self.label_id = 0
-            self.domain_ids = set()
-            self._handled_domain_ids = set()
-
-        def add_domain_id(self, domain_id):
-            if domain_id not in self.domain_ids and domain_id not in self._handled_domain_ids:
-                self.domain_ids.add(domain_id)
-
-        def get_insert_values(self):
-            values = [{'domain_id': domain_id, 'domain_label_id': self.label_id}
-                      for domain_id in self.domain_ids]
-            return values
+def log_progress(progress_counters: util.SharedCounters, total_bytes: int, running_time: float):
+    """Logs the progress and the throughput of all processes since the start"""
+    progress = progress_counters.values()
+    running_time = max(running_time, 1e-9)
+    logger.info('progress: {} chunks, {:.1%} of the bytes, {} lines ({:.0f} lines/s), {} domains '
+                '({:.0f} domains/s)'.format(progress['chunks'],
+                                            progress['bytes'] / total_bytes if total_bytes else 1,
+                                            progress['lines'], progress['lines'] / running_time,
+                                            progress['domains'],
+                                            progress['domains'] / running_time))
 
-        def handled_domain_ids(self):
-            self._handled_domain_ids = self._handled_domain_ids.union(self.domain_ids)
-            self.domain_ids.clear()
 
-        def __hash__(self):
-            return hash(self.label)
-
-    def save_labels(domain_labels_dct, labels_to_save, new_labels, db_sess):
-        if new_labels:
-            db_sess.bulk_save_objects([label.label for label in new_labels], return_defaults=True)
-            for label_obj in new_labels:
-                label_obj.label_id = label_obj.label.id
-
-        values_to_insert = []
-        for label_obj in labels_to_save:
-            if label_obj.domain_ids:
-                values_to_insert.extend(label_obj.get_insert_values())
-                label_obj.handled_domain_ids()
-
-        insert_expr = domain_to_label_table.insert().values(values_to_insert)
-        new_labels.clear()
-        labels_to_save.clear()
-        db_sess.execute(insert_expr)
-
-    Session = create_session_for_process(engine)
-    db_session = Session()
-
-    new_labels = []
-    labels_to_save = set()
-    domain_labels = {}
-    counter = 0
-    ccounter = 0
-
-    while not stop_event.is_set() or not labels_queue.empty():
-        try:
-            domain_label_tuples = labels_queue.get(timeout=1)
-            for label_name, domain_id in domain_label_tuples:
-                try:
-                    label = domain_labels[label_name]
-                except KeyError:
-                    label_obj = DomainLabel(label_name)
-                    label = DomainLabelHolder(label_obj)
-                    domain_labels[label_name] = label
-                    new_labels.append(label)
-
-                labels_to_save.add(label)
-                label.add_domain_id(domain_id)
-
-                counter += 1
-                if counter >= 10**4:
-                    save_labels(domain_labels, labels_to_save, new_labels, db_session)
-                    counter = 0
-                    ccounter +=1
-
-                    if ccounter >= 10:
-                        db_session.commit()
-                        ccounter = 0
-
-        except queue.Empty:
-            pass
-
-    save_labels(domain_labels, labels_to_save, new_labels, db_session)
-    db_session.commit()
-    logger.info('stopped')
-    labels_queue.close()
-
-
-def preprocess_file_part(filepath: str, pnr: int, line_queue: mp.Queue,
+def preprocess_file_part(filepaths: typing.List[str], pnr: int,
+                         chunks: typing.List[InputChunk],
+                         chunk_coordinator: ChunkCoordinator,
                          ip_encoding_filter: bool, regex_strategy: RegexStrategy,
-                         tlds: typing.Set[str], whitelist: typing.Set[str],
-                         parsed_ips: typing.Set[str], parsed_ips_lock: mp.Lock,
-                         domain_label_queue: mp.Queue, finished_reading_event: mp.Event):
+                         tlds: typing.Set[str], whitelist: typing.Optional[IpSet],
+                         whitelist_coverage: typing.Optional[WhitelistCoverage],
+                         block_size: int, commit_lines: int,
+                         checkpoint_filepath: typing.Optional[str],
+                         committed_chunk_lines: typing.Dict[CheckpointChunk, int],
+                         checkpoint_lock: mp.Lock, progress_counters: util.SharedCounters,
+                         stats_directory: str):
     """
-    Sanitize filepart from start to end
+    Reads the file chunks whose indexes are handed out by the chunk_coordinator
+    The chunks of all input files are handed out together, so the processes work on several
+    files at the same time. A process opens a reader for every file it reads.
+    The lines of a chunk are streamed and classified and saved in blocks of block_size lines.
+    A transaction is committed after every commit_lines lines and at the end of a chunk. After
+    every commit the number of committed lines of the chunk or the finished chunk is saved in
+    the checkpoint file. A resumed run skips the committed_chunk_lines of partially written
+    chunks and has to redo at most commit_lines lines of every process. New labels are committed in
+    short separate transactions (see LabelIdCache) so the processes do not wait on or deadlock
+    over the labels inserted by the uncommitted chunks of other processes.
+    The numbers of read lines and saved domains are added to the progress_counters and the
+    parsed whitelisted IPs are marked in the whitelist_coverage. The statistics of the process
+    are written to the stats_directory.
     pnr is a number to recognize the process
     ipregex should be a regex with 4 integers to filter the Isp client domain names
     """
@@ -269,133 +308,343 @@ def preprocess_file_part(filepath: str, pnr: int, line_queue: mp.Queue,
 
     Session = create_session_for_process(engine)
     db_session = Session()
+    label_session = Session.session_factory()
+    chunk_readers = {}
     try:
         bad_characters = collections.defaultdict(int)
         count_good_lines = 0
         count_isp_lines = 0
-
-        while not finished_reading_event.is_set() or not line_queue.empty():
-            try:
-                line = line_queue.get(timeout=2)
-            except queue.Empty:
-                time.sleep(1)
-                continue
-
-            if len(line) == 0:
-                continue
-            line = line.strip()
-            ip, domain = line.split(',', 1)
-
-            if not domain:
-                logger.info('Warning found empty domain for IP {} skipping'.format(ip))
-                continue
-
-            if ':' in ip:
-                ip_version = constants.IPV6_IDENTIFIER
-            else:
-                ip_version = constants.IPV4_IDENTIFIER
-
-            with parsed_ips_lock:
-                parsed_ips.add(ip)
-
-            n_good_lines_count, n_ip_lines_count = classify_domain(
-                ip, domain, ip_version, ip_encoding_filter, regex_strategy, tlds,
-                whitelist, db_session, domain_label_queue)
-            count_good_lines += n_good_lines_count
-            count_isp_lines += n_ip_lines_count
+        label_id_cache = LabelIdCache(LABEL_ID_CACHE_SIZE, label_session=label_session)
+
+        for chunk_index, _ in chunk_coordinator.iter_chunks():
+            file_index, chunk = chunks[chunk_index]
+            if file_index not in chunk_readers:
+                chunk_readers[file_index] = FileChunkReader(filepaths[file_index])
+            checkpoint_chunk = (filepaths[file_index],) + chunk
+            skip_lines = committed_chunk_lines.get(checkpoint_chunk, 0)
+            committed_lines = skip_lines
+            read_lines = 0
+
+            for lines in chunk_readers[file_index].iter_line_blocks(chunk, block_size):
+                read_lines += len(lines)
+                if read_lines <= skip_lines:
+                    continue
+                if read_lines - len(lines) < skip_lines:
+                    lines = lines[len(lines) - (read_lines - skip_lines):]
+
+                ip_domain_tuples = parse_lines(lines)
+
+                if whitelist_coverage is not None:
+                    whitelist_coverage.add_parsed(ip for ip, _ in ip_domain_tuples)
+
+                domain_rows, n_good_lines_count, n_ip_lines_count = classify_domains(
+                    ip_domain_tuples, ip_encoding_filter, regex_strategy, tlds, whitelist)
+                count_good_lines += n_good_lines_count
+                count_isp_lines += n_ip_lines_count
+
+                save_domains(domain_rows, label_id_cache, db_session)
+                progress_counters.add(lines=len(lines), domains=len(domain_rows))
+
+                if read_lines - committed_lines >= commit_lines:
+                    db_session.commit()
+                    committed_lines = read_lines
+                    if checkpoint_filepath:
+                        save_committed_lines(checkpoint_filepath, checkpoint_chunk,
+                                             committed_lines, checkpoint_lock)
 
             db_session.commit()
-        else:
-            logger.info('finished no more lines')
+            progress_counters.add(bytes=chunk[1], chunks=1)
+            if checkpoint_filepath:
+                save_committed_chunk(checkpoint_filepath, filepaths[file_index], chunk,
+                                     checkpoint_lock)
 
-        directory = os.path.dirname(filepath)
-        filename = util.get_path_filename(filepath)
+        logger.info('finished no more lines')
+        logger.info('label id cache hits: {} misses: {}'.format(label_id_cache.hits,
+                                                                 label_id_cache.misses))
+
+        filename = util.get_path_filename(filepaths[0])
 
         logger.info('good lines: {} ips lines: {}'.format(count_good_lines, count_isp_lines))
-        with open(os.path.join(directory, '{0}-{1}-character.stats'.format(filename, pnr)),
+        with open(os.path.join(stats_directory, '{0}-{1}-character.stats'.format(filename, pnr)),
                   'w', encoding='utf-8') as characterStatsFile:
             json.dump(bad_characters, characterStatsFile)
 
-        with open(os.path.join(directory, '{0}-{1}-domain-label.stats'.format(filename, pnr)),
+        with open(os.path.join(stats_directory,
+                               '{0}-{1}-domain-label.stats'.format(filename, pnr)),
                   'w', encoding='utf-8') as labelStatFile:
             json.dump(label_stats, labelStatFile)
     finally:
+        for chunk_reader in chunk_readers.values():
+            chunk_reader.close()
+        label_session.close()
         db_session.close()
         Session.remove()
-        domain_label_queue.close()
 
 
-def classify_domain(ip: str, domain: str, ip_version: str, ip_encoding_filter: bool,
-                    regex_strategy: RegexStrategy, tlds: typing.Set[str],
-                    whitelist: typing.Set[str], db_session,
-                    domain_labels_queue: mp.Queue) -> (int, int):
-    is_ipv6 = ip_version == constants.IPV6_IDENTIFIER
+def apply_rdns_diff(args, filepaths: typing.List[str], regex_strategy: RegexStrategy,
+                    tlds: typing.Set[str], whitelist: typing.Optional[IpSet], db_session,
+                    label_session) -> typing.Counter[str]:
+    """
+    Sorts the old and the new snapshot externally and applies only their differences
+    The old snapshot is either the previous rDNS file or the domains table. Removed pairs are
+    deleted from domains (their label connections are deleted by the cascade) and added pairs
+    are classified and saved like in a full import. The differences are written in blocks of
+    --buffer-lines-per-process pairs, each in one transaction. New labels are committed
+    separately on the label_session.
+    :returns the counts of the added, removed and changed IPs and domains
+    """
+    with ExternalSorter(args.diff_run_size, args.diff_temp_dir) as old_sorter, \
+            ExternalSorter(args.diff_run_size, args.diff_temp_dir) as new_sorter:
+        if args.diff_previous_file:
+            previous_filepaths = input_filepaths([args.diff_previous_file])
+            if not previous_filepaths:
+                raise FileNotFoundError(args.diff_previous_file)
+            for filepath in previous_filepaths:
+                old_sorter.extend(snapshot_pair_lines(filepath, args.buffer_lines_per_process))
+        else:
+            old_sorter.extend(database_pair_lines(db_session))
+            db_session.commit()
+        for filepath in filepaths:
+            new_sorter.extend(snapshot_pair_lines(filepath, args.buffer_lines_per_process))
+        logger.info('sorted both snapshots')
 
-    (good_lines, bad_lines, bad_tld_lines, ip_encoded_lines, custom_filter_lines,
-     bad_characters_part) = preprocess_domains([(ip, domain)], tlds, whitelist,
-                                               ip_version, regex_strategy,
-                                               ip_encoding_filter)
+        return write_rdns_diff(diff_by_ip(old_sorter.sorted_lines(), new_sorter.sorted_lines()),
+                               args.isp_ip_filter, regex_strategy, tlds, whitelist,
+                               args.buffer_lines_per_process, db_session, label_session)
 
-    domain = None
 
-    if good_lines:
-        ip_address, domain_address = good_lines[0]
-        if is_ipv6:
-            domain = Domain(domain_address, ipv6_address=ip_address)
+def write_rdns_diff(ip_diffs: typing.Iterable[IpDiff], ip_encoding_filter: bool,
+                    regex_strategy: RegexStrategy, tlds: typing.Set[str],
+                    whitelist: typing.Optional[IpSet], block_size: int, db_session,
+                    label_session) -> typing.Counter[str]:
+    """Deletes the removed and saves the added (ip, domain) pairs in blocks of block_size"""
+    stats = collections.Counter()
+    label_id_cache = LabelIdCache(LABEL_ID_CACHE_SIZE, label_session=label_session)
+    removed_tuples = []
+    added_tuples = []
+
+    def write_block():
+        delete_domains(removed_tuples, db_session)
+        domain_rows, _, _ = classify_domains(added_tuples, ip_encoding_filter, regex_strategy,
+                                             tlds, whitelist)
+        save_domains(domain_rows, label_id_cache, db_session)
+        db_session.commit()
+        removed_tuples.clear()
+        added_tuples.clear()
+
+    for ip_address, removed_names, added_names in ip_diffs:
+        if removed_names and added_names:
+            stats['changed ips'] += 1
+        elif added_names:
+            stats['added ips'] += 1
         else:
-            domain = Domain(domain_address, ipv4_address=ip_address)
+            stats['removed ips'] += 1
+        stats['removed domains'] += len(removed_names)
+        stats['added domains'] += len(added_names)
 
-        domain.classification_type = DomainType.valid
+        removed_tuples.extend((ip_address, domain) for domain in removed_names)
+        added_tuples.extend((ip_address, domain) for domain in added_names)
+        if len(removed_tuples) + len(added_tuples) >= block_size:
+            write_block()
 
-    if bad_lines:
-        ip_address, domain_address = bad_lines[0]
-        if is_ipv6:
-            domain = Domain(domain_address, ipv6_address=ip_address)
-        else:
-            domain = Domain(domain_address, ipv4_address=ip_address)
+    write_block()
+    return stats
 
-        domain.classification_type = DomainType.invalid_characters
 
-    if bad_tld_lines:
-        ip_address, domain_address = bad_tld_lines[0]
-        if is_ipv6:
-            domain = Domain(domain_address, ipv6_address=ip_address)
-        else:
-            domain = Domain(domain_address, ipv4_address=ip_address)
+def snapshot_pair_lines(filepath: str, block_size: int) -> typing.Generator[str, None, None]:
+    """Yields the pair lines of a rDNS file with normalized IPv6 addresses"""
+    lines = iter_file_lines(filepath)
+    while True:
+        block = list(itertools.islice(lines, block_size))
+        if not block:
+            break
 
-        domain.classification_type = DomainType.bad_tld
+        for ip_address, domain in parse_lines(block):
+            yield pair_line(normalized_ip_address(ip_address), domain)
 
-    if ip_encoded_lines:
-        ip_address, domain_address = ip_encoded_lines[0]
-        if is_ipv6:
-            domain = Domain(domain_address, ipv6_address=ip_address)
-        else:
-            domain = Domain(domain_address, ipv4_address=ip_address)
 
-        domain.classification_type = DomainType.ip_encoded
+def database_pair_lines(db_session) -> typing.Generator[str, None, None]:
+    """Yields the pair lines of all domains streamed with a server side cursor"""
+    result = db_session.connection(execution_options={'stream_results': True}).execute(
+        sqla.text('SELECT host(coalesce(ipv4_address, ipv6_address)), name FROM domains'))
+    for ip_address, domain in result:
+        yield pair_line(ip_address, domain)
 
-    if custom_filter_lines:
-        ip_address, domain_address = custom_filter_lines[0]
-        if is_ipv6:
-            domain = Domain(domain_address, ipv6_address=ip_address)
-        else:
-            domain = Domain(domain_address, ipv4_address=ip_address)
 
-        domain.classification_type = DomainType.blacklisted
+def normalized_ip_address(ip_address: str) -> str:
+    """Returns IPv6 addresses in the compressed form postgres uses for the output of inet"""
+    if ':' not in ip_address:
+        return ip_address
+
+    try:
+        return str(ipaddress.ip_address(ip_address))
+    except ValueError:
+        return ip_address
+
+
+def delete_domains(ip_domain_tuples: typing.List[typing.Tuple[str, str]], db_session):
+    """
+    Deletes the domains of the (ip, domain) tuples
+    Their rows in domain_to_labels and domain_location_hints are deleted by the cascades, which
+    look them up with the indexes on domain_id
+    """
+    if not ip_domain_tuples:
+        return
+
+    db_session.execute(
+        sqla.text('DELETE FROM domains USING unnest(CAST(:ips AS inet[]), '
+                  'CAST(:names AS varchar[])) AS removed(ip, name) '
+                  'WHERE domains.name = removed.name AND '
+                  '(domains.ipv4_address = removed.ip OR domains.ipv6_address = removed.ip)'),
+        {'ips': [ip_address for ip_address, _ in ip_domain_tuples],
+         'names': [domain for _, domain in ip_domain_tuples]})
+
+
+def read_checkpoint(checkpoint_filepath: str) \
+        -> typing.Tuple[typing.Set[CheckpointChunk], typing.Dict[CheckpointChunk, int]]:
+    """
+    Reads the committed chunks and the committed lines of partially written chunks
+    :returns the finished chunks and the number of committed lines for every unfinished chunk
+    """
+    committed_chunks = set()
+    committed_chunk_lines = {}
+    try:
+        with open(checkpoint_filepath, encoding='utf-8') as checkpoint_file:
+            for line in checkpoint_file:
+                line = line.rstrip('\n')
+                if not line:
+                    continue
+                if line.startswith(PARTIAL_CHUNK_PREFIX):
+                    lines, offset, length, filepath = \
+                        line[len(PARTIAL_CHUNK_PREFIX):].split(',', 3)
+                    checkpoint_chunk = (filepath, int(offset), int(length))
+                    committed_chunk_lines[checkpoint_chunk] = max(
+                        int(lines), committed_chunk_lines.get(checkpoint_chunk, 0))
+                else:
+                    offset, length, filepath = line.split(',', 2)
+                    committed_chunks.add((filepath, int(offset), int(length)))
+    except FileNotFoundError:
+        pass
+
+    for checkpoint_chunk in committed_chunks:
+        committed_chunk_lines.pop(checkpoint_chunk, None)
+    return committed_chunks, committed_chunk_lines
+
+
+def save_committed_chunk(checkpoint_filepath: str, filepath: str, chunk: FileChunk,
+                         checkpoint_lock: mp.Lock):
+    """Appends the byte offset, length and file of the committed chunk to the checkpoint file"""
+    _append_checkpoint_line(checkpoint_filepath,
+                            '{},{},{}'.format(chunk[0], chunk[1], filepath), checkpoint_lock)
+
+
+def save_committed_lines(checkpoint_filepath: str, checkpoint_chunk: CheckpointChunk,
+                         committed_lines: int, checkpoint_lock: mp.Lock):
+    """Appends the number of committed lines of an unfinished chunk to the checkpoint file"""
+    filepath, offset, length = checkpoint_chunk
+    _append_checkpoint_line(checkpoint_filepath,
+                            '{}{},{},{},{}'.format(PARTIAL_CHUNK_PREFIX, committed_lines,
+                                                   offset, length, filepath),
+                            checkpoint_lock)
+
+
+def _append_checkpoint_line(checkpoint_filepath: str, line: str, checkpoint_lock: mp.Lock):
+    with checkpoint_lock:
+        with open(checkpoint_filepath, 'a', encoding='utf-8') as checkpoint_file:
+            checkpoint_file.write(line + '\n')
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+
+
+def parse_lines(lines: typing.List[str]) -> typing.List[typing.Tuple[str, str]]:
+    """Splits the lines into (ip, domain) tuples and skips lines without a domain"""
+    ip_domain_tuples = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        ip, _, domain = line.partition(',')
+        if not domain:
+            logger.info('Warning found empty domain for IP {} skipping'.format(ip))
+            continue
+
+        ip_domain_tuples.append((ip, domain))
+    return ip_domain_tuples
+
+
+def classify_domains(ip_domain_tuples: typing.List[typing.Tuple[str, str]],
+                     ip_encoding_filter: bool, regex_strategy: RegexStrategy,
+                     tlds: typing.Set[str], whitelist: typing.Optional[IpSet]) \
+        -> typing.Tuple[typing.List[tuple], int, int]:
+    """
+    Classifies a block of (ip, domain) tuples
+    :returns the (name, ipv4_address, ipv6_address, classification_type) rows of the domains,
+        the number of valid domains and the number of ip encoded domains
+    """
+    domain_rows = []
+    count_good_lines = 0
+    count_isp_lines = 0
+
+    for ip_version in [constants.IPV4_IDENTIFIER, constants.IPV6_IDENTIFIER]:
+        is_ipv6 = ip_version == constants.IPV6_IDENTIFIER
+        version_tuples = [(ip, domain) for ip, domain in ip_domain_tuples
+                          if (':' in ip) == is_ipv6]
+        if not version_tuples:
+            continue
+
+        (good_lines, bad_lines, bad_tld_lines, ip_encoded_lines, custom_filter_lines,
+         _) = preprocess_domains(version_tuples, tlds, whitelist, ip_version, regex_strategy,
+                                 ip_encoding_filter)
+        count_good_lines += len(good_lines)
+        count_isp_lines += len(ip_encoded_lines)
+
+        for lines, domain_type in [(good_lines, DomainType.valid),
+                                   (bad_lines, DomainType.invalid_characters),
+                                   (bad_tld_lines, DomainType.bad_tld),
+                                   (ip_encoded_lines, DomainType.ip_encoded),
+                                   (custom_filter_lines, DomainType.blacklisted)]:
+            for ip_address, domain_address in lines:
+                if is_ipv6:
+                    domain_rows.append((domain_address, None, ip_address, domain_type.name))
+                else:
+                    domain_rows.append((domain_address, ip_address, None, domain_type.name))
+
+    return domain_rows, count_good_lines, count_isp_lines
+
+
+def save_domains(domain_rows: typing.List[tuple], label_id_cache: LabelIdCache, db_session):
+    """
+    Writes the domains and their label connections with COPY
+    The domain ids are reserved from the sequence so the connections can be written without
+    reading the inserted domains back
+    :param domain_rows: the rows returned by classify_domains
+    :param label_id_cache: the cache used to look up and insert the label ids
+    :param db_session: a data base session on which the queries are executed
+    """
+    if not domain_rows:
+        return
+
+    domain_ids = reserve_sequence_ids(Domain.__table__, len(domain_rows), db_session)
+    copy_rows(Domain.__table__, DOMAIN_COLUMNS,
+              ((domain_id,) + domain_row for domain_id, domain_row in zip(domain_ids, domain_rows)),
+              db_session)
 
-    db_session.add(domain)
-    db_session.commit()
-    domain_label_tuples = get_domain_label_tuples(domain)
-    domain_labels_queue.put(domain_label_tuples)
+    domain_label_names = [get_domain_label_names(domain_row[0]) for domain_row in domain_rows]
+    label_ids = label_id_cache.ids_for_names(
+        (label_name for label_names in domain_label_names for label_name in label_names),
+        db_session)
 
-    return len(good_lines), len(ip_encoded_lines)
+    copy_rows(domain_to_label_table, DOMAIN_TO_LABEL_COLUMNS,
+              ((domain_id, label_ids[label_name])
+               for domain_id, label_names in zip(domain_ids, domain_label_names)
+               for label_name in label_names),
+              db_session)
 
 
-def get_domain_label_tuples(domain: Domain):
-    domain_labels = set()
-    for label in domain.name.split('.')[:-2]:
-        domain_labels.add((label, domain.id))
-    return domain_labels
+def get_domain_label_names(domain_name: str) -> typing.Set[str]:
+    """Returns the labels of the domain name without the second and top level domain"""
+    return set(domain_name.split('.')[:-2])
 
 
 if __name__ == '__main__':
@@ -9,6 +9,7 @@ import argparse
 import collections
 import datetime
 import enum
+import itertools
 import multiprocessing as mp
 import operator
 import queue
@@ -18,10 +19,13 @@ import threading
 import typing
 from sqlalchemy.exc import InvalidRequestError
 
-from hloc import util, constants
-from hloc.db_utils import get_measurements_for_domain, get_all_domains_splitted_efficient, \
-    create_session_for_process, create_engine, get_domains_for_ips
+from hloc import util, constants, geo
+from hloc.chunk_coordinator import ChunkCoordinator, ChunkProgress, CommitMarker
+from hloc.db_utils import get_measurements_for_domain, id_range, domains_for_ids, \
+    create_session_for_process, create_engine, get_domains_for_ips, domain_hint_prior_scores, \
+    get_domains_in_id_range, stream_domain_ips
 from hloc.exceptions import ProbeError, ServerError
+from hloc.ip_set import IpSet, load_ip_set
 from hloc.models import *
 from hloc.models.location import probe_location_info_table
 from hloc.ripe_helper.basics_helper import get_measurement_ids
@@ -107,6 +111,19 @@ The measurement strategy:
                              'closed')
     parser.add_argument('--random-domains', action='store_true',
                         help='Select the domains to measure randomly')
+    parser.add_argument('--chunk-size', type=int, default=10**4,
+                        help='The number of domain ids a process takes at once')
+    parser.add_argument('--checkpoint-file', type=str,
+                        help='The file where the finished domain id chunks are saved. '
+                             'Can not be used with --endless-measurements')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip the chunks which are saved as finished in the checkpoint file')
+    parser.add_argument('--min-prior-score', type=float,
+                        help='Skip the location hints whose best prior score in the labels of the '
+                             'domain (computed by find) is below this value. Hints without a '
+                             'score are always checked')
+    parser.add_argument('--max-hints-per-domain', type=int,
+                        help='Only check the location hints with the best prior scores')
     parser.add_argument('--debug', action='store_true', help='Use only one process and one thread')
     parser.add_argument('-l', '--log-file', type=str, default='check_locations.log',
                         help='Specify a logging file where the log should be saved')
@@ -115,9 +132,9 @@ The measurement strategy:
                         help='Set the preferred log level')
     parser.add_argument('-dbn', '--database-name', type=str, default='hloc-measurements')
     parser.add_argument('--ip-filter-file', type=str,
-                        help='The file with the IPs which should be validated. '
-                             'Only IPs which also have a domain entry in the database are '
-                             'considered')
+                        help='The file with the IPs and CIDR prefixes which should be '
+                             'validated. Only IPs which also have a domain entry in the database '
+                             'are considered. A compact copy is cached in <file>.ipset')
 
 
 def main():
@@ -126,6 +143,9 @@ def main():
     __create_parser_arguments(parser)
     args = parser.parse_args()
 
+    if args.checkpoint_file and args.endless_measurements:
+        parser.error('--checkpoint-file can not be used with --endless-measurements')
+
     global engine
     engine = create_engine(args.database_name)
 
@@ -182,13 +202,15 @@ def main():
         for location in locations:
             if location.nearby_probes:
                 location_to_probes_dct[location.id] = []
-                for probe in location.nearby_probes:
+                probe_distances = location.distances_to(
+                    [probe.location for probe in location.nearby_probes])
+                for probe, distance in zip(location.nearby_probes, probe_distances.tolist()):
                     probes.add(probe)
                     _ = str(probe.location.lat + probe.location.lon) + probe.location.id + \
                         str(probe.second_hop_latency) + probe.probe_id + str(probe.id)
                     location_to_probes_dct[location.id].append((
                         probe,
-                        location.gps_distance_haversine(probe.location),
+                        distance,
                         probe.location
                     ))
             else:
@@ -219,15 +241,25 @@ def main():
     if args.debug:
         process_count = 1
 
+    ip_filter = None
     if args.ip_filter_file:
-        ip_set = set()
-        with open(args.ip_filter_file) as ip_filter_file:
-            for line in ip_filter_file:
-                ip_set.add(line.strip())
-
-        ips = list(ip_set)
+        ip_filter = load_ip_set(args.ip_filter_file)
+        logger.info('loaded {} IP filter entries, {} invalid lines'.format(
+            len(ip_filter), ip_filter.invalid_lines))
+
+    if ip_filter is not None and not ip_filter.has_prefixes:
+        # address lists are joined with the indexed address columns by the database
+        ips = [ip_filter.entry_string(entry_index) for entry_index in range(len(ip_filter))]
+        ip_filter = None
+        chunk_coordinator = None
     else:
+        # prefixes are applied to the addresses of the domains of the id chunks
         ips = None
+        start_id, end_id = id_range(Domain, db_session)
+        chunk_coordinator = ChunkCoordinator(start_id, end_id, args.chunk_size,
+                                             checkpoint_filepath=args.checkpoint_file,
+                                             resume=args.resume,
+                                             cyclic=args.endless_measurements)
 
     db_session.close()
 
@@ -254,7 +286,7 @@ def main():
                                    args.allowed_measurement_age,
                                    args.api_key,
                                    args.domain_block_limit,
-                                   process_count,
+                                   chunk_coordinator,
                                    args.include_ip_encoded,
                                    measurement_strategy,
                                    args.probes_per_measurement,
@@ -265,7 +297,10 @@ def main():
                                    args.stop_without_old_results,
                                    ips_for_process,
                                    args.endless_measurements,
-                                   args.random_domains),
+                                   args.random_domains,
+                                   args.min_prior_score,
+                                   args.max_hints_per_domain,
+                                   ip_filter),
                              name='domain_checking_{}'.format(pid))
 
         processes.append(process)
@@ -320,7 +355,7 @@ def ripe_check_process(pid: int,
                        allowed_measurement_age: int,
                        api_key: str,
                        domain_block_limit: int,
-                       nr_processes: int,
+                       chunk_coordinator: typing.Optional[ChunkCoordinator],
                        include_ip_encoded: bool,
                        measurement_strategy: MeasurementStrategy,
                        number_of_probes_per_measurement: int,
@@ -332,8 +367,17 @@ def ripe_check_process(pid: int,
                        stop_without_old_results: bool,
                        ip_list: typing.List[str],
                        endless_measurements: bool,
-                       random_domains: bool):
-    """Checks for all domains if the suspected locations are correct"""
+                       random_domains: bool,
+                       min_prior_score: typing.Optional[float]=None,
+                       max_hints_per_domain: typing.Optional[int]=None,
+                       ip_filter: typing.Optional[IpSet]=None):
+    """
+    Checks for all domains if the suspected locations are correct
+    The domains are taken in chunks from the chunk_coordinator if no ip_list is given. If an
+    ip_filter is given only the domains of the chunks with a contained IP are checked
+    The location hints of a domain are checked in the order of the prior scores of the
+    domain's own label matches
+    """
     correct_type_count = collections.defaultdict(int)
 
     domain_type_count = collections.defaultdict(int)
@@ -354,24 +398,39 @@ def ripe_check_process(pid: int,
     if include_ip_encoded:
         domain_types.append(DomainType.ip_encoded)
 
+    chunk_progress = None
+    if not ip_list:
+        chunk_progress = ChunkProgress(chunk_coordinator)
+
     measurement_results_queue = queue.Queue()
     stop_event = threading.Event()
     save_measurements_thread = threading.Thread(target=measurement_results_saver,
-                                                args=(measurement_results_queue, stop_event))
+                                                args=(measurement_results_queue, stop_event,
+                                                      chunk_progress))
     save_measurements_thread.start()
 
+    def chunk_domains() -> typing.Generator[Domain, None, None]:
+        for chunk in chunk_coordinator.iter_chunks():
+            if ip_filter is None:
+                domains = get_domains_in_id_range(chunk[0], chunk[1], domain_block_limit,
+                                                  domain_types, db_session,
+                                                  use_random_order=random_domains)
+            else:
+                domains = filtered_domains_in_id_range(chunk[0], chunk[1], domain_block_limit,
+                                                       domain_types, ip_filter, db_session,
+                                                       use_random_order=random_domains)
+            for chunk_domain in domains:
+                chunk_progress.started(chunk_domain.id)
+                yield chunk_domain
+
+            chunk_progress.all_started(chunk)
+
     try:
         if ip_list:
             domain_generator = get_domains_for_ips(ip_list, db_session, domain_block_limit,
                                                    endless_mode=endless_measurements)
         else:
-            domain_generator = get_all_domains_splitted_efficient(pid,
-                                                                  domain_block_limit,
-                                                                  nr_processes,
-                                                                  domain_types,
-                                                                  db_session,
-                                                                  use_random_order=random_domains,
-                                                                  endless_mode=endless_measurements)
+            domain_generator = chunk_domains()
 
         generator_lock = threading.Lock()
 
@@ -379,7 +438,7 @@ def ripe_check_process(pid: int,
             try:
                 with generator_lock:
                     domain = domain_generator.__next__()
-                    location_hints = domain.all_label_matches
+                    location_hints = domain.all_matches
                     location_hint_tuples = []
 
                     for location_hint in location_hints:
@@ -395,6 +454,12 @@ def ripe_check_process(pid: int,
                             except InvalidRequestError:
                                 pass
 
+                    location_hint_tuples = order_location_hints(
+                        location_hint_tuples,
+                        domain_hint_prior_scores(domain.id, db_session),
+                        min_prior_score,
+                        max_hints_per_domain)
+
                     loc_ip_version = constants.IPV4_IDENTIFIER if domain.ipv4_address else \
                         constants.IPV6_IDENTIFIER
 
@@ -441,7 +506,8 @@ def ripe_check_process(pid: int,
                                             use_efficient_probes,
                                             location_to_probes_dct,
                                             measurement_results_queue,
-                                            stop_without_old_results))
+                                            stop_without_old_results,
+                                            chunk_progress))
 
             threads.append(thread)
             thread.start()
@@ -467,29 +533,113 @@ def ripe_check_process(pid: int,
     logger.info('correct_count {}'.format(correct_type_count))
 
 
-def measurement_results_saver(measurement_results_queue: queue.Queue, stop_event: threading.Event):
+def order_location_hints(location_hint_tuples: typing.List[typing.Tuple[CodeMatch, LocationInfo]],
+                         prior_scores: typing.Dict[str, float],
+                         min_prior_score: typing.Optional[float]=None,
+                         max_hints: typing.Optional[int]=None) \
+        -> typing.List[typing.Tuple[CodeMatch, LocationInfo]]:
+    """
+    Sorts the location hints by the prior scores of the domain, the best first
+    Hints without a prior score keep their order after the scored ones and are never pruned by
+    min_prior_score
+    :param prior_scores: the best prior score of the domain's label matches per location id
+        (see domain_hint_prior_scores)
+    :param min_prior_score: the hints with a lower prior score are removed
+    :param max_hints: the maximum number of returned hints
+    """
+    def prior_score(hint_tuple):
+        return prior_scores.get(hint_tuple[0].location_id)
+
+    if min_prior_score is not None:
+        location_hint_tuples = [hint_tuple for hint_tuple in location_hint_tuples
+                                if prior_score(hint_tuple) is None or
+                                prior_score(hint_tuple) >= min_prior_score]
+
+    location_hint_tuples.sort(key=lambda hint_tuple: (prior_score(hint_tuple) is None,
+                                                      -(prior_score(hint_tuple) or 0)))
+
+    if max_hints is not None:
+        del location_hint_tuples[max_hints:]
+
+    return location_hint_tuples
+
+
+def filtered_domains_in_id_range(start_id: int, end_id: int, block_limit: int,
+                                 domain_types: typing.List[DomainType], ip_filter: IpSet,
+                                 db_session, use_random_order: bool=False) \
+        -> typing.Generator[Domain, None, None]:
+    """
+    Yields the domains in [start_id, end_id) with an IPv4 or IPv6 address in the filter
+    Only the ids and addresses are streamed. They are checked in blocks of block_limit domains
+    with one contains_many call per address family and only the contained domains are loaded.
+    """
+    domain_ips = stream_domain_ips(start_id, end_id, block_limit, db_session,
+                                   domain_types=domain_types)
+    while True:
+        block = list(itertools.islice(domain_ips, block_limit))
+        if not block:
+            break
+
+        domain_ids, ipv4_addresses, ipv6_addresses = zip(*block)
+        contained = \
+            ip_filter.contains_many([ip_address or '' for ip_address in ipv4_addresses]) | \
+            ip_filter.contains_many([ip_address or '' for ip_address in ipv6_addresses])
+        contained_ids = [domain_id for domain_id, is_contained in zip(domain_ids, contained)
+                         if is_contained]
+        if not contained_ids:
+            continue
+
+        if use_random_order:
+            random.shuffle(contained_ids)
+        domains = {domain.id: domain for domain in domains_for_ids(contained_ids, db_session)}
+        for domain_id in contained_ids:
+            if domain_id in domains:
+                yield domains[domain_id]
+
+
+def measurement_results_saver(measurement_results_queue: queue.Queue, stop_event: threading.Event,
+                              chunk_progress: typing.Optional[ChunkProgress]=None):
+    """
+    Saves the measurement results of the queue in batches
+    The queue also contains a CommitMarker with the id of every checked domain after its
+    results. The domains are marked as done in the chunk_progress after the next commit, so a
+    chunk is only saved as finished when the results of all its domains are committed. If the
+    queue is idle the received results are committed to not delay the checkpoint.
+    """
     Session = create_session_for_process(engine)
     db_session = Session()
 
     results = []
+    checked_domain_ids = []
     count_results = 0
 
+    def commit_results():
+        db_session.bulk_save_objects(results)
+        db_session.commit()
+        results.clear()
+
+        if chunk_progress is not None:
+            for domain_id in checked_domain_ids:
+                chunk_progress.done(domain_id)
+        checked_domain_ids.clear()
+
     while not stop_event.is_set() or not measurement_results_queue.empty():
         try:
             measurement_result = measurement_results_queue.get(timeout=5)
+            if isinstance(measurement_result, CommitMarker):
+                checked_domain_ids.append(measurement_result.item)
+                continue
+
             results.append(measurement_result)
             count_results += 1
 
             if count_results % 10**5 == 0:
-                db_session.bulk_save_objects(results)
-                db_session.commit()
-
-                results.clear()
+                commit_results()
         except queue.Empty:
-            pass
+            if checked_domain_ids:
+                commit_results()
 
-    db_session.bulk_save_objects(results)
-    db_session.commit()
+    commit_results()
 
     db_session.close()
     Session.remove()
@@ -520,8 +670,13 @@ def domain_check_threading_manage(next_domain_info: typing.Callable[
                                   location_to_probes_dct: typing.Dict[
                                       str, typing.Tuple[RipeAtlasProbe, float, Location]],
                                   measurement_results_queue: queue.Queue,
-                                  stop_without_old_results: bool):
-    """The method called to create a thread and manage the domain checks"""
+                                  stop_without_old_results: bool,
+                                  chunk_progress: typing.Optional[ChunkProgress]=None):
+    """
+    The method called to create a thread and manage the domain checks
+    If chunk_progress is set every checked domain is marked as done after its measurement
+    results are committed by the measurement_results_saver
+    """
     logger.debug('thread started')
 
     def get_domains() -> typing.Generator[typing.Tuple[Domain, typing.List[LocationHint]],
@@ -549,6 +704,9 @@ def domain_check_threading_manage(next_domain_info: typing.Callable[
         except Exception:
             logger.exception('Check Domain Error %s', domain.name)
 
+        if chunk_progress is not None:
+            measurement_results_queue.put(CommitMarker(domain.id))
+
     logger.debug('Thread finished')
 
 
@@ -1026,11 +1184,14 @@ def assign_location_probes(locations: [LocationInfo], probes: [RipeAtlasProbe],
                                                                    Location]]:
     near_probes_assignments = []
     location_to_probes_dct = {}
+    probe_lats, probe_lons = Location.coordinate_arrays([probe.location for probe in probes])
 
     for location in locations:
         near_probes = []
-        for probe in probes:
-            dist = probe.location.gps_distance_haversine(location)
+        probe_indexes, probe_distances = geo.indexes_within_radius(
+            location.lat, location.lon, probe_lats, probe_lons, 1000)
+        for probe_index, dist in zip(probe_indexes.tolist(), probe_distances.tolist()):
+            probe = probes[probe_index]
             if dist < 1000:
                 _ = str(probe.location.lat) + str(probe.location.lon) + probe.location.id + \
                     str(probe.second_hop_latency)
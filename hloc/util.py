@@ -165,6 +165,30 @@ def _start_token_generation(sema: mp.Semaphore, tokens_per_second: int, stop_eve
     logging.debug('token generation thread stoopped')
 
 
+class SharedCounters(object):
+    """
+    A block of named integer counters in shared memory
+    Worker processes add to the counters and the main process reads them for progress reports.
+    The counters have to be created before the processes are started.
+    """
+
+    def __init__(self, names: [str]):
+        self.names = list(names)
+        self._indexes = {name: index for index, name in enumerate(self.names)}
+        self._values = mp.Array('q', len(self.names))
+
+    def add(self, **increments: int):
+        """Adds the increments to the counters of the same names in one locked update"""
+        with self._values.get_lock():
+            for name, increment in increments.items():
+                self._values[self._indexes[name]] += increment
+
+    def values(self) -> {str: int}:
+        """Returns a consistent snapshot of all counters"""
+        with self._values.get_lock():
+            return dict(zip(self.names, self._values[:]))
+
+
 __all__ = ['count_lines',
            'seek_lines',
            'hex_for_ip',
@@ -174,4 +198,5 @@ __all__ = ['count_lines',
            'setup_logger',
            'ip_to_int',
            'int_to_alphanumeric',
-           'get_class_properties']
+           'get_class_properties',
+           'SharedCounters']
@@ -4,6 +4,7 @@ from distutils.core import setup
 
 install_requires = ['requests>=2.12.4', 'ripe.atlas.cousteau>=1.3', 'configargparse>=0.11',
                     'sqlalchemy>=1.1.4', 'psycopg2>=2.6.2', 'marisa-trie>=0.7.4', 'ipaddress>=1.0',
+                    'pyahocorasick>=1.1.4', 'numpy>=1.12',
                     'typing>=3.6', 'multiprocessing-logging>=0.2.5']
 
 setup(name='hloc',
@@ -11,6 +12,7 @@ setup(name='hloc',
       description='Hints based LOCation verification framework',
       author='Patrick Sattler',
       author_email='sattler@in.tum.de',
-      packages=['hloc', 'hloc.scripts', 'hloc.models'],
+      packages=['hloc', 'hloc.scripts', 'hloc.models', 'hloc.find_helper'],
       install_requires=install_requires,
+      extras_require={'export': ['pyarrow>=0.15']},
       )